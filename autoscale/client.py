@@ -1,73 +1,2243 @@
-from threading import Thread, Timer
+from threading import Thread, Lock, Event
+import os
 import time
 import json
-from queue import SimpleQueue
+import math
+import random
+import socket
+import gzip
+import asyncio
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urlencode, parse_qsl
 import requests
 from flask import Flask, request, Response, make_response
 
+
+class HttpProtocolError(Exception):
+    pass
+
+
+class PeerError(Exception):
+    pass
+
+
+class HttpConnection:
+    """
+    One keep-alive HTTP/1.1 connection to the http server.
+    Only the small subset of HTTP needed to issue GET requests to the server app is implemented,
+    so the client image does not need any extra package besides flask.
+    """
+
+    # bodies of this content type are counted and dropped instead of kept, like payloads of the server
+    DISCARDED_TYPE = "application/octet-stream"
+    # bytes read at once from a dropped body
+    READ_SIZE = 1 << 16
+
+    def __init__(self, host: str, port: int, host_header: str, generation: int = 0):
+        """
+        :param generation: generation of the pool when the connection is opened
+        """
+        self.host = host
+        self.port = port
+        self.host_header = host_header
+        self.generation = generation
+        self.reader = None
+        self.writer = None
+        self.requests = 0
+        self.reusable = True
+        self.opened_at = None
+        # server pod of the last response, keep-alive requests usually go to the same pod
+        self.pod = None
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.opened_at = time.monotonic()
+
+    def is_closed(self):
+        return self.writer is None or self.writer.is_closing() or self.reader.at_eof()
+
+    def close(self):
+        self.reusable = False
+        if self.writer is not None:
+            self.writer.close()
+
+    async def get(self, target: str):
+        """
+        Send one GET request and read the whole response.
+
+        :param target: request target, path and query string
+        :return: (status code, lower case header dict, body bytes, body size), body is empty if it is dropped
+        """
+        self.writer.write("GET {} HTTP/1.1\r\nHost: {}\r\n\r\n".format(target, self.host_header).encode("latin-1"))
+        await self.writer.drain()
+
+        status_line = await self.reader.readuntil(b"\r\n")
+        parts = status_line.split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith(b"HTTP/"):
+            raise HttpProtocolError("invalid status line: {!r}".format(status_line))
+        status = int(parts[1])
+        headers = {}
+        while True:
+            line = await self.reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        keep = not headers.get("content-type", "").startswith(self.DISCARDED_TYPE)
+        if "content-length" in headers:
+            body, size = await self._read_exactly(int(headers["content-length"]), keep)
+        elif headers.get("transfer-encoding", "").lower() == "chunked":
+            body, size = await self._read_chunked(keep)
+        else:
+            # body is delimited by connection close
+            body, size = await self._read_exactly(None, keep)
+            self.reusable = False
+
+        connection = headers.get("connection", "").lower()
+        if connection == "close" or (parts[0] == b"HTTP/1.0" and connection != "keep-alive"):
+            self.reusable = False
+        self.requests += 1
+        self.pod = headers.get("x-pod-name", self.pod)
+        return status, headers, body, size
+
+    async def _read_exactly(self, size, keep: bool):
+        '''
+        Read size bytes, or until connection close if size is None.
+
+        :param keep: keep the bytes read, or only count them
+        :return: (bytes read if kept, count of bytes read)
+        '''
+        if keep:
+            body = await self.reader.readexactly(size) if size is not None else await self.reader.read()
+            return body, len(body)
+        received = 0
+        while size is None or received < size:
+            data = await self.reader.read(self.READ_SIZE if size is None else min(self.READ_SIZE, size - received))
+            if not data:
+                if size is None:
+                    break
+                raise asyncio.IncompleteReadError(b"", size - received)
+            received += len(data)
+        return b"", received
+
+    async def _read_chunked(self, keep: bool):
+        chunks = []
+        received = 0
+        while True:
+            size_line = await self.reader.readuntil(b"\r\n")
+            size = int(size_line.split(b";", 1)[0], 16)
+            if size == 0:
+                # skip trailers
+                while await self.reader.readuntil(b"\r\n") != b"\r\n":
+                    pass
+                return b"".join(chunks), received
+            chunk, chunk_size = await self._read_exactly(size, keep)
+            chunks.append(chunk)
+            received += chunk_size
+            await self.reader.readexactly(2)
+
+
+class RotationPolicy:
+    """
+    When keep-alive connections are closed and replaced by new ones. Connections through a service
+    stay on the server pod chosen when they are opened, rotating them spreads the load onto pods
+    added by a scale out.
+    """
+
+    MAX_REQUESTS = "max_requests"
+    MAX_AGE = "max_age"
+    ENDPOINTS = "endpoints"
+
+    def __init__(self, max_requests: int = 0, max_age: float = 0, endpoints_service: str = None):
+        """
+        :param max_requests: requests sent on a connection before it is closed, 0 means no limit
+        :param max_age: seconds after which a connection is closed, 0 means no limit
+        :param endpoints_service: headless service of the server pods, all connections are replaced
+            when the number of its addresses changes
+        """
+        self.max_requests = max_requests
+        self.max_age = max_age
+        self.endpoints_service = endpoints_service
+
+    @classmethod
+    def from_request(cls, data: dict) -> "RotationPolicy":
+        ''' Policy of the rotation field of POST /start body, None if there is no rotation. '''
+        rotation = data.get("rotation")
+        if not rotation:
+            return None
+        return cls(max_requests=int(rotation.get("max_requests", 0)), max_age=float(rotation.get("max_age", 0)),
+                   endpoints_service=rotation.get("endpoints_service"))
+
+    def to_request(self) -> dict:
+        return {"max_requests": self.max_requests, "max_age": self.max_age,
+                "endpoints_service": self.endpoints_service}
+
+    def expired(self, conn: HttpConnection):
+        ''' Reason to close the connection, None if it can be reused. '''
+        if self.max_requests and conn.requests >= self.max_requests:
+            return self.MAX_REQUESTS
+        if self.max_age and time.monotonic() - conn.opened_at >= self.max_age:
+            return self.MAX_AGE
+        return None
+
+
+class OverloadPolicy:
+    """
+    What the client does with sends which are due while all connections are busy.
+    queue: wait for a free connection, at most max_backlog sends wait, others are dropped.
+    shed: drop every send which can't start within max_lateness seconds of its intended time.
+    catchup: wait for a free connection like queue, but sends start at most at catchup_factor
+    times the planned rate, so a backlog is not fired as a burst.
+    Unless the policy is catchup, sends waiting when the rate or profile changes are dropped.
+    """
+
+    QUEUE = "queue"
+    SHED = "shed"
+    CATCHUP = "catchup"
+
+    def __init__(self, policy: str = QUEUE, max_backlog: int = 0, max_lateness: float = 1.0,
+                 catchup_factor: float = 1.5, late_threshold: float = 0.05):
+        """
+        :param policy: queue, shed or catchup
+        :param max_backlog: max number of waiting sends of queue and catchup policy, 0 means no limit
+        :param max_lateness: max delay of a send behind its intended time with shed policy
+        :param catchup_factor: max send rate of catchup policy relative to the planned rate
+        :param late_threshold: sends delayed by more than this behind their intended time are counted as late
+        """
+        if policy not in (self.QUEUE, self.SHED, self.CATCHUP):
+            raise ValueError("unsupported overload policy: {}".format(policy))
+        if catchup_factor <= 1:
+            raise ValueError("catchup_factor must be above 1")
+        self.policy = policy
+        self.max_backlog = max_backlog
+        self.max_lateness = max_lateness
+        self.catchup_factor = catchup_factor
+        self.late_threshold = late_threshold
+
+    @classmethod
+    def from_request(cls, data: dict) -> "OverloadPolicy":
+        ''' Policy of the overload field of POST /start body, default is queue without limit. '''
+        overload = data.get("overload") or {}
+        return cls(policy=overload.get("policy", cls.QUEUE), max_backlog=int(overload.get("max_backlog", 0)),
+                   max_lateness=float(overload.get("max_lateness", 1.0)),
+                   catchup_factor=float(overload.get("catchup_factor", 1.5)),
+                   late_threshold=float(overload.get("late_threshold", 0.05)))
+
+    def to_request(self) -> dict:
+        return {"policy": self.policy, "max_backlog": self.max_backlog, "max_lateness": self.max_lateness,
+                "catchup_factor": self.catchup_factor, "late_threshold": self.late_threshold}
+
+
+class WorkloadMix:
+    """
+    Weighted mix of server workloads, every request runs one workload picked at random by weight.
+    Workloads are served by /work/<workload> of the server, see server.py for the workloads and their
+    parameters. Entries are named by their workload unless given a name, stats are kept by entry name.
+    """
+
+    def __init__(self, entries: list):
+        """
+        :param entries: list like [{"workload": "memory", "params": {"mib": 64}, "weight": 1, "name": "mem64"}, ..]
+        """
+        if not entries:
+            raise ValueError("workload mix is empty")
+        self.entries = []
+        self.targets = []
+        self.cum_weights = []
+        total = 0.0
+        for entry in entries:
+            weight = float(entry.get("weight", 1))
+            if weight <= 0:
+                raise ValueError("weight of workload {} must be positive".format(entry["workload"]))
+            params = entry.get("params") or {}
+            name = entry.get("name") or entry["workload"]
+            self.entries.append({"workload": entry["workload"], "params": params, "weight": weight, "name": name})
+            self.targets.append((name, "/work/" + entry["workload"] + ("?" + urlencode(params) if params else "")))
+            total += weight
+            self.cum_weights.append(total)
+
+    @classmethod
+    def from_request(cls, data: dict) -> "WorkloadMix":
+        ''' Mix of the workloads field of POST /start body, None if requests go to the target url. '''
+        entries = data.get("workloads")
+        return cls(entries) if entries else None
+
+    def to_request(self) -> list:
+        return [dict(entry) for entry in self.entries]
+
+    def pick(self) -> tuple:
+        ''' (entry name, request target) of a workload picked at random by weight. '''
+        return random.choices(self.targets, cum_weights=self.cum_weights)[0]
+
+
+class HttpConnectionPool:
+    """ Pool of idle keep-alive connections to one host. """
+
+    def __init__(self, host: str, port: int, host_header: str, size: int, rotation: RotationPolicy = None):
+        self.host = host
+        self.port = port
+        self.host_header = host_header
+        self.size = size
+        self.rotation = rotation
+        self.idle = deque()
+        self.opened = 0
+        # connections opened before the last rotate are closed when released
+        self.generation = 0
+        # connections opened and rotated since the last take_counts
+        self.counts = {}
+
+    def _count(self, key: str):
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def _expired(self, conn: HttpConnection):
+        if conn.generation != self.generation:
+            return RotationPolicy.ENDPOINTS
+        return self.rotation.expired(conn) if self.rotation else None
+
+    async def acquire(self):
+        while self.idle:
+            conn = self.idle.pop()
+            if conn.is_closed():
+                continue
+            reason = self._expired(conn)
+            if reason is None:
+                return conn
+            conn.close()
+            self._count(reason)
+        conn = HttpConnection(self.host, self.port, self.host_header, self.generation)
+        await conn.open()
+        self.opened += 1
+        self._count("opened")
+        return conn
+
+    def release(self, conn: HttpConnection):
+        reason = self._expired(conn) if conn.reusable else None
+        if reason is not None:
+            self._count(reason)
+        if conn.reusable and reason is None and len(self.idle) < self.size:
+            self.idle.append(conn)
+        else:
+            conn.close()
+
+    def rotate(self):
+        ''' Replace all connections, idle ones are closed at once and busy ones when released. '''
+        self.generation += 1
+        while self.idle:
+            self.idle.pop().close()
+            self._count(RotationPolicy.ENDPOINTS)
+
+    def take_counts(self) -> dict:
+        counts = self.counts
+        self.counts = {}
+        return counts
+
+    def close(self):
+        while self.idle:
+            self.idle.pop().close()
+
+
+class LatencyHistogram:
+    """
+    Log bucketed latency histogram in the style of HdrHistogram.
+    Values are recorded in microseconds. Values below SUB_BUCKETS have a bucket each, and every power
+    of two range above is split into HALF_SUB_BUCKETS linear buckets, so the relative error of a
+    quantile is at most 1/HALF_SUB_BUCKETS (1/32), and the number of buckets, hence the memory used,
+    is bounded whatever the number of samples.
+    """
+
+    SUB_BUCKET_BITS = 6
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+    HALF_SUB_BUCKETS = SUB_BUCKETS >> 1
+    # values above about 19 hours are recorded in the last bucket
+    MAX_VALUE = (1 << 36) - 1
+
+    def __init__(self):
+        # bucket index -> count, only non-empty buckets are kept
+        self.counts = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    @classmethod
+    def bucket_index(cls, value: int) -> int:
+        if value < cls.SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - cls.SUB_BUCKET_BITS
+        return cls.SUB_BUCKETS + (shift - 1) * cls.HALF_SUB_BUCKETS + (value >> shift) - cls.HALF_SUB_BUCKETS
+
+    @classmethod
+    def bucket_upper(cls, index: int) -> int:
+        ''' Highest value which is recorded in the bucket. '''
+        if index < cls.SUB_BUCKETS:
+            return index
+        shift, sub = divmod(index - cls.SUB_BUCKETS, cls.HALF_SUB_BUCKETS)
+        shift += 1
+        return ((sub + cls.HALF_SUB_BUCKETS + 1) << shift) - 1
+
+    def record(self, value: float):
+        ''' Record one latency sample, unit is second. '''
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        index = self.bucket_index(min(max(int(value * 1000000), 0), self.MAX_VALUE))
+        self.counts[index] = self.counts.get(index, 0) + 1
+
+    def merge(self, other: "LatencyHistogram"):
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+
+    def quantiles(self, quantiles: tuple) -> list:
+        ''' Value at each quantile in ascending quantiles, unit is second. '''
+        result = []
+        if not self.count:
+            return [None] * len(quantiles)
+        buckets = sorted(self.counts.items())
+        i = 0
+        cumulative = buckets[0][1]
+        for quantile in quantiles:
+            rank = max(1, quantile * self.count)
+            while cumulative < rank and i + 1 < len(buckets):
+                i += 1
+                cumulative += buckets[i][1]
+            value = self.bucket_upper(buckets[i][0]) / 1000000
+            result.append(min(max(value, self.min), self.max))
+        return result
+
+    def cumulative_counts(self, bounds: tuple) -> list:
+        ''' Number of samples not above each bound in ascending bounds, unit is second. '''
+        result = []
+        buckets = sorted(self.counts.items())
+        i = 0
+        cumulative = 0
+        for bound in bounds:
+            while i < len(buckets) and self.bucket_upper(buckets[i][0]) <= bound * 1000000:
+                cumulative += buckets[i][1]
+                i += 1
+            result.append(cumulative)
+        return result
+
+    def to_raw(self) -> dict:
+        ''' JSON serializable form from which the histogram can be rebuilt and merged exactly. '''
+        return {
+            "counts": {str(index): count for index, count in self.counts.items()},
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max
+        }
+
+    @classmethod
+    def from_raw(cls, raw: dict) -> "LatencyHistogram":
+        histogram = cls()
+        histogram.counts = {int(index): count for index, count in raw["counts"].items()}
+        histogram.count = raw["count"]
+        histogram.sum = raw["sum"]
+        histogram.min = raw["min"]
+        histogram.max = raw["max"]
+        return histogram
+
+    def to_dict(self) -> dict:
+        p50, p90, p99, p999 = self.quantiles((0.5, 0.9, 0.99, 0.999))
+        return {
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": p50,
+            "p90": p90,
+            "p99": p99,
+            "p999": p999
+        }
+
+
+def throttled_share(throttled_seconds: float, duration: float) -> float:
+    ''' Share of the server handling duration in which the server pod was throttled by its cpu limit. '''
+    return throttled_seconds / duration if duration > 0 else 0.0
+
+
+class BackendStats:
+    """ Requests served by one server pod, identified by the X-Pod-Name response header. """
+
+    def __init__(self):
+        self.completed = 0
+        self.errors = 0
+        self.cpu_load_duration = 0.0
+        # cpu time of server threads and time the server pod was throttled by its cpu limit
+        self.server_cpu_seconds = 0.0
+        self.server_throttled_seconds = 0.0
+        # response body bytes
+        self.received_bytes = 0
+        self.latency = LatencyHistogram()
+
+    def record(self, cpu_load_duration: float, server_cpu_seconds: float, server_throttled_seconds: float,
+               received_bytes: int):
+        self.completed += 1
+        self.cpu_load_duration += cpu_load_duration
+        self.server_cpu_seconds += server_cpu_seconds
+        self.server_throttled_seconds += server_throttled_seconds
+        self.received_bytes += received_bytes
+
+    def merge(self, other: "BackendStats"):
+        self.completed += other.completed
+        self.errors += other.errors
+        self.cpu_load_duration += other.cpu_load_duration
+        self.server_cpu_seconds += other.server_cpu_seconds
+        self.server_throttled_seconds += other.server_throttled_seconds
+        self.received_bytes += other.received_bytes
+        self.latency.merge(other.latency)
+
+    def to_raw(self) -> dict:
+        return {
+            "completed": self.completed,
+            "errors": self.errors,
+            "cpu_load_duration": self.cpu_load_duration,
+            "server_cpu_seconds": self.server_cpu_seconds,
+            "server_throttled_seconds": self.server_throttled_seconds,
+            "received_bytes": self.received_bytes,
+            "latency": self.latency.to_raw()
+        }
+
+    @classmethod
+    def from_raw(cls, raw: dict) -> "BackendStats":
+        stats = cls()
+        stats.completed = raw["completed"]
+        stats.errors = raw["errors"]
+        stats.cpu_load_duration = raw["cpu_load_duration"]
+        stats.server_cpu_seconds = raw["server_cpu_seconds"]
+        stats.server_throttled_seconds = raw["server_throttled_seconds"]
+        stats.received_bytes = raw["received_bytes"]
+        stats.latency = LatencyHistogram.from_raw(raw["latency"])
+        return stats
+
+    def to_dict(self, duration: float) -> dict:
+        '''
+        :param duration: length of the period in seconds, used to compute the throughput in bytes/s
+        '''
+        return {
+            "completed": self.completed,
+            "errors": self.errors,
+            "cpu_load_duration": self.cpu_load_duration,
+            "server_cpu_seconds": self.server_cpu_seconds,
+            "server_throttled_seconds": self.server_throttled_seconds,
+            "throttled_share": throttled_share(self.server_throttled_seconds, self.cpu_load_duration),
+            "received_bytes": self.received_bytes,
+            "throughput": self.received_bytes / duration if duration > 0 else 0,
+            "latency": self.latency.to_dict()
+        }
+
+
+class WorkloadStats(BackendStats):
+    """ Requests of one entry of a WorkloadMix, with the resources consumed as reported by the server. """
+
+    def __init__(self):
+        super().__init__()
+        # reported resource -> sum, like memory_bytes or bytes_read, or max of peaks
+        self.resources = {}
+
+    def add_resources(self, report: dict):
+        ''' Sum the resources of a report, but keep the max of peaks like max_rss_bytes. '''
+        for key, value in report.items():
+            # time and cpu accounting of the request are not resources of the workload
+            if key in ("workload", "duration", "cpu_seconds", "throttled_seconds", "throttled_periods") \
+                    or not isinstance(value, (int, float)):
+                continue
+            if key.startswith("max_"):
+                self.resources[key] = max(value, self.resources.get(key, value))
+            else:
+                self.resources[key] = self.resources.get(key, 0) + value
+
+    def merge(self, other: "WorkloadStats"):
+        super().merge(other)
+        self.add_resources(other.resources)
+
+    def to_raw(self) -> dict:
+        raw = super().to_raw()
+        raw["resources"] = dict(self.resources)
+        return raw
+
+    @classmethod
+    def from_raw(cls, raw: dict) -> "WorkloadStats":
+        stats = super().from_raw(raw)
+        stats.resources = dict(raw["resources"])
+        return stats
+
+    def to_dict(self, duration: float) -> dict:
+        data = super().to_dict(duration)
+        data["resources"] = dict(self.resources)
+        return data
+
+
+class TrafficStats:
+    """
+    Counters and latency histograms of the traffic generated in a period.
+    Stats of one interval also hold the gauges sampled when the interval is closed.
+    """
+
+    COUNTERS = ("scheduled", "sent", "dropped", "late", "completed", "errors", "cpu_load_duration",
+                "server_cpu_seconds", "server_throttled_seconds", "requested_cpu_seconds", "received_bytes",
+                "connections_opened")
+    GAUGES = ("in_flight", "backlog")
+
+    def __init__(self, begin: float):
+        """
+        :param begin: wall clock time of the period begin
+        """
+        self.begin = begin
+        self.scheduled = 0
+        self.sent = 0
+        # sends dropped by the overload policy, and sends made later than the late threshold
+        self.dropped = 0
+        self.late = 0
+        self.completed = 0
+        self.errors = 0
+        self.cpu_load_duration = 0.0
+        # cpu time burned by server threads, time server pods were throttled by their cpu limit while
+        # handling requests, and cpu time requested by cpu_ms, as reported by server
+        self.server_cpu_seconds = 0.0
+        self.server_throttled_seconds = 0.0
+        self.requested_cpu_seconds = 0.0
+        # response body bytes
+        self.received_bytes = 0
+        self.connections_opened = 0
+        self.error_types = {}
+        # closed connections by rotation reason
+        self.rotations = {}
+        # server pod name -> BackendStats
+        self.backends = {}
+        # workload mix entry name -> WorkloadStats
+        self.workloads = {}
+        # latency from intended send time to response, and from actual send time to response
+        self.latency = LatencyHistogram()
+        self.service_time = LatencyHistogram()
+        # gauges, None until sampled
+        self.in_flight = None
+        self.backlog = None
+
+    def close(self, in_flight: int, backlog: int):
+        ''' Sample gauges at the end of the interval. '''
+        self.in_flight = in_flight
+        self.backlog = backlog
+
+    def record_error(self, error_type: str):
+        self.errors += 1
+        self.error_types[error_type] = self.error_types.get(error_type, 0) + 1
+
+    def backend(self, name: str) -> BackendStats:
+        if name not in self.backends:
+            self.backends[name] = BackendStats()
+        return self.backends[name]
+
+    def workload(self, name: str) -> WorkloadStats:
+        if name not in self.workloads:
+            self.workloads[name] = WorkloadStats()
+        return self.workloads[name]
+
+    def merge(self, other: "TrafficStats", gauges: bool = False, extend: bool = True):
+        '''
+        :param gauges: also sum gauges, only when merging the same interval of several clients
+        :param extend: begin at the earlier begin of both periods, not when merging an interval into a
+            total which begins with the schedule, inside the interval
+        '''
+        if extend:
+            self.begin = min(self.begin, other.begin)
+        for key in self.COUNTERS:
+            setattr(self, key, getattr(self, key) + getattr(other, key))
+        if gauges:
+            for key in self.GAUGES:
+                if getattr(other, key) is not None:
+                    setattr(self, key, (getattr(self, key) or 0) + getattr(other, key))
+        for error_type, count in other.error_types.items():
+            self.error_types[error_type] = self.error_types.get(error_type, 0) + count
+        for reason, count in other.rotations.items():
+            self.rotations[reason] = self.rotations.get(reason, 0) + count
+        for name, backend in other.backends.items():
+            self.backend(name).merge(backend)
+        for name, workload in other.workloads.items():
+            self.workload(name).merge(workload)
+        self.latency.merge(other.latency)
+        self.service_time.merge(other.service_time)
+
+    def to_raw(self) -> dict:
+        raw = {key: getattr(self, key) for key in self.COUNTERS + self.GAUGES}
+        raw["begin"] = self.begin
+        raw["error_types"] = dict(self.error_types)
+        raw["rotations"] = dict(self.rotations)
+        raw["backends"] = {name: backend.to_raw() for name, backend in self.backends.items()}
+        raw["workloads"] = {name: workload.to_raw() for name, workload in self.workloads.items()}
+        raw["latency"] = self.latency.to_raw()
+        raw["service_time"] = self.service_time.to_raw()
+        return raw
+
+    @classmethod
+    def from_raw(cls, raw: dict) -> "TrafficStats":
+        stats = cls(raw["begin"])
+        for key in cls.COUNTERS + cls.GAUGES:
+            setattr(stats, key, raw[key])
+        stats.error_types = dict(raw["error_types"])
+        stats.rotations = dict(raw["rotations"])
+        stats.backends = {name: BackendStats.from_raw(backend) for name, backend in raw["backends"].items()}
+        stats.workloads = {name: WorkloadStats.from_raw(workload) for name, workload in raw["workloads"].items()}
+        stats.latency = LatencyHistogram.from_raw(raw["latency"])
+        stats.service_time = LatencyHistogram.from_raw(raw["service_time"])
+        return stats
+
+    def to_dict(self, duration: float) -> dict:
+        '''
+        :param duration: length of the period in seconds, used to compute rates in reqs/min
+        '''
+        data = {key: getattr(self, key) for key in self.COUNTERS}
+        data.update({key: getattr(self, key) for key in self.GAUGES if getattr(self, key) is not None})
+        data["error_types"] = dict(self.error_types)
+        data["rotations"] = dict(self.rotations)
+        data["backends"] = {name: backend.to_dict(duration) for name, backend in sorted(self.backends.items())}
+        data["workloads"] = {name: workload.to_dict(duration) for name, workload in sorted(self.workloads.items())}
+        data["throughput"] = self.received_bytes / duration if duration > 0 else 0
+        data["throttled_share"] = throttled_share(self.server_throttled_seconds, self.cpu_load_duration)
+        data["send_rate"] = self.sent * 60 / duration if duration > 0 else 0
+        data["achieved_rate"] = self.completed * 60 / duration if duration > 0 else 0
+        data["latency"] = self.latency.to_dict()
+        data["service_time"] = self.service_time.to_dict()
+        return data
+
+
+class LinearSegment:
+    """ Part of a rate profile in which the rate changes linearly, or stays constant. """
+
+    def __init__(self, index: int, shape: str, duration: float, begin_rate: float, end_rate: float):
+        """
+        :param index: index of the profile segment this part belongs to
+        :param shape: shape of the profile segment this part belongs to
+        :param duration: duration in seconds, may be infinite for a constant rate
+        :param begin_rate: rate at the begin, unit: reqs/min
+        :param end_rate: rate at the end, unit: reqs/min
+        """
+        if begin_rate < 0 or end_rate < 0:
+            raise ValueError("rate of {} segment must not be negative".format(shape))
+        if math.isinf(duration) and begin_rate != end_rate:
+            raise ValueError("duration of {} segment must be finite".format(shape))
+        self.index = index
+        self.shape = shape
+        self.duration = duration
+        # rates are kept in reqs/sec
+        self.begin_rate = begin_rate / 60
+        self.slope = 0.0 if begin_rate == end_rate else (end_rate - begin_rate) / 60 / duration
+
+    def rate(self, t: float) -> float:
+        return self.begin_rate + self.slope * t
+
+    def integral(self, t: float) -> float:
+        ''' Request count sent from the begin of this part to t. '''
+        if self.slope == 0:
+            # avoid 0 * inf for an infinite part without requests
+            return self.begin_rate * t if self.begin_rate else 0.0
+        return self.begin_rate * t + self.slope * t * t / 2
+
+    def inverse(self, x: float) -> float:
+        ''' Time offset at which integral reaches x. '''
+        if self.slope == 0:
+            return x / self.begin_rate
+        # positive root of slope / 2 * t ^ 2 + begin_rate * t - x = 0, in a form without cancellation
+        root = math.sqrt(max(self.begin_rate * self.begin_rate + 2 * self.slope * x, 0.0))
+        if self.begin_rate + root == 0:
+            return 0.0
+        return min(2 * x / (self.begin_rate + root), self.duration)
+
+
+class SineSegment:
+    """ Part of a rate profile in which the rate follows a sine wave around a base rate. """
+
+    def __init__(self, index: int, shape: str, duration: float, base: float, amplitude: float, period: float):
+        """
+        :param base: base rate, unit: reqs/min
+        :param amplitude: amplitude of the wave, unit: reqs/min
+        :param period: period of the wave in seconds
+        """
+        if amplitude < 0 or base < amplitude:
+            raise ValueError("base of sine segment must not be less than amplitude")
+        if period <= 0 or math.isinf(duration):
+            raise ValueError("period and duration of sine segment must be positive and finite")
+        self.index = index
+        self.shape = shape
+        self.duration = duration
+        self.base = base / 60
+        self.amplitude = amplitude / 60
+        self.omega = 2 * math.pi / period
+
+    def rate(self, t: float) -> float:
+        return self.base + self.amplitude * math.sin(self.omega * t)
+
+    def integral(self, t: float) -> float:
+        return self.base * t + self.amplitude * (1 - math.cos(self.omega * t)) / self.omega
+
+    def inverse(self, x: float) -> float:
+        # integral is not decreasing, so bisect it down to one microsecond
+        low, high = 0.0, self.duration
+        while high - low > 0.000001:
+            middle = (low + high) / 2
+            if self.integral(middle) < x:
+                low = middle
+            else:
+                high = middle
+        return high
+
+
+class RateProfile:
+    """
+    Time based request rate, a list of segments executed one after another.
+    Every segment is a dict with shape, duration in seconds, and the rates of its shape in reqs/min:
+
+        {"shape": "constant", "duration": 60, "rate": 600}
+        {"shape": "ramp", "duration": 60, "from": 600, "to": 1200}
+        {"shape": "step", "duration": 60, "from": 600, "to": 1200, "steps": 4}
+        {"shape": "sine", "duration": 60, "base": 600, "amplitude": 300, "period": 20}
+        {"shape": "spike", "duration": 60, "base": 600, "peak": 3000, "at": 20, "spike_duration": 5}
+
+    A step segment climbs from the from rate to the to rate in equal steps. A spike segment holds the
+    base rate except for spike_duration seconds from at seconds. After the last segment the rate is 0,
+    unless the profile loops.
+    """
+
+    SHAPES = ("constant", "ramp", "step", "sine", "spike")
+
+    def __init__(self, segments: list, loop: bool = False, scale: float = 1.0):
+        """
+        :param segments: segment definitions like above
+        :param loop: restart from the first segment after the last one
+        :param scale: factor applied to every rate, used to split a profile across workers
+        """
+        if not segments:
+            raise ValueError("profile must have at least one segment")
+        self.segments = segments
+        self.loop = loop
+        self.scale = scale
+        self.parts = []
+        for index, segment in enumerate(segments):
+            self.parts.extend(self._parse(index, segment, scale))
+        self.duration = sum(part.duration for part in self.parts)
+        if loop and math.isinf(self.duration):
+            raise ValueError("profile with infinite duration can not loop")
+
+    @classmethod
+    def constant(cls, rate: float) -> "RateProfile":
+        ''' Profile which holds rate for ever. '''
+        return cls([{"shape": "constant", "rate": rate, "duration": float("inf")}])
+
+    def scaled(self, scale: float) -> "RateProfile":
+        return RateProfile(self.segments, self.loop, self.scale * scale)
+
+    @property
+    def constant_rate(self):
+        ''' Rate of a profile created by constant(), None for other profiles. '''
+        if len(self.parts) == 1 and math.isinf(self.duration):
+            rate = self.segments[0]["rate"]
+            return rate if self.scale == 1 else rate * self.scale
+        return None
+
+    def schedule(self, arrival: str, begin: float) -> "ArrivalSchedule":
+        return ArrivalSchedule(self, arrival, begin)
+
+    def to_request(self) -> dict:
+        ''' Rate or profile fields of a /start request body for this profile. '''
+        if self.constant_rate is not None:
+            return {"rate": self.constant_rate}
+        return {"profile": {"segments": self.segments, "loop": self.loop, "scale": self.scale}}
+
+    @classmethod
+    def from_request(cls, data: dict) -> "RateProfile":
+        ''' Profile of a /start request body, raises KeyError, TypeError or ValueError if invalid. '''
+        if "profile" in data:
+            profile = data["profile"]
+            return cls(profile["segments"], bool(profile.get("loop", False)), float(profile.get("scale", 1.0)))
+        return cls.constant(int(data["rate"]))
+
+    @staticmethod
+    def _parse(index: int, segment: dict, scale: float) -> list:
+        shape = segment.get("shape")
+        duration = float(segment["duration"])
+        if duration <= 0:
+            raise ValueError("duration of segment {} must be positive".format(index))
+        if shape == "constant":
+            rate = float(segment["rate"]) * scale
+            return [LinearSegment(index, shape, duration, rate, rate)]
+        elif shape == "ramp":
+            return [LinearSegment(index, shape, duration, float(segment["from"]) * scale,
+                                  float(segment["to"]) * scale)]
+        elif shape == "step":
+            steps = int(segment["steps"])
+            if steps < 1:
+                raise ValueError("steps of segment {} must be positive".format(index))
+            rate_from = float(segment["from"]) * scale
+            rate_to = float(segment["to"]) * scale
+            parts = []
+            for i in range(steps):
+                rate = rate_from + (rate_to - rate_from) * i / (steps - 1) if steps > 1 else rate_from
+                parts.append(LinearSegment(index, shape, duration / steps, rate, rate))
+            return parts
+        elif shape == "sine":
+            return [SineSegment(index, shape, duration, float(segment["base"]) * scale,
+                                float(segment["amplitude"]) * scale, float(segment["period"]))]
+        elif shape == "spike":
+            base = float(segment["base"]) * scale
+            peak = float(segment["peak"]) * scale
+            at = float(segment.get("at", 0))
+            spike_duration = min(float(segment["spike_duration"]), duration - at)
+            if at < 0 or spike_duration <= 0:
+                raise ValueError("spike of segment {} must be inside the segment".format(index))
+            parts = []
+            if at > 0:
+                parts.append(LinearSegment(index, shape, at, base, base))
+            parts.append(LinearSegment(index, shape, spike_duration, peak, peak))
+            if duration - at - spike_duration > 0:
+                parts.append(LinearSegment(index, shape, duration - at - spike_duration, base, base))
+            return parts
+        raise ValueError("unsupported shape of segment {}: {}, must be one of {}".format(
+            index, shape, ", ".join(RateProfile.SHAPES)))
+
+    def position(self, elapsed: float):
+        '''
+        Locate elapsed seconds since the profile begin.
+
+        :return: (part, offset in part, cycle), part is None after the end of the profile
+        '''
+        cycle = 0
+        if self.loop:
+            cycle, elapsed = divmod(elapsed, self.duration)
+        for part in self.parts:
+            if elapsed < part.duration:
+                return part, elapsed, int(cycle)
+            elapsed -= part.duration
+        return None, 0.0, int(cycle)
+
+    def rate(self, elapsed: float) -> float:
+        ''' Rate at elapsed seconds since the profile begin, unit: reqs/min. '''
+        part, offset, cycle = self.position(elapsed)
+        return part.rate(offset) * 60 if part else 0.0
+
+    def status(self, elapsed: float) -> dict:
+        part, offset, cycle = self.position(elapsed)
+        if part is None:
+            return {"complete": True, "segment": None, "elapsed": elapsed}
+        segment_begin = sum(p.duration for p in self.parts[:self.parts.index(part)] if p.index == part.index)
+        return {
+            "complete": False,
+            "segment": part.index,
+            "segments": len(self.segments),
+            "shape": part.shape,
+            "segment_elapsed": segment_begin + offset,
+            "elapsed": elapsed,
+            "cycle": cycle
+        }
+
+
+class ArrivalSchedule:
+    """
+    Intended send times of an open loop arrival process following a RateProfile.
+    The n-th request is sent when the integral of the rate over time reaches the n-th target: n for
+    constant arrivals, or the sum of n exponentially distributed values of mean 1 for poisson
+    arrivals. Send times are computed from the profile instead of accumulating intervals, so the
+    schedule never drifts and follows rate changes of the profile exactly.
+    """
+
+    CONSTANT = "constant"
+    POISSON = "poisson"
+    # every request is sent to the target url
+    popped_target = None
+
+    def __init__(self, profile: RateProfile, arrival: str, begin: float):
+        """
+        :param profile: the request rate over time
+        :param arrival: arrival process, constant or poisson
+        :param begin: monotonic time of the schedule begin
+        """
+        if arrival not in (self.CONSTANT, self.POISSON):
+            raise ValueError("unsupported arrival process: {}".format(arrival))
+        self.profile = profile
+        self.arrival = arrival
+        self.begin = begin
+        # current part of the profile, its begin time, and the target relative to its begin
+        self.part = 0
+        self.part_begin = begin
+        self.target = 0.0
+        self.next_time = begin
+        self._advance()
+
+    def _advance(self):
+        self.target += 1 if self.arrival == self.CONSTANT else random.expovariate(1)
+        parts = self.profile.parts
+        empty_parts = 0
+        while self.part < len(parts):
+            part = parts[self.part]
+            total = part.integral(part.duration)
+            if self.target <= total:
+                self.next_time = self.part_begin + part.inverse(self.target)
+                return
+            self.target -= total
+            self.part_begin += part.duration
+            self.part += 1
+            empty_parts = empty_parts + 1 if total == 0 else 0
+            if self.part == len(parts) and self.profile.loop and empty_parts < len(parts):
+                self.part = 0
+        self.next_time = float("inf")
+
+    def pop(self) -> float:
+        ''' Return the next intended send time and advance the schedule. '''
+        intended = self.next_time
+        self._advance()
+        return intended
+
+    def rate(self, now: float) -> float:
+        ''' Planned rate, unit: reqs/min. '''
+        return self.profile.rate(now - self.begin)
+
+    def status(self, now: float):
+        ''' Profile status, None for a constant rate. '''
+        if math.isinf(self.profile.duration):
+            return None
+        return self.profile.status(now - self.begin)
+
+    def close(self):
+        pass
+
+
+class TraceProfile:
+    """
+    Recorded request trace replayed as an open loop schedule in place of a rate profile.
+    Every line of the trace file is one request, either csv like "timestamp,path,count" or a json
+    object like {"timestamp": .., "path": .., "count": ..}, path and count are optional and default
+    to those of the target url. Timestamps are seconds, the replay begins at the first one. Blank
+    lines, comments starting with # and lines which can't be parsed are skipped. Files ending with
+    .gz are decompressed on the fly.
+    """
+
+    def __init__(self, path: str, speed: float = 1.0, loop: bool = False, shard: int = 0, shards: int = 1):
+        """
+        :param path: path of the trace file in the client pod
+        :param speed: time scale of the replay, 2 replays the trace twice as fast
+        :param loop: replay the trace again from the beginning when it ends
+        :param shard: index of the entries replayed, entry i is replayed if i % shards == shard
+        :param shards: number of clients replaying the trace together
+        """
+        if speed <= 0:
+            raise ValueError("speed must be positive")
+        if not os.path.isfile(path):
+            raise ValueError("trace file {} is not found".format(path))
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.shard = shard
+        self.shards = shards
+
+    @classmethod
+    def from_request(cls, data: dict) -> "TraceProfile":
+        trace = data["trace"]
+        return cls(path=trace["path"], speed=float(trace.get("speed", 1.0)), loop=bool(trace.get("loop", False)),
+                   shard=int(trace.get("shard", 0)), shards=int(trace.get("shards", 1)))
+
+    def to_request(self) -> dict:
+        return {"trace": {"path": self.path, "speed": self.speed, "loop": self.loop,
+                          "shard": self.shard, "shards": self.shards}}
+
+    def split(self, parts: int) -> list:
+        ''' Split the entries of this shard into parts shards, every part replays one entry out of parts. '''
+        return [TraceProfile(self.path, self.speed, self.loop, self.shard + self.shards * i, self.shards * parts)
+                for i in range(parts)]
+
+    def schedule(self, arrival: str, begin: float) -> "TraceSchedule":
+        return TraceSchedule(self, begin)
+
+
+class TraceSchedule:
+    """
+    Intended send times and targets of the entries of a TraceProfile. The trace file is read one
+    line ahead of the schedule, so traces of any length are replayed in constant memory. When the
+    trace loops, the next cycle begins one mean entry interval after the last entry.
+    """
+
+    # field separator of csv lines
+    SEPARATOR = ","
+
+    def __init__(self, trace: TraceProfile, begin: float):
+        """
+        :param trace: the replayed trace
+        :param begin: monotonic time of the schedule begin
+        """
+        self.trace = trace
+        self.begin = begin
+        self.file = None
+        self.cycle = 0
+        self.cycle_begin = begin
+        # timestamps of the first and last entry, and entry count of the trace file
+        self.first = None
+        self.last = None
+        self.entries = 0
+        self.invalid = 0
+        self.replayed = 0
+        self.complete = False
+        self.next_time = float("inf")
+        self.next_target = None
+        # target of the entry returned by the last pop, None for the target url
+        self.popped_target = None
+        # replayed rate measured over windows of the schedule
+        self.window_begin = begin
+        self.window_count = 0
+        self.window_rate = 0.0
+        self._open()
+        self._advance()
+
+    def _open(self):
+        path = self.trace.path
+        self.file = gzip.open(path, "rt") if path.endswith(".gz") else open(path)
+        self.index = 0
+
+    @classmethod
+    def parse(cls, line: str):
+        ''' (timestamp, path, count) of one trace line, None for blank and comment lines. '''
+        line = line.strip()
+        if not line or line.startswith("#"):
+            return None
+        if line.startswith("{"):
+            entry = json.loads(line)
+            count = entry.get("count")
+            return float(entry["timestamp"]), entry.get("path") or None, int(count) if count is not None else None
+        fields = [field.strip() for field in line.split(cls.SEPARATOR)]
+        path = fields[1] if len(fields) > 1 and fields[1] else None
+        count = int(fields[2]) if len(fields) > 2 and fields[2] else None
+        return float(fields[0]), path, count
+
+    def _advance(self):
+        while self.file is not None:
+            line = self.file.readline()
+            if not line:
+                self._rewind()
+                continue
+            try:
+                entry = self.parse(line)
+            except (ValueError, KeyError, TypeError):
+                self.invalid += 1
+                continue
+            if entry is None:
+                continue
+            timestamp, path, count = entry
+            if self.cycle == 0:
+                self.entries += 1
+                self.first = timestamp if self.first is None else self.first
+                self.last = timestamp
+            index = self.index
+            self.index += 1
+            if index % self.trace.shards != self.trace.shard:
+                continue
+            self.next_time = self.cycle_begin + (timestamp - self.first) / self.trace.speed
+            self.next_target = (path, count) if path is not None or count is not None else None
+            return
+        self.next_time = float("inf")
+        self.next_target = None
+
+    def _rewind(self):
+        self.file.close()
+        self.file = None
+        if not self.trace.loop or self.entries < 2 or self.last <= self.first:
+            self.complete = True
+            return
+        duration = (self.last - self.first) * self.entries / (self.entries - 1)
+        self.cycle += 1
+        self.cycle_begin += duration / self.trace.speed
+        self._open()
+
+    def pop(self) -> float:
+        ''' Return the next intended send time and advance the schedule, its target is popped_target. '''
+        intended = self.next_time
+        self.popped_target = self.next_target
+        self.replayed += 1
+        self.window_count += 1
+        if intended - self.window_begin >= 1:
+            self.window_rate = self.window_count * 60 / (intended - self.window_begin)
+            self.window_begin = intended
+            self.window_count = 0
+        self._advance()
+        return intended
+
+    def rate(self, now: float) -> float:
+        ''' Replayed rate, unit: reqs/min. '''
+        return self.window_rate if now - self.window_begin < 2 else 0.0
+
+    def status(self, now: float) -> dict:
+        return {
+            "trace": self.trace.path,
+            "speed": self.trace.speed,
+            "complete": self.complete,
+            "cycle": self.cycle,
+            "replayed": self.replayed,
+            "invalid": self.invalid,
+            "elapsed": now - self.begin
+        }
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
 class HttpRequestClient(Thread):
+    """
+    Open loop http traffic generator.
+    Requests are sent from an asyncio event loop running in this thread, up to `concurrency` requests
+    are in flight at the same time over pooled keep-alive connections. Every request has an intended
+    send time given by its ArrivalSchedule, and latency is measured from that intended time, so time
+    a request waits because the client or server falls behind is not omitted from the results.
+    """
 
     TIMER_INTERVAL = 1
     DEFAULT_COUNT = 100000
+    DEFAULT_CONCURRENCY = 100
+    # seconds a request may take from waiting for a connection to the end of the response
+    DEFAULT_REQUEST_TIMEOUT = 30.0
+    # number of per interval stats kept in memory
+    INTERVAL_HISTORY = 300
+    # sleep shorter than this is done by yielding to the event loop, so sends are not late by the
+    # timer resolution of the event loop
+    SPIN_THRESHOLD = 0.001
+    # longer sleep waits on the wakeup event, so a rate change or stop takes effect at once
+    WAKEUP_THRESHOLD = 0.05
+    # seconds between resolving the endpoints service of the rotation policy
+    ENDPOINTS_INTERVAL = 5
 
-    def __init__(self, url: str, rate: int):
-        super().__init__()
+    def __init__(self, url: str, rate: int = 0, concurrency: int = DEFAULT_CONCURRENCY,
+                 arrival: str = ArrivalSchedule.CONSTANT, profile: RateProfile = None, begin: float = None,
+                 rotation: RotationPolicy = None, overload: OverloadPolicy = None, workloads: WorkloadMix = None,
+                 request_timeout: float = DEFAULT_REQUEST_TIMEOUT):
+        """
+        :param url: target url
+        :param rate: constant request rate, unit: reqs/min, ignored if profile is given
+        :param concurrency: max number of requests in flight
+        :param arrival: arrival process, constant or poisson
+        :param profile: request rate over time, or a TraceProfile replayed instead
+        :param begin: wall clock time at which the schedule begins, default is when the thread starts
+        :param rotation: connection rotation policy, default is to keep connections as long as possible
+        :param overload: policy of sends due while all connections are busy, default is queue without limit
+        :param workloads: server workloads requested instead of the path of the target url
+        :param request_timeout: seconds after which a request is abandoned and counted as a timeout error
+        """
+        super().__init__(daemon=True)
         self.url = url
-        self.rate = rate
-        self.timer = None
-        self.queue = SimpleQueue()
+        self.request_timeout = request_timeout
+        self.rotation = rotation
+        self.overload = overload if overload else OverloadPolicy()
+        self.workloads = workloads
+        # incremented when the profile changes, sends of a previous epoch are stale
+        self.epoch = 0
+        # earliest start of the next send with catchup policy
+        self.next_start = 0.0
+        self.endpoints = None
+        # server pod name -> wall clock time of its first response
+        self.first_seen = {}
+        self.profile = profile if profile else RateProfile.constant(rate)
+        self.concurrency = concurrency
+        self.arrival = arrival
+        self.begin = begin
         self.run_flag = True
+        self.loop = None
 
-    def timer_function(self):
-        current = time.monotonic()
-        
-        # caculate http request count based on rate and actual timer interval
-        duration = current - self.rate_begin_time
-        count = int((duration + self.TIMER_INTERVAL) * self.rate / 60 - self.sent_reqs)
-        if count > 0:
-            self.queue.put_nowait(count)
-        
-        # restart timer
-        self.timer = Timer(self.TIMER_INTERVAL, self.timer_function)
-        self.timer.start()
+        # url format: http://server_svc_ip/cpu, count parameter is appended to the query string
+        # unless the load is given in calibrated cpu milliseconds by cpu_ms
+        split = urlsplit(url)
+        self.host = split.hostname
+        self.port = split.port or 80
+        self.host_header = split.netloc
+        self.path = split.path or "/"
+        self.query = parse_qsl(split.query)
+        if "count" not in dict(self.query) and "cpu_ms" not in dict(self.query):
+            self.query.append(("count", self.DEFAULT_COUNT))
+        self.target = self.path + "?" + urlencode(self.query)
+
+        self.schedule = self.profile.schedule(arrival, time.monotonic())
+        self.in_flight = 0
+        self.waiting = 0
+        self.max_send_delay = 0.0
+        # stats of completed intervals are merged into total, current interval is recorded in interval.
+        # Total begins with the schedule, so rates of the total do not count the wait for a start time
+        now = time.time()
+        self.total = TrafficStats(begin if begin is not None else now)
+        self.interval = TrafficStats(now - now % self.TIMER_INTERVAL)
+        self.intervals = deque(maxlen=self.INTERVAL_HISTORY)
 
     def run(self):
-        self.sent_reqs = 0
-        self.rate_begin_time = time.monotonic()
-        self.timer = Timer(self.TIMER_INTERVAL, self.timer_function)
-        self.timer.start()
+        asyncio.run(self._run())
+
+    async def _run(self):
+        self.wakeup = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.pool = HttpConnectionPool(self.host, self.port, self.host_header, self.concurrency, self.rotation)
+        self.tasks = set()
+
+        # the schedule begins when the event loop is ready to send, or at the given wall clock time
+        self.schedule.close()
+        self.schedule = self.profile.schedule(self.arrival, monotonic_at(self.begin))
+        if self.begin is None:
+            self.total.begin = time.time()
+        background = [asyncio.ensure_future(self._report())]
+        if self.rotation and self.rotation.endpoints_service:
+            background.append(asyncio.ensure_future(self._watch_endpoints()))
+        await self._schedule()
 
+        for task in background + list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*background, *self.tasks, return_exceptions=True)
+        self.schedule.close()
+        self.pool.close()
+
+    async def _schedule(self):
+        ''' Dispatch every request at its intended send time until stopped. '''
         while self.run_flag:
-            # get request count from queue
-            request_count = self.queue.get()
-            print("current queue size after get one: {}".format(self.queue.qsize()))
-            cpu_load_duration = 0
-            begin = time.monotonic()
-            for i in range(request_count):
-                # url format: http://server_svc_ip/cpu?count=10000
-                resp = requests.get(self.url, params={"count": self.DEFAULT_COUNT})
-                cpu_load_duration += float(resp.text)
-                resp.close()
-            self.sent_reqs += request_count
-            end = time.monotonic()
-            total_duration = end - begin
-            print("request count: {}, cpu load_duration: {}, total_duration: {}".format(request_count, cpu_load_duration, total_duration))
-            if total_duration > self.TIMER_INTERVAL:
-                print("WARNING: current configuration exceed http sending max capability, please decrease rate or DEFAULT_COUNT.")            
+            now = time.monotonic()
+            # dispatch all requests which are due, each keeps its own intended send time
+            while self.schedule.next_time <= now:
+                intended = self.schedule.pop()
+                self._dispatch(intended, self.schedule.popped_target)
+
+            delay = self.schedule.next_time - time.monotonic()
+            if delay >= self.WAKEUP_THRESHOLD:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), min(delay, self.TIMER_INTERVAL))
+                except asyncio.TimeoutError:
+                    pass
+            elif delay >= self.SPIN_THRESHOLD:
+                await asyncio.sleep(delay - self.SPIN_THRESHOLD)
+            else:
+                await asyncio.sleep(0)
+
+    def _dispatch(self, intended: float, target: tuple = None):
+        if self.overload.max_backlog and self.overload.policy != OverloadPolicy.SHED \
+                and self.waiting >= self.overload.max_backlog:
+            self.interval.scheduled += 1
+            self.interval.dropped += 1
+            return
+        task = asyncio.ensure_future(self._send_one(intended, self.epoch, target))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        self.interval.scheduled += 1
+
+    async def _report(self):
+        '''
+        Close the current interval stats every TIMER_INTERVAL and print a summary. Intervals are
+        aligned to wall clock, so intervals of different processes or pods can be merged.
+        '''
+        while True:
+            await asyncio.sleep(self.TIMER_INTERVAL - time.time() % self.TIMER_INTERVAL)
+            interval = self.interval
+            self.interval = TrafficStats(interval.begin + self.TIMER_INTERVAL)
+            for key, count in self.pool.take_counts().items():
+                if key == "opened":
+                    interval.connections_opened += count
+                else:
+                    interval.rotations[key] = interval.rotations.get(key, 0) + count
+            interval.close(self.in_flight, self.waiting)
+            self.total.merge(interval, extend=False)
+            self.intervals.append(interval)
+
+            if self.waiting > 0:
+                print("WARNING: current configuration exceed http sending max capability, "
+                      "please decrease rate or DEFAULT_COUNT, or increase concurrency.")
+            print("request count: {}, completed: {}, errors: {}, in flight: {}, waiting: {}, "
+                  "cpu load_duration: {}".format(interval.scheduled, interval.completed, interval.errors,
+                                                 self.in_flight, self.waiting, interval.cpu_load_duration))
+            if interval.error_types:
+                print("errors by type: {}".format(", ".join("{}: {}".format(error_type, count) for error_type, count
+                                                            in sorted(interval.error_types.items()))))
+
+    async def _watch_endpoints(self):
+        '''
+        Resolve the endpoints service periodically, and replace all connections when the number of
+        server pods changes, so new connections are balanced across the current pods.
+        '''
+        while True:
+            try:
+                infos = await self.loop.getaddrinfo(self.rotation.endpoints_service, self.port,
+                                                    type=socket.SOCK_STREAM)
+                endpoints = sorted(set(info[4][0] for info in infos))
+            except OSError as e:
+                print("resolve endpoints service {} error: {}".format(self.rotation.endpoints_service, e))
+                endpoints = self.endpoints
+            if self.endpoints is not None and endpoints is not None and len(endpoints) != len(self.endpoints):
+                print("server endpoints changed from {} to {}, rotate connections.".format(
+                    len(self.endpoints), len(endpoints)))
+                self.pool.rotate()
+            self.endpoints = endpoints
+            await asyncio.sleep(self.ENDPOINTS_INTERVAL)
+
+    def _overloaded(self, intended: float, epoch: int) -> bool:
+        ''' Whether a send which got a free connection is dropped by the overload policy. '''
+        policy = self.overload
+        if policy.policy == OverloadPolicy.CATCHUP:
+            return False
+        if epoch != self.epoch:
+            return True
+        return policy.policy == OverloadPolicy.SHED and time.monotonic() - intended > policy.max_lateness
+
+    async def _pace(self):
+        ''' Space sends of catchup policy by the capped rate. '''
+        rate = self.schedule.rate(time.monotonic()) * self.overload.catchup_factor
+        now = time.monotonic()
+        if rate <= 0:
+            self.next_start = now
+            return
+        start = max(self.next_start, now)
+        self.next_start = start + 60 / rate
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    def _request_target(self, target: tuple) -> str:
+        ''' Request target of a trace entry, path and count default to those of the target url. '''
+        if target is None:
+            return self.target
+        path, count = target
+        query = [(key, value) for key, value in self.query if key != "count" or count is None]
+        if count is not None:
+            query.append(("count", count))
+        return (path or self.path) + "?" + urlencode(query)
+
+    async def _send_one(self, intended: float, epoch: int, target: tuple = None):
+        self.waiting += 1
+        async with self.semaphore:
+            self.waiting -= 1
+            if self._overloaded(intended, epoch):
+                self.interval.dropped += 1
+                return
+            if self.overload.policy == OverloadPolicy.CATCHUP:
+                await self._pace()
+            self.interval.sent += 1
+            self.in_flight += 1
+            try:
+                begin = time.monotonic()
+                self.max_send_delay = max(self.max_send_delay, begin - intended)
+                if begin - intended > self.overload.late_threshold:
+                    self.interval.late += 1
+                # trace entries keep their own target, other requests run a workload of the mix if any
+                workload = None
+                if target is None and self.workloads:
+                    workload, request_target = self.workloads.pick()
+                else:
+                    request_target = self._request_target(target)
+                # server pod of the connection used, known for a timeout on a reused connection
+                sent_to = {}
+                try:
+                    status, headers, body, received = await asyncio.wait_for(
+                        self._get(request_target, sent_to), self.request_timeout)
+                except asyncio.TimeoutError:
+                    # the connection is closed by _get when cancelled, its response is not read by a later request
+                    self._record_error("timeout", sent_to.get("pod"), workload)
+                    return
+                end = time.monotonic()
+                # the interval may have been closed while waiting for the response
+                stats = self.interval
+                pod = headers.get("x-pod-name")
+                backend = stats.backend(pod) if pod else None
+                workload_stats = stats.workload(workload) if workload else None
+                if pod and pod not in self.first_seen:
+                    self.first_seen[pod] = time.time()
+                    print("first response from server pod {}".format(pod))
+                if status != 200:
+                    self._record_error("http_{}".format(status), pod, workload)
+                    return
+                if headers.get("content-type", "").startswith(HttpConnection.DISCARDED_TYPE):
+                    # payloads are only counted, they carry no report
+                    report, cpu_load_duration = {}, 0.0
+                else:
+                    # /cpu responds with the load duration, or with a json report including it for cpu_ms and
+                    # workloads, time_taken is the duration reported by the server of the docker image
+                    report = json.loads(body) if body.startswith(b"{") else {"duration": float(body)}
+                    cpu_load_duration = report["duration"] if "duration" in report else report["time_taken"]
+                # cpu accounting of the request is in headers of both response forms
+                server_cpu_seconds = float(headers.get("x-cpu-seconds") or report.get("cpu_seconds") or 0.0)
+                server_throttled_seconds = float(headers.get("x-throttled-seconds") or 0.0)
+                stats.cpu_load_duration += cpu_load_duration
+                stats.server_cpu_seconds += server_cpu_seconds
+                stats.server_throttled_seconds += server_throttled_seconds
+                stats.requested_cpu_seconds += report.get("requested_cpu_seconds") or 0.0
+                stats.received_bytes += received
+                stats.completed += 1
+                stats.latency.record(end - intended)
+                stats.service_time.record(end - begin)
+                if backend:
+                    backend.record(cpu_load_duration, server_cpu_seconds, server_throttled_seconds, received)
+                    backend.latency.record(end - intended)
+                if workload_stats:
+                    workload_stats.record(cpu_load_duration, server_cpu_seconds, server_throttled_seconds, received)
+                    workload_stats.latency.record(end - intended)
+                    workload_stats.add_resources(report)
+            except (OSError, ValueError, KeyError, asyncio.IncompleteReadError, HttpProtocolError) as e:
+                # errors are summed up by type in the interval report, not printed one by one
+                self.interval.record_error(type(e).__name__)
+            finally:
+                self.in_flight -= 1
+
+    def _record_error(self, error_type: str, pod: str = None, workload: str = None):
+        ''' Count a failed request in the current interval, and for its server pod and workload if known. '''
+        stats = self.interval
+        stats.record_error(error_type)
+        if pod:
+            stats.backend(pod).errors += 1
+        if workload:
+            stats.workload(workload).errors += 1
+
+    async def _get(self, target: str, sent_to: dict = None):
+        '''
+        :param sent_to: if given, the pod field is set to the server pod of the connection used, if known
+        '''
+        conn = await self.pool.acquire()
+        if sent_to is not None:
+            sent_to["pod"] = conn.pod
+        try:
+            result = await conn.get(target)
+        except (OSError, asyncio.IncompleteReadError):
+            conn.close()
+            if conn.requests == 0:
+                raise
+            # idle keep-alive connection was closed by server, retry once on a new connection
+            conn = await self.pool.acquire()
+            if sent_to is not None:
+                sent_to["pod"] = conn.pod
+            try:
+                result = await conn.get(target)
+            except BaseException:
+                conn.close()
+                raise
+        except BaseException:
+            conn.close()
+            raise
+        self.pool.release(conn)
+        return result
+
+    def _apply_profile(self, profile: RateProfile, begin: float):
+        self.schedule.close()
+        self.schedule = profile.schedule(self.arrival, monotonic_at(begin))
+        self.profile = profile
+        # backlog of the previous profile is not fired at the new rate
+        self.epoch += 1
+        if self.loop:
+            self.wakeup.set()
+
+    def change_profile(self, profile: RateProfile, begin: float = None):
+        '''
+        Replace the rate profile or trace, the new profile begins at wall clock time begin, default is now.
+        '''
+        if self.loop:
+            self.loop.call_soon_threadsafe(self._apply_profile, profile, begin)
+        else:
+            self._apply_profile(profile, begin)
 
     def change_http_rate(self, rate):
-        self.queue.empty()
-        self.sent_reqs = 0
-        self.rate_begin_time = time.monotonic()
-        self.rate = rate
+        self.change_profile(RateProfile.constant(rate))
+
+    def _call_in_loop(self, func):
+        ''' Call func in the event loop thread, so stats are not read while being updated. '''
+        if self.loop is not None and self.is_alive():
+            async def call():
+                return func()
+            try:
+                return asyncio.run_coroutine_threadsafe(call(), self.loop).result()
+            except RuntimeError:
+                # event loop has been closed
+                pass
+        return func()
+
+    def _snapshot(self, intervals: int):
+        total = TrafficStats(self.total.begin)
+        total.merge(self.total)
+        total.merge(self.interval, extend=False)
+        now = time.monotonic()
+        return {
+            "target_url": self.url,
+            "rate": self.schedule.rate(now),
+            "profile": self.schedule.status(now),
+            "arrival": self.arrival,
+            "concurrency": self.concurrency,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "max_send_delay": self.max_send_delay,
+            "rotation": self.rotation.to_request() if self.rotation else None,
+            "overload": self.overload.to_request(),
+            "workloads": self.workloads.to_request() if self.workloads else None,
+            "endpoints": len(self.endpoints) if self.endpoints is not None else None,
+            "first_seen": dict(self.first_seen),
+            "total": total,
+            "intervals": list(self.intervals)[-intervals:] if intervals > 0 else []
+        }
+
+    def snapshot(self, intervals: int = INTERVAL_HISTORY):
+        '''
+        Stats of the client which can be merged with merge_snapshots, see render_stats.
+
+        :param intervals: number of last intervals included
+        '''
+        return self._call_in_loop(lambda: self._snapshot(intervals))
+
+    def status(self):
+        return render_status(self.snapshot(0))
+
+    def stats(self, intervals: int = INTERVAL_HISTORY):
+        return render_stats(self.snapshot(intervals), intervals)
 
     def stop(self):
         self.run_flag = False
-        self.timer.cancel()
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+
+def monotonic_at(wall_time: float = None) -> float:
+    ''' Monotonic clock time corresponding to a wall clock time, default is now. '''
+    now = time.monotonic()
+    return now if wall_time is None else now + wall_time - time.time()
+
+
+def available_cpus():
+    '''
+    Number of cpus this pod may use. The cgroup cpu limit is honored because os.cpu_count()
+    reports the cpus of the node instead of the pod limit.
+    '''
+    cpus = len(os.sched_getaffinity(0))
+    try:
+        # cgroup v2
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, float(quota) / float(period))
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                quota = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if quota > 0:
+                cpus = min(cpus, quota / period)
+        except (OSError, ValueError):
+            pass
+    return max(1, int(cpus + 0.5))
+
+
+def split_rate(rate: int, parts: int) -> list:
+    ''' Split rate into parts integer rates, the sum of which is exactly rate. '''
+    base, remainder = divmod(rate, parts)
+    return [base + 1 if i < remainder else base for i in range(parts)]
+
+
+def split_profile(profile: RateProfile, parts: int) -> list:
+    ''' Split profile into parts profiles, the sum of which is profile. '''
+    if isinstance(profile, TraceProfile):
+        return profile.split(parts)
+    if profile.constant_rate is not None:
+        # split constant rate into integer rates
+        return [RateProfile.constant(rate) for rate in split_rate(int(profile.constant_rate), parts)]
+    return [profile.scaled(1 / parts)] * parts
+
+
+def merge_snapshots(snapshots: list) -> dict:
+    ''' Merge snapshots of several HttpRequestClient into one snapshot. '''
+    merged = dict(snapshots[0])
+    for key in ("rate", "concurrency", "in_flight", "waiting"):
+        merged[key] = sum(snapshot[key] for snapshot in snapshots)
+    merged["max_send_delay"] = max(snapshot["max_send_delay"] for snapshot in snapshots)
+    if merged["profile"] and "replayed" in merged["profile"]:
+        # every client replays a shard of the trace
+        merged["profile"] = dict(merged["profile"])
+        merged["profile"]["replayed"] = sum(snapshot["profile"]["replayed"] for snapshot in snapshots)
+        merged["profile"]["complete"] = all(snapshot["profile"]["complete"] for snapshot in snapshots)
+    merged["first_seen"] = {}
+    for snapshot in snapshots:
+        for pod, seen in snapshot["first_seen"].items():
+            merged["first_seen"][pod] = min(seen, merged["first_seen"].get(pod, seen))
+    merged["total"] = TrafficStats(merged["total"].begin)
+    intervals = {}
+    for snapshot in snapshots:
+        merged["total"].merge(snapshot["total"])
+        # intervals are aligned to wall clock, so the same interval of each client has the same begin
+        for interval in snapshot["intervals"]:
+            if interval.begin not in intervals:
+                intervals[interval.begin] = TrafficStats(interval.begin)
+            intervals[interval.begin].merge(interval, gauges=True)
+    merged["intervals"] = [intervals[begin] for begin in sorted(intervals)]
+    return merged
+
+
+def snapshot_to_raw(snapshot: dict, intervals: int) -> dict:
+    ''' JSON serializable form of a snapshot with its last intervals, which can be merged exactly. '''
+    raw = dict(snapshot)
+    raw["total"] = snapshot["total"].to_raw()
+    raw["intervals"] = [interval.to_raw() for interval in snapshot["intervals"][-intervals:]] if intervals > 0 else []
+    return raw
+
+
+def snapshot_from_raw(raw: dict) -> dict:
+    snapshot = dict(raw)
+    snapshot["total"] = TrafficStats.from_raw(raw["total"])
+    snapshot["intervals"] = [TrafficStats.from_raw(interval) for interval in raw["intervals"]]
+    return snapshot
+
+
+def render_status(snapshot: dict) -> dict:
+    ''' Status view of a snapshot, the response of GET /start. '''
+    status = {key: value for key, value in snapshot.items() if key not in ("total", "intervals")}
+    total = snapshot["total"]
+    status.update(total.to_dict(time.time() - total.begin))
+    return status
+
+
+def render_interval(interval: TrafficStats) -> dict:
+    record = interval.to_dict(HttpRequestClient.TIMER_INTERVAL)
+    record["begin"] = interval.begin
+    return record
+
+
+def render_stats(snapshot: dict, intervals: int) -> dict:
+    ''' Stats view of a snapshot with the last intervals stats, the response of GET /stats. '''
+    stats = render_status(snapshot)
+    stats["interval_length"] = HttpRequestClient.TIMER_INTERVAL
+    stats["intervals"] = []
+    for interval in snapshot["intervals"][-intervals:] if intervals > 0 else []:
+        stats["intervals"].append(render_interval(interval))
+    return stats
+
+
+def render_sample(name: str, labels: dict, value) -> str:
+    if not labels:
+        return "{} {}".format(name, value)
+    pairs = ['{}="{}"'.format(key, str(label).replace("\\", "\\\\").replace('"', '\\"'))
+             for key, label in labels.items()]
+    return "{}{{{}}} {}".format(name, ",".join(pairs), value)
+
+
+def render_family(name: str, kind: str, description: str, samples: list) -> list:
+    ''' Lines of one metric family, samples is a list of (labels, value). '''
+    lines = ["# HELP {} {}".format(name, description), "# TYPE {} {}".format(name, kind)]
+    return lines + [render_sample(name, labels, value) for labels, value in samples]
+
+
+def render_histogram(name: str, description: str, histograms: list) -> list:
+    ''' Lines of one histogram family, histograms is a list of (labels, LatencyHistogram). '''
+    lines = ["# HELP {} {}".format(name, description), "# TYPE {} histogram".format(name)]
+    for labels, histogram in histograms:
+        for bound, count in zip(METRICS_BUCKETS, histogram.cumulative_counts(METRICS_BUCKETS)):
+            lines.append(render_sample(name + "_bucket", dict(labels, le=bound), count))
+        lines.append(render_sample(name + "_bucket", dict(labels, le="+Inf"), histogram.count))
+        lines.append(render_sample(name + "_sum", labels, histogram.sum))
+        lines.append(render_sample(name + "_count", labels, histogram.count))
+    return lines
+
+
+def render_metrics(generators: list) -> str:
+    '''
+    Prometheus text exposition of the traffic stats, the response of GET /metrics.
+
+    :param generators: list of (generator id, stats of all traffic generated by it, snapshot of the
+        running client for the gauges or None if it is stopped)
+    '''
+    lines = []
+    for key, description in (("scheduled", "Requests which reached their intended send time."),
+                             ("sent", "Requests sent."),
+                             ("dropped", "Requests dropped by overload policy."),
+                             ("late", "Requests sent later than the late threshold."),
+                             ("completed", "Requests completed successfully.")):
+        lines += render_family("http_client_requests_{}_total".format(key), "counter", description,
+                               [({"generator": generator}, getattr(total, key)) for generator, total, _ in generators])
+    lines += render_family("http_client_request_errors_total", "counter", "Failed requests by error type.",
+                           [({"generator": generator, "type": error_type}, count)
+                            for generator, total, _ in generators
+                            for error_type, count in sorted(total.error_types.items())])
+    lines += render_family("http_client_connections_opened_total", "counter", "Connections opened to server.",
+                           [({"generator": generator}, total.connections_opened) for generator, total, _ in generators])
+    lines += render_family("http_client_connections_rotated_total", "counter",
+                           "Connections closed by rotation policy by reason.",
+                           [({"generator": generator, "reason": reason}, count)
+                            for generator, total, _ in generators
+                            for reason, count in sorted(total.rotations.items())])
+    lines += render_family("http_client_server_cpu_seconds_total", "counter", "Cpu load duration reported by server.",
+                           [({"generator": generator}, total.cpu_load_duration) for generator, total, _ in generators])
+    lines += render_family("http_client_server_thread_cpu_seconds_total", "counter",
+                           "Cpu time of server threads reported by server.",
+                           [({"generator": generator}, total.server_cpu_seconds) for generator, total, _ in generators])
+    lines += render_family("http_client_server_throttled_seconds_total", "counter",
+                           "Time server pods were throttled by their cpu limit while handling requests.",
+                           [({"generator": generator}, total.server_throttled_seconds)
+                            for generator, total, _ in generators])
+    lines += render_family("http_client_requested_cpu_seconds_total", "counter", "Cpu time requested by cpu_ms.",
+                           [({"generator": generator}, total.requested_cpu_seconds)
+                            for generator, total, _ in generators])
+    lines += render_family("http_client_received_bytes_total", "counter", "Response body bytes received.",
+                           [({"generator": generator}, total.received_bytes) for generator, total, _ in generators])
+    lines += render_family("http_client_backend_requests_total", "counter", "Requests completed by each server pod.",
+                           [({"generator": generator, "pod": name}, backend.completed)
+                            for generator, total, _ in generators
+                            for name, backend in sorted(total.backends.items())])
+    lines += render_family("http_client_backend_cpu_seconds_total", "counter",
+                           "Cpu load duration reported by each server pod.",
+                           [({"generator": generator, "pod": name}, backend.cpu_load_duration)
+                            for generator, total, _ in generators
+                            for name, backend in sorted(total.backends.items())])
+    lines += render_family("http_client_backend_thread_cpu_seconds_total", "counter",
+                           "Cpu time of server threads reported by each server pod.",
+                           [({"generator": generator, "pod": name}, backend.server_cpu_seconds)
+                            for generator, total, _ in generators
+                            for name, backend in sorted(total.backends.items())])
+    lines += render_family("http_client_backend_throttled_seconds_total", "counter",
+                           "Time each server pod was throttled by its cpu limit while handling requests.",
+                           [({"generator": generator, "pod": name}, backend.server_throttled_seconds)
+                            for generator, total, _ in generators
+                            for name, backend in sorted(total.backends.items())])
+    lines += render_family("http_client_backend_received_bytes_total", "counter",
+                           "Response body bytes received from each server pod.",
+                           [({"generator": generator, "pod": name}, backend.received_bytes)
+                            for generator, total, _ in generators
+                            for name, backend in sorted(total.backends.items())])
+    lines += render_family("http_client_workload_requests_total", "counter",
+                           "Requests completed by each workload of the mix.",
+                           [({"generator": generator, "workload": name}, workload.completed)
+                            for generator, total, _ in generators
+                            for name, workload in sorted(total.workloads.items())])
+    lines += render_family("http_client_workload_resource_total", "counter",
+                           "Resources consumed by each workload of the mix as reported by server.",
+                           [({"generator": generator, "workload": name, "resource": resource}, value)
+                            for generator, total, _ in generators
+                            for name, workload in sorted(total.workloads.items())
+                            for resource, value in sorted(workload.resources.items())
+                            if not resource.startswith("max_")])
+    lines += render_family("http_client_workload_resource_peak", "gauge",
+                           "Peak resources of the server reported by each workload of the mix.",
+                           [({"generator": generator, "workload": name, "resource": resource[len("max_"):]}, value)
+                            for generator, total, _ in generators
+                            for name, workload in sorted(total.workloads.items())
+                            for resource, value in sorted(workload.resources.items())
+                            if resource.startswith("max_")])
+    lines += render_histogram("http_client_request_latency_seconds", "Latency from intended send time to response.",
+                              [({"generator": generator}, total.latency) for generator, total, _ in generators])
+    lines += render_histogram("http_client_request_service_time_seconds", "Latency from actual send time to response.",
+                              [({"generator": generator}, total.service_time) for generator, total, _ in generators])
+    running = [(generator, snapshot) for generator, _, snapshot in generators if snapshot is not None]
+    lines += render_family("http_client_requests_in_flight", "gauge", "Requests waiting for response.",
+                           [({"generator": generator}, snapshot["in_flight"]) for generator, snapshot in running])
+    lines += render_family("http_client_planned_rate", "gauge", "Planned request rate in reqs/min.",
+                           [({"generator": generator}, snapshot["rate"]) for generator, snapshot in running])
+    return "\n".join(lines) + "\n"
+
+
+def stream_records(get_client, sse: bool):
+    '''
+    Generate one record per closed interval of the client until the client is stopped, as
+    newline delimited json or server sent events.
+
+    :param get_client: function returning the current client, the stream ends when it changes
+    :param sse: generate server sent events instead of newline delimited json
+    '''
+    client = get_client()
+    last_begin = None
+    while client is not None and client is get_client():
+        # wait until the current interval is closed by the client
+        time.sleep(HttpRequestClient.TIMER_INTERVAL - time.time() % HttpRequestClient.TIMER_INTERVAL
+                   + STREAM_DELAY)
+        try:
+            snapshot = client.snapshot(STREAM_INTERVALS)
+        except PeerError as e:
+            print("stream stats fail, err: {}".format(e))
+            return
+        for interval in snapshot["intervals"]:
+            if last_begin is not None and interval.begin <= last_begin:
+                continue
+            if last_begin is None and interval is not snapshot["intervals"][-1]:
+                # a new subscriber begins from the last closed interval
+                continue
+            last_begin = interval.begin
+            record = render_interval(interval)
+            record["rate"] = snapshot["rate"]
+            record["profile"] = snapshot["profile"]
+            line = json.dumps(record)
+            yield "data: {}\n\n".format(line) if sse else line + "\n"
+
+
+def shard_worker(conn, url: str, profile: RateProfile, concurrency: int, arrival: str, begin: float,
+                 rotation: RotationPolicy, overload: OverloadPolicy, workloads: WorkloadMix, request_timeout: float):
+    '''
+    Entry of one shard worker process. It runs one HttpRequestClient and serves the
+    commands sent by ShardedHttpRequestClient through the pipe.
+    '''
+    client = HttpRequestClient(url=url, concurrency=concurrency, arrival=arrival, profile=profile, begin=begin,
+                               rotation=rotation, overload=overload, workloads=workloads,
+                               request_timeout=request_timeout)
+    client.start()
+    while True:
+        cmd, arg = conn.recv()
+        if cmd == "snapshot":
+            conn.send(client.snapshot(arg))
+        elif cmd == "profile":
+            client.change_profile(*arg)
+            conn.send(None)
+        elif cmd == "stop":
+            client.stop()
+            client.join()
+            conn.send(None)
+            break
+
+
+class ShardedHttpRequestClient:
+    """
+    Generate http traffic from several worker processes, so the client pod is not limited by the GIL
+    of one python process. Target rate and concurrency are split across workers, and status of all
+    workers is merged into one view.
+    """
+
+    # time given to worker processes to start, so that all of them begin the schedule together
+    START_DELAY = 0.5
+
+    def __init__(self, url: str, rate: int = 0, concurrency: int = HttpRequestClient.DEFAULT_CONCURRENCY,
+                 arrival: str = ArrivalSchedule.CONSTANT, profile: RateProfile = None, begin: float = None,
+                 workers: int = 0, rotation: RotationPolicy = None, overload: OverloadPolicy = None,
+                 workloads: WorkloadMix = None, request_timeout: float = HttpRequestClient.DEFAULT_REQUEST_TIMEOUT):
+        self.url = url
+        self.request_timeout = request_timeout
+        self.profile = profile if profile else RateProfile.constant(rate)
+        self.concurrency = concurrency
+        self.arrival = arrival
+        self.begin = begin
+        self.rotation = rotation
+        self.overload = overload
+        self.workloads = workloads
+        self.workers = workers if workers > 0 else available_cpus()
+        self.lock = Lock()
+        self.conns = []
+        self.processes = []
+
+    def start(self):
+        profiles = split_profile(self.profile, self.workers)
+        concurrency = max(1, self.concurrency // self.workers)
+        begin = self.begin if self.begin is not None else time.time() + self.START_DELAY
+        for i in range(self.workers):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=shard_worker, daemon=True,
+                                              args=(child_conn, self.url, profiles[i], concurrency,
+                                                    self.arrival, begin, self.rotation, self.overload,
+                                                    self.workloads, self.request_timeout))
+            process.start()
+            self.conns.append(parent_conn)
+            self.processes.append(process)
+        print("start {} http traffic worker processes.".format(self.workers))
+
+    def _call(self, cmd, args):
+        ''' Send one command to every worker and collect their replies. '''
+        with self.lock:
+            for conn, arg in zip(self.conns, args):
+                conn.send((cmd, arg))
+            return [conn.recv() for conn in self.conns]
+
+    def change_profile(self, profile: RateProfile, begin: float = None):
+        # all workers begin the new profile together
+        begin = begin if begin is not None else time.time()
+        self._call("profile", [(part, begin) for part in split_profile(profile, self.workers)])
+        self.profile = profile
+
+    def change_http_rate(self, rate):
+        self.change_profile(RateProfile.constant(rate))
+
+    def snapshot(self, intervals: int = HttpRequestClient.INTERVAL_HISTORY):
+        merged = merge_snapshots(self._call("snapshot", [intervals] * self.workers))
+        merged["workers"] = self.workers
+        return merged
+
+    def status(self):
+        return render_status(self.snapshot(0))
+
+    def stats(self, intervals: int = HttpRequestClient.INTERVAL_HISTORY):
+        return render_stats(self.snapshot(intervals), intervals)
+
+    def stop(self):
+        self._call("stop", [None] * self.workers)
+        for process in self.processes:
+            process.join()
+
+
+class CoordinatedHttpRequestClient:
+    """
+    Coordinate http traffic generated by several client pods. The rate or profile is split across
+    the peer pods through their /start api, all peers begin their schedule at the same wall clock
+    time, and their stats are merged exactly into one view. Clocks of the nodes are expected to be
+    synchronized, by NTP for example.
+    """
+
+    # time given to all peers to receive the start request before the schedule begins
+    START_DELAY = 2
+    PEER_PORT = 8080
+    PEER_TIMEOUT = 10
+
+    def __init__(self, url: str, peers: list, profile: RateProfile, options: dict):
+        """
+        :param url: target url
+        :param peers: address of every peer pod, ip or ip:port
+        :param profile: request rate over time of all peers together
+        :param options: other /start fields sent to every peer as is, id, concurrency, arrival, workers,
+            rotation, overload and workloads
+        """
+        if not peers:
+            raise PeerError("no peer http client pod is found.")
+        self.url = url
+        self.peers = [peer if ":" in peer else "{}:{}".format(peer, self.PEER_PORT) for peer in peers]
+        self.profile = profile
+        self.options = options
+        self.session = requests.Session()
+
+    @classmethod
+    def discover_peers(cls, service: str) -> list:
+        ''' Ip of every ready pod selected by a headless service, which has one A record per pod. '''
+        try:
+            infos = socket.getaddrinfo(service, cls.PEER_PORT, proto=socket.IPPROTO_TCP)
+        except socket.gaierror as e:
+            raise PeerError("resolve peer service {} fail, err: {}".format(service, e))
+        return sorted({info[4][0] for info in infos})
+
+    def _request(self, method: str, peer: str, path: str, payload: dict):
+        resp = self.session.request(method, "http://" + peer + path, json=payload, timeout=self.PEER_TIMEOUT)
+        if 200 != resp.status_code:
+            raise PeerError("{} {} on peer {} fail, err: {}".format(method, path, peer, resp.text))
+        return resp
+
+    def _request_all(self, method: str, path: str, payloads: list) -> list:
+        ''' Send one request to every peer concurrently and return their responses. '''
+        with ThreadPoolExecutor(max_workers=len(self.peers)) as pool:
+            futures = [pool.submit(self._request, method, peer, path, payload)
+                       for peer, payload in zip(self.peers, payloads)]
+            try:
+                return [future.result() for future in futures]
+            except requests.RequestException as e:
+                raise PeerError("{} {} on peers fail, err: {}".format(method, path, e))
+
+    def _start_payloads(self, profile: RateProfile, begin: float) -> list:
+        payloads = []
+        for part in split_profile(profile, len(self.peers)):
+            payload = dict(self.options, target_url=self.url, start_at=begin)
+            payload.update(part.to_request())
+            payloads.append(payload)
+        return payloads
+
+    def start(self):
+        begin = time.time() + self.START_DELAY
+        self._request_all("POST", "/start", self._start_payloads(self.profile, begin))
+        print("start http traffic on {} peers: {}".format(len(self.peers), self.peers))
+
+    def change_profile(self, profile: RateProfile, begin: float = None):
+        begin = begin if begin is not None else time.time() + self.START_DELAY
+        self._request_all("POST", "/start", self._start_payloads(profile, begin))
+        self.profile = profile
+
+    def change_http_rate(self, rate):
+        self.change_profile(RateProfile.constant(rate))
+
+    def snapshot(self, intervals: int = HttpRequestClient.INTERVAL_HISTORY):
+        # the generator of every peer has the same id, default is the target url
+        path = "/stats?" + urlencode({"raw": 1, "intervals": intervals, "id": self.options.get("id") or self.url})
+        resps = self._request_all("GET", path, [None] * len(self.peers))
+        merged = merge_snapshots([snapshot_from_raw(resp.json()) for resp in resps])
+        merged["workers"] = sum(resp.json().get("workers", 1) for resp in resps)
+        merged["peers"] = self.peers
+        return merged
+
+    def status(self):
+        return render_status(self.snapshot(0))
+
+    def stats(self, intervals: int = HttpRequestClient.INTERVAL_HISTORY):
+        return render_stats(self.snapshot(intervals), intervals)
+
+    def stop(self):
+        payload = {"id": self.options.get("id") or self.url, "target_url": self.url}
+        self._request_all("POST", "/stop", [payload] * len(self.peers))
+        self.session.close()
+
+def create_client(data: dict, profile: RateProfile):
+    '''
+    Create the client for the options of a POST /start request body, the client is not started.
+    '''
+    concurrency = int(data.get("concurrency", HttpRequestClient.DEFAULT_CONCURRENCY))
+    arrival = data.get("arrival", ArrivalSchedule.CONSTANT)
+    if arrival not in (ArrivalSchedule.CONSTANT, ArrivalSchedule.POISSON):
+        raise ValueError("unsupported arrival process: {}".format(arrival))
+    workers = int(data.get("workers", 1))
+    rotation = RotationPolicy.from_request(data)
+    overload = OverloadPolicy.from_request(data)
+    workloads = WorkloadMix.from_request(data)
+    request_timeout = float(data.get("request_timeout", HttpRequestClient.DEFAULT_REQUEST_TIMEOUT))
+    if request_timeout <= 0:
+        raise ValueError("request_timeout must be positive: {}".format(request_timeout))
+    if workers == 1:
+        return HttpRequestClient(url = data["target_url"], concurrency = concurrency, arrival = arrival,
+                                 profile = profile, begin = data.get("start_at"), rotation = rotation,
+                                 overload = overload, workloads = workloads, request_timeout = request_timeout)
+    return ShardedHttpRequestClient(url = data["target_url"], concurrency = concurrency,
+                                    arrival = arrival, profile = profile, begin = data.get("start_at"),
+                                    workers = workers, rotation = rotation, overload = overload,
+                                    workloads = workloads, request_timeout = request_timeout)
+
+
+class Calibration(Thread):
+    """
+    Measure the max rate this pod sustains against a target. The rate is increased step by step,
+    every step runs at constant rate, and passes if the sent and achieved rate keep up with the
+    planned rate, errors stay within the tolerance and p99 latency is below max_latency. The ramp
+    stops at the first failed step, the ceiling is the rate of the last passed step. stop ends the
+    ramp at once, the step cut short is not counted.
+    """
 
-clientThread = None
+    DEFAULT_START_RATE = 600
+    DEFAULT_MAX_RATE = 600000
+    DEFAULT_STEP_FACTOR = 1.5
+    DEFAULT_STEP_DURATION = 10
+    DEFAULT_MAX_LATENCY = 1.0
+    DEFAULT_TOLERANCE = 0.05
+    # first seconds of a step are not measured, so the backlog of the previous step is not counted
+    WARMUP = 2
+
+    def __init__(self, data: dict):
+        """
+        :param data: body of POST /calibrate, options of POST /start are used to create the client
+        """
+        super().__init__(daemon=True)
+        self.data = data
+        self.url = data["target_url"]
+        self.start_rate = float(data.get("start_rate", self.DEFAULT_START_RATE))
+        self.max_rate = float(data.get("max_rate", self.DEFAULT_MAX_RATE))
+        self.step_factor = float(data.get("step_factor", self.DEFAULT_STEP_FACTOR))
+        self.step_duration = int(data.get("step_duration", self.DEFAULT_STEP_DURATION))
+        self.max_latency = float(data.get("max_latency", self.DEFAULT_MAX_LATENCY))
+        self.tolerance = float(data.get("tolerance", self.DEFAULT_TOLERANCE))
+        if self.start_rate <= 0 or self.step_factor <= 1 or self.step_duration <= self.WARMUP:
+            raise ValueError("start_rate must be positive, step_factor above 1 and step_duration above {}".format(
+                self.WARMUP))
+        self.client = create_client(data, RateProfile.constant(self.start_rate))
+        self.stopped = Event()
+        self.steps = []
+        self.ceiling = None
+        self.complete = False
+
+    def run(self):
+        self.client.start()
+        try:
+            rate = self.start_rate
+            while not self.stopped.is_set() and rate <= self.max_rate:
+                step = self._run_step(rate)
+                if step is None:
+                    break
+                self.steps.append(step)
+                print("calibration step: {}".format(step))
+                if not step["passed"]:
+                    break
+                self.ceiling = rate
+                rate = rate * self.step_factor
+        finally:
+            self.client.stop()
+            self.complete = True
+        print("calibration {}, max sustainable rate: {}".format(
+            "stopped" if self.stopped.is_set() else "complete", self.ceiling))
+
+    def _run_step(self, rate: float) -> dict:
+        ''' Run one step at rate, return its result, or None if the calibration is stopped during the step. '''
+        begin = time.time()
+        self.client.change_profile(RateProfile.constant(rate), begin)
+        end = begin + self.step_duration
+        # wait until the last interval of the step is closed
+        if self.stopped.wait(end - time.time() + STREAM_DELAY):
+            return None
+        measured = TrafficStats(begin)
+        backlog = 0
+        count = 0
+        for interval in self.client.snapshot(self.step_duration + 1)["intervals"]:
+            if interval.begin >= begin + self.WARMUP and interval.begin + HttpRequestClient.TIMER_INTERVAL <= end:
+                measured.merge(interval)
+                backlog = interval.backlog or 0
+                count += 1
+        stats = measured.to_dict(count * HttpRequestClient.TIMER_INTERVAL)
+        floor = rate * (1 - self.tolerance)
+        p99 = stats["latency"]["p99"]
+        passed = (count > 0 and stats["send_rate"] >= floor and stats["achieved_rate"] >= floor
+                  and measured.errors <= self.tolerance * max(measured.sent, 1)
+                  and p99 is not None and p99 <= self.max_latency)
+        return {
+            "rate": rate,
+            "send_rate": stats["send_rate"],
+            "achieved_rate": stats["achieved_rate"],
+            "errors": measured.errors,
+            "p99": p99,
+            "backlog": backlog,
+            "passed": passed
+        }
+
+    def status(self) -> dict:
+        return {
+            "target_url": self.url,
+            "complete": self.complete,
+            "stopped": self.stopped.is_set(),
+            "max_sustainable_rate": self.ceiling,
+            "cpus": available_cpus(),
+            "workers": int(self.data.get("workers", 1)),
+            "steps": list(self.steps)
+        }
+
+    def stop(self):
+        self.stopped.set()
+
+
+# delay after the end of an interval before it is streamed, so all clients have closed it
+STREAM_DELAY = 0.2
+# number of last intervals read for every streamed interval, so no interval is missed when late
+STREAM_INTERVALS = 5
+
+# directory of uploaded trace files
+TRACE_DIR = os.environ.get("TRACE_DIR", "/tmp/traces")
+# bytes of an uploaded trace written at a time, so traces larger than memory can be uploaded
+TRACE_CHUNK = 1 << 16
+
+# latency bucket bounds of exported histograms, unit is second
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# running clients and coordinators by generator id
+clients = {}
+coordinators = {}
+# serializes creating and removing generators
+generators_lock = Lock()
+calibration = None
+# stats of stopped clients by generator id, so exported counters never go backwards while the process runs
+retired_stats = {}
 app = Flask(__name__)
 
+def generator_id(data: dict) -> str:
+    ''' Id of the generator a request body is for, default is its target url. '''
+    return data.get("id") or data.get("target_url")
+
+def load_profile(data: dict):
+    ''' TraceProfile of the trace field of a request body, or RateProfile of its rate or profile fields. '''
+    if data.get("trace") is not None:
+        return TraceProfile.from_request(data)
+    return RateProfile.from_request(data)
+
+def find_generator(generators: dict):
+    '''
+    Find the generator of the id query parameter. Without id the only generator is used, so clients
+    written for one generator per pod keep working.
+    :return: (generator id, generator), generator is None if it is not found
+    '''
+    generator = request.args.get("id")
+    if generator is None and len(generators) == 1:
+        generator = next(iter(generators))
+    return generator, generators.get(generator)
+
 @app.route('/', methods=['GET'])
 def index():
     ''' For readiness or liveness probe '''
@@ -77,57 +2247,456 @@ def index():
 def start():
     """
     Start generate load to http server deployment or query current status.
-    For POST method, request body is json like below:
+    Several generators can run at once, each one has its own rate, profile and stats, and is identified
+    by the id field, default is the target url.
+    For POST method, request body is json like below, rate unit is reqs/min. One of rate, profile
+    or trace must be given, profile is a list of segments executed by the client on its own
+    clock, see RateProfile for the segment shapes, trace replays a recorded trace file uploaded by
+    PUT /traces/<name>, see TraceProfile. The query of target_url is kept, count is added to it unless
+    it has count or cpu_ms, the load of a request in calibrated cpu milliseconds of the server.
+    Optional fields: concurrency limits the number of requests in flight, arrival is the arrival
+    process of requests, constant(default) or poisson, workers is the number of processes generating
+    traffic, 0 means one process per available cpu of the pod, rotation is the policy to replace keep-alive connections so the load
+    spreads onto new server pods, see RotationPolicy, overload is the policy of sends due while all
+    connections are busy, see OverloadPolicy, workloads is a weighted mix of server workloads run
+    by the requests instead of the path of target_url, see WorkloadMix, request_timeout is the seconds
+    after which a request is abandoned, its connection closed and the request counted as a timeout error:
     {
+        "id": "server-a",
         "target_url": "http://" + http_server_svc_ip,
-        "rate": rate
+        "rate": rate,
+        "profile": {
+            "segments": [{"shape": "ramp", "duration": 60, "from": 600, "to": 6000}, ..],
+            "loop": false
+        },
+        "trace": {"path": "/tmp/traces/trace.csv", "speed": 1.0, "loop": false},
+        "concurrency": concurrency,
+        "arrival": "constant",
+        "workers": workers,
+        "request_timeout": 30,
+        "start_at": wall clock time at which the schedule begins, default is now,
+        "rotation": {"max_requests": 1000, "max_age": 30, "endpoints_service": "server-headless"},
+        "overload": {"policy": "queue", "max_backlog": 1000, "late_threshold": 0.05},
+        "workloads": [{"workload": "cpu", "params": {"count": 100000}, "weight": 3},
+                      {"workload": "memory", "params": {"mib": 64, "seconds": 1}, "weight": 1}]
     }
-    For GET method, response body is json like below:
+    A POST with the id of a running generator replaces its rate or profile.
+    For GET method, query parameter id selects the generator, it can be omitted if only one generator
+    is running, response body is json like below:
     {
+        "id": generator id,
         "target_url": "http://" + http_server_svc_ip,
-        "rate": rate
+        "rate": current planned rate,
+        "profile": {
+            "complete": false, "segment": active segment index, "segments": segment count,
+            "shape": active segment shape, "segment_elapsed": .., "elapsed": .., "cycle": loop count
+        },
+        or for a trace {"trace": path, "speed": .., "complete": .., "cycle": .., "replayed": replayed entries,
+                        "invalid": skipped lines, "elapsed": ..},
+        "arrival": "constant",
+        "concurrency": concurrency,
+        "in_flight": current in flight request count,
+        "waiting": request count waiting for a free connection,
+        "max_send_delay": max delay between intended and actual send time,
+        "rotation": rotation policy, null if connections are not rotated,
+        "overload": overload policy,
+        "workloads": workload mix, null if requests go to target_url,
+        "endpoints": server pod count resolved from rotation endpoints_service, null if not resolved,
+        "first_seen": {server pod name: wall clock time of its first response, ..},
+        "scheduled": request count which reached its intended send time,
+        "sent": sent request count,
+        "dropped": request count dropped by overload policy,
+        "late": sent request count which were late by more than late_threshold,
+        "completed": completed request count,
+        "errors": failed request count,
+        "error_types": {"http_503": count, "timeout": count, "ConnectionResetError": count, ..},
+        "cpu_load_duration": total cpu load duration reported by server,
+        "server_cpu_seconds": total cpu time of server threads,
+        "server_throttled_seconds": total time server pods were throttled by their cpu limit while handling requests,
+        "requested_cpu_seconds": total cpu time requested by cpu_ms,
+        "received_bytes": total response body bytes,
+        "connections_opened": opened connection count,
+        "rotations": {"max_requests": count, "max_age": count, "endpoints": count},
+        "backends": {
+            server pod name: {"completed": .., "errors": .., "cpu_load_duration": .., "server_cpu_seconds": ..,
+                              "server_throttled_seconds": .., "throttled_share": .., "received_bytes": ..,
+                              "throughput": received bytes/s, "latency": {..}}, ..
+        },
+        "workloads": {
+            workload name: {"completed": .., "errors": .., "cpu_load_duration": .., "latency": {..},
+                            "resources": {"memory_bytes": .., "bytes_read": .., ..}}, ..
+        },
+        "throttled_share": server_throttled_seconds / cpu_load_duration,
+        "throughput": average received bytes/s,
+        "send_rate": average sent reqs/min,
+        "achieved_rate": average completed reqs/min,
+        "latency": {"count": .., "min": .., "max": .., "mean": .., "p50": .., "p90": .., "p99": .., "p999": ..},
+        "service_time": {"count": .., "min": .., "max": .., "mean": .., "p50": .., "p90": .., "p99": .., "p999": ..},
+        "workers": worker process count, only present in multi-process mode,
+        "max_sustainable_rate": max rate measured by the last calibration, only present when calibrated
     }
+    latency is measured from the intended send time and service_time from the actual
+    send time of each request, unit is second.
     :return: response object
     :rtype: str
     """
-    global clientThread
     if request.method == "POST":
         data = request.get_json()
-        if not clientThread:
-            print("start http traffic: url: {}, rate: {}".format(data["target_url"], data["rate"]))
-            clientThread = HttpRequestClient(url = data["target_url"], rate = int(data["rate"]))
-            clientThread.start()
-            return make_response(("create http traffic client success.", 200))
+        try:
+            profile = load_profile(data)
+        except (KeyError, TypeError, ValueError) as e:
+            print("invalid rate, profile or trace: {}".format(e))
+            return make_response(("invalid rate, profile or trace: {}".format(e), 400))
+        if calibration and calibration.is_alive():
+            return make_response(("calibration is running, please wait until it completes.", 400))
+        generator = generator_id(data)
+        with generators_lock:
+            client = clients.get(generator)
+            if not client:
+                print("start http traffic {}: url: {}, rate: {}, profile: {}".format(
+                    generator, data["target_url"], data.get("rate"), data.get("profile")))
+                try:
+                    client = create_client(data, profile)
+                except ValueError as e:
+                    return make_response((str(e), 400))
+                client.start()
+                clients[generator] = client
+                return make_response(("create http traffic client success.", 200))
+        if data["target_url"] == client.url:
+            print("change http traffic {} rate: {}, profile: {}".format(
+                generator, data.get("rate"), data.get("profile")))
+            client.change_profile(profile, data.get("start_at"))
+            return make_response(("change http traffic client rate success.", 200))
         else:
-            if data["target_url"] == clientThread.url:
-                print("change http traffic rate: {}".format(data["rate"]))
-                clientThread.change_http_rate(int(data["rate"]))
-                return make_response(("change http traffic client rate success.", 200))
-            else:
-                print("target url are different from original one.")
-                return make_response(("target url are different from original one.", 400))
+            print("target url are different from original one.")
+            return make_response(("target url are different from original one.", 400))
     else:
-        if clientThread:
-            data = {
-                "target_url": clientThread.url,
-                "rate": clientThread.rate
-            }
-            return make_response(data)
+        generator, client = find_generator(clients)
+        if client:
+            status = client.status()
+            status["id"] = generator
+            if calibration and calibration.ceiling is not None:
+                status["max_sustainable_rate"] = calibration.ceiling
+            return make_response(status)
         else:
             return make_response(("please start http traffic client first.", 400))
 
+@app.route('/generators', methods=['GET'])
+def generators():
+    """
+    Query status of all running generators, response body is json like below, each status is like
+    the response of GET /start:
+    {generator id: status, ..}
+    :return: response object
+    :rtype: str
+    """
+    return make_response({generator: client.status() for generator, client in list(clients.items())})
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """
+    Query traffic stats of a generator. The response body is the status returned by GET /start, plus
+    the stats of the last intervals, each of which is TIMER_INTERVAL seconds long:
+    {
+        ...,
+        "interval_length": 1,
+        "intervals": [
+            {
+                "begin": wall clock time of interval begin,
+                "scheduled": .., "sent": .., "dropped": .., "late": .., "completed": .., "errors": ..,
+                "error_types": {..},
+                "cpu_load_duration": .., "connections_opened": .., "rotations": {..}, "backends": {..},
+                "send_rate": .., "achieved_rate": ..,
+                "latency": {..}, "service_time": {..}
+            }
+        ]
+    }
+    The query parameter id selects the generator like in GET /start. The optional query parameter
+    intervals limits the number of returned intervals, default is all intervals kept in memory. With
+    query parameter raw=1 the response is the raw snapshot used by the coordinator to merge stats of
+    several pods exactly.
+    :return: response object
+    :rtype: str
+    """
+    generator, client = find_generator(clients)
+    if not client:
+        return make_response(("please start http traffic client first.", 400))
+    intervals = request.args.get("intervals", default=HttpRequestClient.INTERVAL_HISTORY, type=int)
+    if request.args.get("raw", default=0, type=int):
+        return make_response(snapshot_to_raw(client.snapshot(intervals), intervals))
+    result = client.stats(intervals)
+    result["id"] = generator
+    return make_response(result)
+
+def stream_response(get_client):
+    sse = request.args.get("format") == "sse" or "text/event-stream" in request.headers.get("Accept", "")
+    mimetype = "text/event-stream" if sse else "application/x-ndjson"
+    return Response(stream_records(get_client, sse), mimetype=mimetype, headers={"Cache-Control": "no-cache"})
+
+@app.route('/stream', methods=['GET'])
+def stream():
+    """
+    Stream stats of every closed interval of a generator over one long-lived connection until it
+    is stopped. Every record is the interval stats like in GET /stats, plus the planned rate
+    and profile status, and the in flight and backlog request count at the end of the interval:
+    {"begin": .., "sent": .., "achieved_rate": .., "errors": .., "latency": {..}, "backlog": .., "rate": .., ..}
+    Records are newline delimited json, or server sent events with query parameter format=sse
+    or header Accept: text/event-stream. The query parameter id selects the generator like in GET /start.
+    :return: response object
+    :rtype: str
+    """
+    generator, client = find_generator(clients)
+    if not client:
+        return make_response(("please start http traffic client first.", 400))
+    return stream_response(lambda: clients.get(generator))
+
 @app.route('/stop', methods=['POST'])
 def stop():
-    global clientThread
+    ''' Stop the generator of the id field of request body, default is the target url. '''
+    data = request.get_json()
+    generator = generator_id(data)
+    with generators_lock:
+        client = clients.get(generator)
+        if client:
+            if data["target_url"] == client.url:
+                print("stop http traffic {}.".format(generator))
+                if generator not in retired_stats:
+                    retired_stats[generator] = TrafficStats(time.time())
+                retired_stats[generator].merge(client.snapshot(0)["total"])
+                client.stop()
+                del clients[generator]
+                return make_response(("stop http traffic client success.", 200))
+            else:
+                print("target url are different from original one.")
+                return make_response(("target url are different from original one.", 400))
+
+    return make_response(("please start http traffic client first.", 400))
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Export the traffic stats of every generator of this pod in Prometheus text format, labelled by
+    generator id: request counters, errors by type, cpu load duration reported by server, latency and
+    service time histograms, in flight requests and planned rate. Counters include the traffic of
+    stopped clients.
+    Stats are recorded by the event loop of each client without lock, and only read when scraped.
+    :return: response object
+    :rtype: str
+    """
+    running = dict(clients)
+    series = []
+    for generator in sorted(set(running) | set(retired_stats)):
+        retired = retired_stats.get(generator)
+        total = TrafficStats(retired.begin if retired else time.time())
+        if retired:
+            total.merge(retired)
+        client = running.get(generator)
+        snapshot = client.snapshot(0) if client else None
+        if snapshot is not None:
+            total.merge(snapshot["total"])
+        series.append((generator, total, snapshot))
+    return Response(render_metrics(series), mimetype="text/plain; version=0.0.4")
+
+@app.route('/calibrate', methods=['GET', 'POST', 'DELETE'])
+def calibrate():
+    """
+    Measure the max rate this pod can sustain against a target, query the calibration result, or
+    cancel a running calibration with DELETE method, its passed steps are kept.
+    For POST method, request body is json like below, rates unit is reqs/min. All fields but target_url
+    are optional, concurrency, arrival and workers are used like in POST /start. The calibration runs
+    in background, the http traffic client must not be running:
+    {
+        "target_url": "http://" + http_server_svc_ip,
+        "start_rate": 600,
+        "max_rate": 600000,
+        "step_factor": 1.5,
+        "step_duration": 10,
+        "max_latency": 1.0,
+        "tolerance": 0.05
+    }
+    For GET method, response body is json like below:
+    {
+        "target_url": "http://" + http_server_svc_ip,
+        "complete": true,
+        "stopped": true if cancelled by DELETE method,
+        "max_sustainable_rate": rate of the last passed step, null if no step passed,
+        "cpus": available cpus of the pod,
+        "workers": worker process count used by the calibration,
+        "steps": [{"rate": .., "send_rate": .., "achieved_rate": .., "errors": .., "p99": .., "backlog": ..,
+                   "passed": true}, ..]
+    }
+    :return: response object
+    :rtype: str
+    """
+    global calibration
+    if request.method == "POST":
+        data = request.get_json()
+        if clients or (calibration and calibration.is_alive()):
+            return make_response(("http traffic client or calibration is running, please stop it first.", 400))
+        try:
+            calibration = Calibration(data)
+        except (KeyError, TypeError, ValueError) as e:
+            print("invalid calibration request: {}".format(e))
+            return make_response(("invalid calibration request: {}".format(e), 400))
+        print("start calibration: url: {}".format(data["target_url"]))
+        calibration.start()
+        return make_response(("start calibration success.", 200))
+    if request.method == "DELETE":
+        if not (calibration and calibration.is_alive()):
+            return make_response(("calibration is not running.", 400))
+        print("stop calibration: url: {}".format(calibration.url))
+        calibration.stop()
+        calibration.join()
+        return make_response(("stop calibration success.", 200))
+    if calibration:
+        return make_response(calibration.status())
+    return make_response(("please start calibration first.", 400))
+
+@app.route('/coordinator/start', methods=['GET', 'POST'])
+def coordinator_start():
+    """
+    Start generate load from several client pods, or query their merged status.
+    For POST method, request body is the same as POST /start plus the peers to coordinate, either
+    the list of peer pod ips, or a headless service selecting them, default is the service in
+    PEER_SERVICE environment variable. The rate or profile is split across the peers, other fields
+    are sent to every peer as is, so concurrency and workers are per peer. The generator id is used
+    on every peer, so one coordinator can run several generators like POST /start:
+    {
+        "id": "server-a",
+        "target_url": "http://" + http_server_svc_ip,
+        "rate": rate,
+        "peers": [pod_ip, ..],
+        "peer_service": "client-headless"
+    }
+    For GET method, query parameter id selects the generator like in GET /start, response body is
+    the merged status like GET /start plus the peers list.
+    :return: response object
+    :rtype: str
+    """
+    try:
+        if request.method == "POST":
+            data = request.get_json()
+            try:
+                profile = load_profile(data)
+            except (KeyError, TypeError, ValueError) as e:
+                print("invalid rate, profile or trace: {}".format(e))
+                return make_response(("invalid rate, profile or trace: {}".format(e), 400))
+            generator = generator_id(data)
+            # peers may include this pod, so the lock is not held while requesting them
+            with generators_lock:
+                coordinator = coordinators.get(generator)
+                created = coordinator is None
+                if created:
+                    peers = data.get("peers")
+                    if not peers:
+                        peers = CoordinatedHttpRequestClient.discover_peers(
+                            data.get("peer_service", os.environ.get("PEER_SERVICE", "")))
+                    options = {key: data[key] for key in ("id", "concurrency", "arrival", "workers", "rotation",
+                                                          "overload", "workloads", "request_timeout") if key in data}
+                    coordinator = CoordinatedHttpRequestClient(url = data["target_url"], peers = peers,
+                                                               profile = profile, options = options)
+                    coordinators[generator] = coordinator
+            if created:
+                try:
+                    coordinator.start()
+                except PeerError:
+                    coordinators.pop(generator, None)
+                    raise
+                return make_response(("create coordinated http traffic success.", 200))
+            if data["target_url"] == coordinator.url:
+                print("change coordinated http traffic {} rate: {}, profile: {}".format(
+                    generator, data.get("rate"), data.get("profile")))
+                coordinator.change_profile(profile, data.get("start_at"))
+                return make_response(("change coordinated http traffic rate success.", 200))
+            else:
+                print("target url are different from original one.")
+                return make_response(("target url are different from original one.", 400))
+        generator, coordinator = find_generator(coordinators)
+        if coordinator:
+            status = coordinator.status()
+            status["id"] = generator
+            return make_response(status)
+        return make_response(("please start coordinated http traffic first.", 400))
+    except PeerError as e:
+        print(str(e))
+        return make_response((str(e), 502))
+
+@app.route('/coordinator/stats', methods=['GET'])
+def coordinator_stats():
+    """
+    Query traffic stats merged from all peers, response body is like GET /stats.
+    :return: response object
+    :rtype: str
+    """
+    generator, coordinator = find_generator(coordinators)
+    if not coordinator:
+        return make_response(("please start coordinated http traffic first.", 400))
+    intervals = request.args.get("intervals", default=HttpRequestClient.INTERVAL_HISTORY, type=int)
+    try:
+        result = coordinator.stats(intervals)
+    except PeerError as e:
+        print(str(e))
+        return make_response((str(e), 502))
+    result["id"] = generator
+    return make_response(result)
+
+@app.route('/coordinator/stream', methods=['GET'])
+def coordinator_stream():
+    """
+    Stream stats merged from all peers, records are like GET /stream.
+    :return: response object
+    :rtype: str
+    """
+    generator, coordinator = find_generator(coordinators)
+    if not coordinator:
+        return make_response(("please start coordinated http traffic first.", 400))
+    return stream_response(lambda: coordinators.get(generator))
+
+@app.route('/coordinator/stop', methods=['POST'])
+def coordinator_stop():
+    ''' Stop the coordinated generator of the id field of request body, default is the target url. '''
     data = request.get_json()
-    if clientThread:
-        if data["target_url"] == clientThread.url:
-            print("stop http traffic.")
-            clientThread.stop()
-            clientThread = None
-            return make_response(("stop http traffic client success.", 200))
+    generator = generator_id(data)
+    # peers may include this pod, so the lock is not held while requesting them
+    with generators_lock:
+        coordinator = coordinators.get(generator)
+        if coordinator and data["target_url"] == coordinator.url:
+            del coordinators[generator]
+    if coordinator:
+        if data["target_url"] == coordinator.url:
+            print("stop coordinated http traffic {}.".format(generator))
+            try:
+                coordinator.stop()
+            except PeerError as e:
+                print(str(e))
+                return make_response((str(e), 502))
+            return make_response(("stop coordinated http traffic success.", 200))
         else:
             print("target url are different from original one.")
             return make_response(("target url are different from original one.", 400))
 
-    return make_response(("please start http traffic client first.", 400))
\ No newline at end of file
+    return make_response(("please start coordinated http traffic first.", 400))
+
+@app.route('/traces/<name>', methods=['PUT'])
+def upload_trace(name):
+    """
+    Upload a trace file replayed by the trace field of POST /start, request body is the file content,
+    name ending with .gz is decompressed on replay. The body is streamed to disk, so traces larger
+    than memory can be uploaded. Response body is json like {"path": path of the trace file in this pod}.
+    :return: response object
+    :rtype: str
+    """
+    if os.path.basename(name) != name or name.startswith("."):
+        return make_response(("invalid trace name {}.".format(name), 400))
+    os.makedirs(TRACE_DIR, exist_ok=True)
+    path = os.path.join(TRACE_DIR, name)
+    size = 0
+    with open(path, "wb") as f:
+        while True:
+            chunk = request.stream.read(TRACE_CHUNK)
+            if not chunk:
+                break
+            f.write(chunk)
+            size += len(chunk)
+    print("upload trace {}: {} bytes".format(path, size))
+    return make_response({"path": path, "size": size})
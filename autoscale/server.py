@@ -1,8 +1,611 @@
+import os
 import math
 import time
-from flask import Flask, request
+import json
+import bisect
+import random
+import socket
+import resource
+import shutil
+import signal
+import tempfile
+import functools
+import multiprocessing
+from threading import Lock, Thread
+from collections import deque
+from flask import Flask, Response, request
+from werkzeug.serving import make_server, WSGIRequestHandler
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    # without gunicorn the production server is werkzeug, which closes connections after each response
+    BaseApplication = None
+
+class ServerMetrics:
+    """
+    Counters and histograms of handled requests exported in Prometheus text format.
+    Request threads only append events to a deque, which is atomic and takes no lock, events
+    are folded into the totals when scraped, or by a request thread when many are pending and
+    no other thread is folding them, so handling a request never waits for a lock.
+    With several worker processes, every worker dumps its totals to a file of a shared directory
+    every SHARE_INTERVAL, and a scrape served by any worker renders the totals of all of them.
+    Handled requests are also counted by the second they completed in, for the request rate of the
+    pod over the last RATE_WINDOW seconds.
+    """
+
+    # handling duration bucket bounds, unit is second
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    # pending events folded by a request thread
+    FOLD_THRESHOLD = 10000
+    # seconds between dumps of the totals of a worker process
+    SHARE_INTERVAL = 1
+    # seconds of the moving window of the request rate
+    RATE_WINDOW = 10
+
+    def __init__(self):
+        self.events = deque()
+        self.lock = Lock()
+        self.started = {}
+        self.handled = {}
+        self.cpu_seconds = 0.0
+        self.requested_cpu_seconds = 0.0
+        self.throttled_seconds = 0.0
+        self.payload_bytes = 0
+        # loop iterations per cpu millisecond measured at startup
+        self.iterations_per_ms = None
+        self.duration_buckets = [0] * (len(self.BUCKETS) + 1)
+        self.duration_sum = 0.0
+        # monotonic second -> requests handled in it, for seconds in the rate window
+        self.recent = {}
+        # directory of the totals of worker processes, None for a single process
+        self.share_dir = None
+
+    def request_started(self, path: str):
+        self.events.append((path, None, None, None, None, None, None))
+
+    def request_handled(self, path: str, duration: float, cpu_seconds: float = 0.0,
+                        requested_cpu_seconds: float = 0.0, throttled_seconds: float = 0.0,
+                        payload_bytes: int = 0):
+        '''
+        :param duration: wall clock duration of handling the request, unit is second
+        :param cpu_seconds: cpu time burned by the request thread
+        :param requested_cpu_seconds: cpu time requested by the cpu_ms parameter of the request
+        :param throttled_seconds: time the pod was throttled by its cpu limit while handling the request
+        :param payload_bytes: payload bytes sent by the request
+        '''
+        self.events.append((path, duration, cpu_seconds, requested_cpu_seconds, throttled_seconds,
+                            payload_bytes, int(time.monotonic())))
+        if len(self.events) > self.FOLD_THRESHOLD and self.lock.acquire(blocking=False):
+            try:
+                self._fold()
+            finally:
+                self.lock.release()
+
+    def _fold(self):
+        events = self.events
+        while events:
+            path, duration, cpu_seconds, requested_cpu_seconds, throttled_seconds, payload_bytes, second = \
+                events.popleft()
+            if duration is None:
+                self.started[path] = self.started.get(path, 0) + 1
+                continue
+            self.handled[path] = self.handled.get(path, 0) + 1
+            self.cpu_seconds += cpu_seconds
+            self.requested_cpu_seconds += requested_cpu_seconds
+            self.throttled_seconds += throttled_seconds
+            self.payload_bytes += payload_bytes
+            self.duration_buckets[bisect.bisect_left(self.BUCKETS, duration)] += 1
+            self.duration_sum += duration
+            self.recent[second] = self.recent.get(second, 0) + 1
+        oldest = int(time.monotonic()) - self.RATE_WINDOW - self.SHARE_INTERVAL
+        for second in [second for second in self.recent if second < oldest]:
+            del self.recent[second]
+
+    def totals(self) -> dict:
+        return {
+            "started": dict(self.started),
+            "handled": dict(self.handled),
+            "cpu_seconds": self.cpu_seconds,
+            "requested_cpu_seconds": self.requested_cpu_seconds,
+            "throttled_seconds": self.throttled_seconds,
+            "payload_bytes": self.payload_bytes,
+            "duration_buckets": list(self.duration_buckets),
+            "duration_sum": self.duration_sum,
+            "recent": dict(self.recent)
+        }
+
+    @staticmethod
+    def merge_totals(totals: dict, other: dict):
+        for key in ("started", "handled"):
+            for path, count in other[key].items():
+                totals[key][path] = totals[key].get(path, 0) + count
+        for key in ("cpu_seconds", "requested_cpu_seconds", "throttled_seconds", "payload_bytes", "duration_sum"):
+            totals[key] += other[key]
+        totals["duration_buckets"] = [a + b for a, b in zip(totals["duration_buckets"], other["duration_buckets"])]
+        # seconds are json object keys in dumps
+        for second, count in other["recent"].items():
+            totals["recent"][int(second)] = totals["recent"].get(int(second), 0) + count
+
+    def share(self, directory: str):
+        ''' Share the totals of this worker process through directory, called in the worker after fork. '''
+        self.share_dir = directory
+        Thread(target=self._share_loop, daemon=True).start()
+
+    def _share_file(self, pid: int) -> str:
+        return os.path.join(self.share_dir, "worker-{}.json".format(pid))
+
+    def _dump(self):
+        path = self._share_file(os.getpid())
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.totals(), f)
+        # readers never see a partly written file
+        os.replace(path + ".tmp", path)
+
+    def _share_loop(self):
+        while True:
+            time.sleep(self.SHARE_INTERVAL)
+            with self.lock:
+                self._fold()
+                self._dump()
+
+    @staticmethod
+    def _alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            pass
+        return True
+
+    def _shared_totals(self) -> dict:
+        '''
+        Totals of this process merged with the last dump of every other worker. Counters of dead workers
+        are kept, but their requests in flight are not, as they will never be handled.
+        '''
+        totals = self.totals()
+        if self.share_dir is None:
+            return totals
+        own = os.path.basename(self._share_file(os.getpid()))
+        for name in os.listdir(self.share_dir):
+            if name == own or not name.startswith("worker-") or not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.share_dir, name)) as f:
+                    other = json.load(f)
+                if not self._alive(int(name[len("worker-"):-len(".json")])):
+                    other["started"] = other["handled"]
+            except (OSError, ValueError):
+                continue
+            self.merge_totals(totals, other)
+        return totals
+
+    def _gauges(self, totals: dict) -> dict:
+        '''
+        Request rate and requests in flight of the pod. The rate window ends SHARE_INTERVAL before the
+        current second, which is partial and not yet dumped by other workers.
+        '''
+        end = int(time.monotonic()) - self.SHARE_INTERVAL
+        handled = sum(count for second, count in totals["recent"].items() if end - self.RATE_WINDOW <= second < end)
+        return {
+            "requests_per_second": handled / self.RATE_WINDOW,
+            "requests_in_flight": sum(totals["started"].values()) - sum(totals["handled"].values())
+        }
+
+    def gauges(self) -> dict:
+        with self.lock:
+            self._fold()
+            return self._gauges(self._shared_totals())
+
+    def render(self) -> str:
+        with self.lock:
+            self._fold()
+            totals = self._shared_totals()
+        gauges = self._gauges(totals)
+        lines = ["# HELP http_server_requests_total Handled requests by path.",
+                 "# TYPE http_server_requests_total counter"]
+        for path, count in sorted(totals["handled"].items()):
+            lines.append('http_server_requests_total{{path="{}"}} {}'.format(path, count))
+        lines += ["# HELP http_server_requests_in_flight Requests being handled.",
+                  "# TYPE http_server_requests_in_flight gauge",
+                  "http_server_requests_in_flight {}".format(gauges["requests_in_flight"]),
+                  "# HELP http_server_requests_per_second Requests handled per second over the rate window.",
+                  "# TYPE http_server_requests_per_second gauge",
+                  "http_server_requests_per_second {}".format(gauges["requests_per_second"]),
+                  "# HELP http_server_cpu_seconds_total Cpu time burned by requests.",
+                  "# TYPE http_server_cpu_seconds_total counter",
+                  "http_server_cpu_seconds_total {}".format(totals["cpu_seconds"]),
+                  "# HELP http_server_requested_cpu_seconds_total Cpu time requested by the cpu_ms parameter.",
+                  "# TYPE http_server_requested_cpu_seconds_total counter",
+                  "http_server_requested_cpu_seconds_total {}".format(totals["requested_cpu_seconds"]),
+                  "# HELP http_server_request_throttled_seconds_total Time requests were stopped by cpu throttling of the pod.",
+                  "# TYPE http_server_request_throttled_seconds_total counter",
+                  "http_server_request_throttled_seconds_total {}".format(totals["throttled_seconds"]),
+                  "# HELP http_server_payload_bytes_total Payload bytes sent by /payload.",
+                  "# TYPE http_server_payload_bytes_total counter",
+                  "http_server_payload_bytes_total {}".format(totals["payload_bytes"]),
+                  "# HELP http_server_request_duration_seconds Duration of handling requests.",
+                  "# TYPE http_server_request_duration_seconds histogram"]
+        cumulative = 0
+        for bound, count in zip(self.BUCKETS, totals["duration_buckets"]):
+            cumulative += count
+            lines.append('http_server_request_duration_seconds_bucket{{le="{}"}} {}'.format(bound, cumulative))
+        cumulative += totals["duration_buckets"][-1]
+        lines.append('http_server_request_duration_seconds_bucket{{le="+Inf"}} {}'.format(cumulative))
+        lines.append("http_server_request_duration_seconds_sum {}".format(totals["duration_sum"]))
+        lines.append("http_server_request_duration_seconds_count {}".format(cumulative))
+        if self.iterations_per_ms is not None:
+            lines += ["# HELP http_server_cpu_iterations_per_ms Loop iterations per cpu millisecond of this node.",
+                      "# TYPE http_server_cpu_iterations_per_ms gauge",
+                      "http_server_cpu_iterations_per_ms {}".format(self.iterations_per_ms)]
+        # the cgroup is shared by all worker processes, so its counters are not merged
+        stat = read_cpu_stat()
+        if stat is not None:
+            lines += ["# HELP http_server_cgroup_cpu_usage_seconds_total Cpu time used by the cgroup of the pod.",
+                      "# TYPE http_server_cgroup_cpu_usage_seconds_total counter",
+                      "http_server_cgroup_cpu_usage_seconds_total {}".format(stat["usage_seconds"]),
+                      "# HELP http_server_cgroup_throttled_seconds_total Time the cgroup of the pod was throttled by its cpu limit.",
+                      "# TYPE http_server_cgroup_throttled_seconds_total counter",
+                      "http_server_cgroup_throttled_seconds_total {}".format(stat["throttled_seconds"]),
+                      "# HELP http_server_cgroup_periods_total Elapsed CFS enforcement periods of the cgroup of the pod.",
+                      "# TYPE http_server_cgroup_periods_total counter",
+                      "http_server_cgroup_periods_total {}".format(stat["periods"]),
+                      "# HELP http_server_cgroup_throttled_periods_total CFS periods the cgroup of the pod was throttled in.",
+                      "# TYPE http_server_cgroup_throttled_periods_total counter",
+                      "http_server_cgroup_throttled_periods_total {}".format(stat["throttled_periods"])]
+        return "\n".join(lines) + "\n"
+
+MIB = 1 << 20
+PAGE_SIZE = resource.getpagesize()
+# directory of the files of disk workloads
+WORK_DIR = os.environ.get("WORK_DIR", tempfile.gettempdir())
+# cpu time burned at startup to measure the loop speed of this node
+CALIBRATION_SECONDS = float(os.environ.get("CPU_CALIBRATION_SECONDS", 0.2))
+# worker processes when run as main, 0 means one per cpu of the pod cpu limit
+WORKERS = int(os.environ.get("WORKERS", 0))
+PORT = int(os.environ.get("PORT", 8080))
+# request threads of a worker process served by gunicorn
+THREADS = int(os.environ.get("THREADS", 32))
+# seconds an idle keep-alive connection is kept open by gunicorn
+KEEPALIVE_SECONDS = int(os.environ.get("KEEPALIVE_SECONDS", 75))
+LISTEN_BACKLOG = 1024
+# iterations of one busy step of the duty cycle burner
+BURN_CHUNK = 1000
+# state of the duty cycle burner shared by the worker processes
+BURN_STATE = os.environ.get("BURN_STATE", os.path.join(tempfile.gettempdir(), "duty-cycle.json"))
+# size of the preallocated buffer of /payload, also its largest piece written at once
+PAYLOAD_BUFFER = int(os.environ.get("PAYLOAD_BUFFER", MIB))
+
+# workload kernels served by /work/<name>
+workloads = {}
+
+def workload(name: str):
+    '''
+    Register a workload kernel served by /work/<name>. A kernel takes the query parameters of the
+    request and returns the resources it consumed, the wall clock and cpu time of the request are
+    measured around it.
+    '''
+    def register(kernel):
+        workloads[name] = kernel
+        return kernel
+    return register
+
+def burn(count: int):
+    ''' Burn cpu by count iterations of a sqrt loop. '''
+    x = 0.0001
+    for i in range(1, count):
+        x += math.sqrt(x)
+
+def burn_for(count: int, seconds: float) -> int:
+    '''
+    Burn cpu by count iterations, or in chunks until the thread burned seconds of cpu time if seconds is given.
+    :return: iterations done
+    '''
+    if not seconds:
+        burn(count)
+        return count
+    iterations = 0
+    deadline = time.thread_time() + seconds
+    while time.thread_time() < deadline:
+        burn(10000)
+        iterations += 10000
+    return iterations
+
+def calibrate(seconds: float, rounds: int = 5) -> float:
+    '''
+    Measure loop iterations per cpu millisecond, so cpu_ms parameters cost the same cpu time on any
+    node. Cpu time of the thread is measured, so the result is not skewed by cpu throttling, and the
+    median of several rounds is taken, so it is not skewed by a round disturbed by other processes.
+    '''
+    speeds = []
+    for i in range(rounds):
+        cpu_start = time.thread_time()
+        iterations = burn_for(0, seconds / rounds)
+        speeds.append(iterations / ((time.thread_time() - cpu_start) * 1000))
+    return sorted(speeds)[rounds // 2]
+
+def cpu_count(args) -> tuple:
+    '''
+    Loop count of a request, from the cpu_ms parameter if given, else the count parameter.
+    :return: (count, requested cpu seconds or None if count is given)
+    '''
+    cpu_ms = args.get("cpu_ms", type=float)
+    if cpu_ms is None:
+        return args.get("count", default=1000000, type=int), None
+    if cpu_ms < 0:
+        raise ValueError("cpu_ms must not be negative")
+    return round(cpu_ms * ITERATIONS_PER_MS), cpu_ms / 1000
+
+def duty_cycle(fraction: float, seconds: float, slice_seconds: float):
+    '''
+    Hold fraction of one cpu for seconds by slices of busy loop then sleep. The busy phase burns the
+    cpu time due by the end of the slice, measured by the thread clock, so time lost to preemption or
+    throttling is caught up within the next slice, but a backlog longer than one slice is forgiven,
+    so it does not end in a burst.
+    '''
+    start = time.monotonic()
+    cpu_start = time.thread_time()
+    max_owed = fraction * slice_seconds
+    while True:
+        elapsed = time.monotonic() - start
+        if elapsed >= seconds:
+            return
+        used = time.thread_time() - cpu_start
+        owed = fraction * elapsed - used
+        if owed > max_owed:
+            cpu_start -= owed - max_owed
+            owed = max_owed
+        if owed > 0:
+            target = time.thread_time() + owed + max_owed
+            while time.thread_time() < target:
+                burn(BURN_CHUNK)
+        else:
+            time.sleep(min(-owed / fraction, seconds - elapsed))
+
+class DutyCycleBurner:
+    """
+    Background cpu load holding a number of millicores for a duration, independent of the request
+    rate. The load is split into processes holding at most one cpu each, see duty_cycle. The state
+    is kept in a file, so every worker process of the server can query or stop the burner started by
+    any of them.
+    """
+
+    def __init__(self, state_path: str):
+        self.state_path = state_path
+
+    def _load(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save(self, state: dict):
+        with open(self.state_path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+    def start(self, millicores: float, seconds: float, slice_seconds: float) -> dict:
+        if millicores <= 0 or seconds <= 0 or slice_seconds <= 0:
+            raise ValueError("millicores, seconds and slice_ms must be positive")
+        self.stop()
+        count = math.ceil(millicores / 1000)
+        context = multiprocessing.get_context("fork")
+        processes = [context.Process(target=duty_cycle, args=(millicores / 1000 / count, seconds, slice_seconds),
+                                     daemon=True) for i in range(count)]
+        # taken before the processes start, so they are all gone once seconds elapsed since then
+        started = time.time()
+        for process in processes:
+            process.start()
+        # reap the processes when they end
+        Thread(target=lambda: [process.join() for process in processes], daemon=True).start()
+        self._save({"millicores": millicores, "seconds": seconds, "slice_ms": slice_seconds * 1000,
+                    "pids": [process.pid for process in processes], "started": started, "stopped": False})
+        print("duty cycle burner holds {} millicores for {} seconds by {} processes".format(
+            millicores, seconds, count))
+        return self.status()
+
+    def stop(self) -> dict:
+        state = self._load()
+        if state and not state["stopped"]:
+            # processes which ended on their own are reaped, and their pids may be reused
+            if time.time() - state["started"] < state["seconds"]:
+                for pid in state["pids"]:
+                    try:
+                        os.kill(pid, signal.SIGTERM)
+                    except OSError:
+                        pass
+            state["stopped"] = True
+            self._save(state)
+        return self.status()
+
+    def millicores(self) -> float:
+        ''' Millicores held now, 0 if no burner is running. '''
+        status = self.status()
+        return status["millicores"] if status["running"] else 0
+
+    def status(self) -> dict:
+        state = self._load()
+        if state is None:
+            return {"running": False}
+        elapsed = time.time() - state["started"]
+        return {
+            "running": not state["stopped"] and elapsed < state["seconds"],
+            "millicores": state["millicores"],
+            "seconds": state["seconds"],
+            "slice_ms": state["slice_ms"],
+            "processes": len(state["pids"]),
+            "elapsed": min(elapsed, state["seconds"])
+        }
+
+def allocate(mib: int) -> bytearray:
+    ''' Allocate mib MiB and touch every page of it, so it is resident and counted by the memory cgroup. '''
+    buffer = bytearray(mib * MIB)
+    buffer[::PAGE_SIZE] = b"\x01" * len(range(0, len(buffer), PAGE_SIZE))
+    return buffer
+
+def max_rss() -> int:
+    ''' Peak resident memory of the server process, unit is byte. '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+@functools.lru_cache(maxsize=16)
+def payload_piece(size: int) -> bytes:
+    '''
+    Leading size bytes of the payload buffer. A piece is sliced once and written by every response
+    using its size, because WSGI servers only write bytes, not memoryview slices of the buffer.
+    '''
+    return PAYLOAD[:size]
+
+def read_cpu_stat() -> dict:
+    '''
+    Cpu accounting of the cgroup of the pod as {"usage_seconds", "throttled_seconds", "periods", "throttled_periods"},
+    None without cgroup cpu accounting.
+    '''
+    try:
+        # cgroup v2, the nr_ and throttled_ fields are missing without cpu limit
+        with open("/sys/fs/cgroup/cpu.stat") as f:
+            stat = dict(line.split() for line in f)
+        return {"usage_seconds": int(stat["usage_usec"]) / 1e6,
+                "throttled_seconds": int(stat.get("throttled_usec", 0)) / 1e6,
+                "periods": int(stat.get("nr_periods", 0)),
+                "throttled_periods": int(stat.get("nr_throttled", 0))}
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        # cgroup v1, times are nanoseconds
+        with open("/sys/fs/cgroup/cpu/cpu.stat") as f:
+            stat = dict(line.split() for line in f)
+        with open("/sys/fs/cgroup/cpuacct/cpuacct.usage") as f:
+            usage = int(f.read())
+        return {"usage_seconds": usage / 1e9,
+                "throttled_seconds": int(stat["throttled_time"]) / 1e9,
+                "periods": int(stat["nr_periods"]),
+                "throttled_periods": int(stat["nr_throttled"])}
+    except (OSError, KeyError, ValueError):
+        return None
+
+class CpuAccounting:
+    """
+    Splits the wall clock duration of handling a request into cpu time burned by the request thread,
+    time the pod was throttled by its cpu limit, and the rest spent waiting for other threads and
+    processes. Throttling stops every thread of the cgroup, so throttled time is charged to all
+    requests in flight, and is capped by the time the request thread was off cpu.
+    """
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.cpu_start = time.thread_time()
+        self.stat_start = read_cpu_stat()
+        self.duration = 0.0
+        self.cpu_seconds = 0.0
+        self.throttled_seconds = 0.0
+        self.throttled_periods = 0
+
+    def finish(self):
+        self.cpu_seconds = time.thread_time() - self.cpu_start
+        self.duration = time.monotonic() - self.start
+        stat = read_cpu_stat() if self.stat_start is not None else None
+        if stat is not None:
+            throttled = stat["throttled_seconds"] - self.stat_start["throttled_seconds"]
+            self.throttled_seconds = max(0.0, min(throttled, self.duration - self.cpu_seconds))
+            self.throttled_periods = stat["throttled_periods"] - self.stat_start["throttled_periods"]
+
+    def report(self) -> dict:
+        return {"duration": self.duration, "cpu_seconds": self.cpu_seconds,
+                "throttled_seconds": self.throttled_seconds, "throttled_periods": self.throttled_periods}
+
+    def headers(self) -> dict:
+        ''' Response headers identifying the serving pod and the cpu accounting of the request. '''
+        return {"X-Pod-Name": POD_NAME, "X-Cpu-Seconds": str(self.cpu_seconds),
+                "X-Throttled-Seconds": str(self.throttled_seconds)}
+
+@workload("cpu")
+def cpu_workload(args) -> dict:
+    '''
+    count: iterations of the sqrt loop, default is 1000000, cpu_ms: calibrated cpu milliseconds instead
+    of count, seconds: cpu time burned measured by the thread clock instead of count.
+    '''
+    count, requested = cpu_count(args)
+    report = {"iterations": burn_for(count, args.get("seconds", type=float))}
+    if requested is not None:
+        report["requested_cpu_seconds"] = requested
+    return report
+
+@workload("memory")
+def memory_workload(args) -> dict:
+    ''' mib: memory allocated and touched, default is 64, seconds: time the memory is held, default is 0. '''
+    mib = args.get("mib", default=64, type=int)
+    buffer = allocate(mib)
+    time.sleep(args.get("seconds", default=0.0, type=float))
+    del buffer
+    return {"memory_bytes": mib * MIB, "max_rss_bytes": max_rss()}
+
+@workload("disk")
+def disk_workload(args) -> dict:
+    '''
+    mib: size of the file written then read, default is 16, block_kib: size of each read and write,
+    default is 64, mode: seq or random order of the blocks, default is seq, seconds: reads are repeated
+    until this time elapsed, default is one read.
+    '''
+    size = args.get("mib", default=16, type=int) * MIB
+    block_size = args.get("block_kib", default=64, type=int) * 1024
+    mode = args.get("mode", default="seq")
+    if block_size <= 0 or mode not in ("seq", "random"):
+        raise ValueError("invalid block_kib or mode")
+    offsets = list(range(0, size, block_size))
+    if mode == "random":
+        random.shuffle(offsets)
+    block = b"\xa5" * block_size
+    fd, path = tempfile.mkstemp(dir=WORK_DIR)
+    written = read = ops = 0
+    deadline = time.monotonic() + args.get("seconds", default=0.0, type=float)
+    try:
+        for offset in offsets:
+            written += os.pwrite(fd, block, offset)
+        os.fsync(fd)
+        ops += len(offsets)
+        while True:
+            # drop the file from page cache, so it is read from disk
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            for offset in offsets:
+                read += len(os.pread(fd, block_size, offset))
+            ops += len(offsets)
+            if time.monotonic() >= deadline:
+                break
+    finally:
+        os.close(fd)
+        os.remove(path)
+    return {"bytes_written": written, "bytes_read": read, "io_ops": ops}
+
+@workload("mix")
+def mix_workload(args) -> dict:
+    '''
+    mib: memory allocated and touched, default is 64, held while burning cpu by count iterations,
+    default is 1000000, by cpu_ms calibrated cpu milliseconds or by seconds of cpu time.
+    '''
+    mib = args.get("mib", default=64, type=int)
+    count, requested = cpu_count(args)
+    buffer = allocate(mib)
+    iterations = burn_for(count, args.get("seconds", type=float))
+    del buffer
+    report = {"iterations": iterations, "memory_bytes": mib * MIB, "max_rss_bytes": max_rss()}
+    if requested is not None:
+        report["requested_cpu_seconds"] = requested
+    return report
 
 app = Flask(__name__)
+metrics = ServerMetrics()
+ITERATIONS_PER_MS = calibrate(CALIBRATION_SECONDS)
+# allocated before worker processes are forked, so they share its pages. Random bytes are not
+# shrunk by any compression on the way
+PAYLOAD = os.urandom(PAYLOAD_BUFFER)
+metrics.iterations_per_ms = ITERATIONS_PER_MS
+burner = DutyCycleBurner(BURN_STATE)
+print("cpu calibration: {} iterations per cpu millisecond".format(ITERATIONS_PER_MS))
+# pod name is the hostname of the container
+POD_NAME = socket.gethostname()
+# namespace of the pod from the downward api, for the objects described by custom metrics
+POD_NAMESPACE = os.environ.get("POD_NAMESPACE", "default")
 
 @app.route('/')
 def index():
@@ -11,10 +614,296 @@ def index():
 
 @app.route('/cpu')
 def consume_cpu():
-    count = request.args.get("count", default=1000000, type=int)
-    x = 0.0001
-    start = time.monotonic()
-    for i in range(1, count):
-        x += math.sqrt(x)
-    end = time.monotonic()
-    return str(end - start)
+    """
+    Burn cpu by the count parameter, response body is the duration. With the cpu_ms parameter the
+    loop count is calibrated to burn that cpu time, and response body is json like below:
+    {"duration": wall clock seconds, "cpu_seconds": cpu time of the request thread,
+     "throttled_seconds": time the pod was throttled by its cpu limit, "throttled_periods": CFS periods throttled,
+     "requested_cpu_seconds": cpu_ms / 1000, "iterations": loop count}
+    Both forms carry the cpu and throttled seconds in the X-Cpu-Seconds and X-Throttled-Seconds headers.
+    """
+    metrics.request_started("/cpu")
+    accounting = CpuAccounting()
+    burned = 0.0
+    try:
+        count, requested = cpu_count(request.args)
+        burn(count)
+        burned = requested or 0.0
+    except ValueError as e:
+        return str(e), 400
+    finally:
+        # paired with request_started whatever happens, so requests in flight never leak
+        accounting.finish()
+        metrics.request_handled("/cpu", accounting.duration, accounting.cpu_seconds, burned,
+                                accounting.throttled_seconds)
+    # the serving pod is identified in header, so load distribution across pods can be measured by client
+    headers = accounting.headers()
+    if requested is None:
+        return str(accounting.duration), 200, headers
+    report = accounting.report()
+    report.update({"requested_cpu_seconds": requested, "iterations": count})
+    return Response(json.dumps(report), mimetype="application/json", headers=headers)
+
+@app.route('/payload')
+def send_payload():
+    """
+    Respond with the count of bytes of the bytes parameter taken from the preallocated payload buffer,
+    written with Content-Length in pieces of the buffer size. With the chunk parameter the payload is
+    streamed by chunked transfer encoding in pieces of chunk bytes. Pieces are sliced from the buffer once
+    per size and shared by responses, so the server spends no cpu building payloads.
+    """
+    metrics.request_started("/payload")
+    accounting = CpuAccounting()
+    sent = 0
+    response = None
+
+    def stream():
+        nonlocal sent
+        piece = payload_piece(chunk or PAYLOAD_BUFFER)
+        while size - sent >= len(piece):
+            yield piece
+            sent += len(piece)
+        if size > sent:
+            yield payload_piece(size - sent)
+            sent = size
+
+    def finish():
+        # called when the body is sent or the client is gone
+        accounting.finish()
+        metrics.request_handled("/payload", accounting.duration, accounting.cpu_seconds, 0.0,
+                                accounting.throttled_seconds, sent)
+
+    try:
+        size = int(request.args.get("bytes", 0))
+        chunk = int(request.args.get("chunk", 0))
+        if size < 0 or not 0 <= chunk <= PAYLOAD_BUFFER:
+            raise ValueError("bytes must not be negative and chunk must be at most {}".format(PAYLOAD_BUFFER))
+        headers = {"X-Pod-Name": POD_NAME}
+        if not chunk:
+            headers["Content-Length"] = str(size)
+        response = Response(stream(), mimetype="application/octet-stream", headers=headers)
+        response.call_on_close(finish)
+        return response
+    except ValueError as e:
+        return str(e), 400
+    finally:
+        # a response records the request when it is closed, else the request is recorded now
+        if response is None:
+            finish()
+
+@app.route('/metrics')
+def export_metrics():
+    ''' Export metrics of handled requests in Prometheus text format. '''
+    lines = ["# HELP http_server_duty_cycle_millicores Cpu load held by the duty cycle burner.",
+             "# TYPE http_server_duty_cycle_millicores gauge",
+             "http_server_duty_cycle_millicores {}".format(burner.millicores())]
+    return Response(metrics.render() + "\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+def quantity(value: float) -> str:
+    ''' Kubernetes quantity of value in milli units, like 12500m for 12.5. '''
+    return "{}m".format(int(round(value * 1000)))
+
+@app.route('/custom-metrics')
+def export_custom_metrics():
+    """
+    Request rate and requests in flight of this pod as a custom.metrics.k8s.io/v1beta1 MetricValueList,
+    named like their gauges of /metrics. A custom metrics stand-in serves the pods metrics of the API
+    by concatenating the items of every pod, filtered by the metric query parameter if given.
+    """
+    gauges = metrics.gauges()
+    timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    names = {"http_server_requests_per_second": gauges["requests_per_second"],
+             "http_server_requests_in_flight": gauges["requests_in_flight"]}
+    metric = request.args.get("metric")
+    if metric is not None and metric not in names:
+        return "unknown metric {}".format(metric), 404
+    items = [{
+        "describedObject": {"kind": "Pod", "namespace": POD_NAMESPACE, "name": POD_NAME, "apiVersion": "/v1"},
+        "metricName": name,
+        "timestamp": timestamp,
+        "value": quantity(value)
+    } for name, value in sorted(names.items()) if metric in (None, name)]
+    body = {"kind": "MetricValueList", "apiVersion": "custom.metrics.k8s.io/v1beta1", "metadata": {},
+            "items": items}
+    return Response(json.dumps(body), mimetype="application/json")
+
+@app.route('/burn', methods=['GET', 'POST', 'DELETE'])
+def duty_cycle_burn():
+    """
+    Hold a cpu load of the pod in background, so utilization steps are exact whatever the request
+    rate. POST with query parameters millicores, seconds and optional slice_ms, default is 10, starts
+    the burner in place of the running one, GET queries it and DELETE stops it. Response body is json
+    like below:
+    {"running": true, "millicores": .., "seconds": .., "slice_ms": .., "processes": .., "elapsed": ..}
+    """
+    if request.method == "POST":
+        try:
+            return burner.start(request.args.get("millicores", type=float, default=0),
+                                request.args.get("seconds", type=float, default=0),
+                                request.args.get("slice_ms", type=float, default=10) / 1000)
+        except ValueError as e:
+            return str(e), 400
+    if request.method == "DELETE":
+        return burner.stop()
+    return burner.status()
+
+@app.route('/work')
+def list_workloads():
+    ''' Names and parameters of the registered workloads. '''
+    return {name: kernel.__doc__.strip() for name, kernel in sorted(workloads.items())}
+
+@app.route('/work/<name>')
+def run_workload(name):
+    """
+    Run the registered workload of name with the query parameters of the request, response body is
+    json like below, with the resources reported by the workload:
+    {"workload": name, "duration": wall clock seconds, "cpu_seconds": cpu time of the request thread,
+     "throttled_seconds": time the pod was throttled by its cpu limit, "throttled_periods": CFS periods throttled, ..}
+    """
+    kernel = workloads.get(name)
+    if kernel is None:
+        return "unknown workload {}".format(name), 404
+    path = "/work/" + name
+    metrics.request_started(path)
+    accounting = CpuAccounting()
+    error = report = None
+    try:
+        report = kernel(request.args)
+    except (ValueError, OSError, MemoryError) as e:
+        error = e
+    finally:
+        # paired with request_started even when the kernel raises, so requests in flight never leak
+        accounting.finish()
+        metrics.request_handled(path, accounting.duration, accounting.cpu_seconds,
+                                report.get("requested_cpu_seconds", 0.0) if report is not None else 0.0,
+                                accounting.throttled_seconds)
+    if error is not None:
+        # invalid parameters are the client's fault, lack of memory or disk is the server's
+        status = 400 if isinstance(error, ValueError) else 500
+        return "workload {} failed: {}".format(name, error), status, accounting.headers()
+    report.update(accounting.report())
+    report["workload"] = name
+    return Response(json.dumps(report), mimetype="application/json", headers=accounting.headers())
+
+def available_cpus() -> int:
+    '''
+    Number of cpus this pod may use. The cgroup cpu limit is honored because os.cpu_count()
+    reports the cpus of the node instead of the pod limit.
+    '''
+    cpus = len(os.sched_getaffinity(0))
+    try:
+        # cgroup v2
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, float(quota) / float(period))
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                quota = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if quota > 0:
+                cpus = min(cpus, quota / period)
+        except (OSError, ValueError):
+            pass
+    return max(1, int(cpus + 0.5))
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """ Request handler of the production server without access log, which costs more than a short request. """
+
+    def log_request(self, code="-", size="-"):
+        pass
+
+def warm_up():
+    ''' Serve one request of each kind without metrics, so lazy initialization is done before the pod is ready. '''
+    client = app.test_client()
+    for path in ("/", "/work", "/metrics"):
+        client.get(path)
+
+def serve(port: int, workers: int):
+    '''
+    Production server of several worker processes, which share the listening socket and dump their
+    metrics to a shared directory. The socket is opened only when the app is warm, so the readiness
+    probe passes as soon as requests are served at full speed. Dead workers are replaced, SIGTERM
+    stops all of them. Workers are gunicorn threaded workers keeping connections alive if gunicorn
+    is installed, else threaded werkzeug servers.
+    '''
+    warm_up()
+    share_dir = tempfile.mkdtemp(prefix="server-metrics-")
+    try:
+        if BaseApplication is not None:
+            serve_gunicorn(port, workers, share_dir)
+        else:
+            serve_werkzeug(port, workers, share_dir)
+    finally:
+        shutil.rmtree(share_dir, ignore_errors=True)
+
+def serve_gunicorn(port: int, workers: int, share_dir: str):
+    ''' Serve by gunicorn gthread workers, which keep idle connections alive for KEEPALIVE_SECONDS. '''
+    class Server(BaseApplication):
+        def load_config(self):
+            settings = {
+                "bind": "0.0.0.0:{}".format(port),
+                "workers": workers,
+                "worker_class": "gthread",
+                "threads": THREADS,
+                "keepalive": KEEPALIVE_SECONDS,
+                "backlog": LISTEN_BACKLOG,
+                # the app is loaded and warm before workers are forked
+                "preload_app": True,
+                "post_fork": lambda server, worker: metrics.share(share_dir)
+            }
+            for key, value in settings.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    print("serving on port {} by {} gunicorn worker processes of {} threads".format(port, workers, THREADS))
+    Server().run()
+
+def serve_werkzeug(port: int, workers: int, share_dir: str):
+    ''' Serve by forked threaded werkzeug servers, which close the connection after each response. '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("0.0.0.0", port))
+    sock.listen(LISTEN_BACKLOG)
+    children = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            metrics.share(share_dir)
+            server = make_server("0.0.0.0", port, app, threaded=True, request_handler=QuietRequestHandler,
+                                 fd=sock.fileno())
+            server.serve_forever()
+            os._exit(0)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for i in range(workers):
+        spawn()
+    print("serving on port {} by {} werkzeug worker processes".format(port, workers))
+    while children:
+        pid, status = os.wait()
+        if pid not in children:
+            continue
+        children.discard(pid)
+        if not stopping:
+            print("worker process {} exited with status {}, restart it".format(pid, status))
+            spawn()
+
+if __name__ == "__main__":
+    serve(PORT, WORKERS or available_cpus())
@@ -1,20 +1,35 @@
-from flask import Flask
+import os
+from flask import Flask, request
 from cpuload import cpuload
-from httpclient import httpclient
+from httpclient import httpclient, MAX_CONCURRENCY, MAX_COUNT
+from prefork import serve, available_cpus
 app = Flask(__name__)
 
 """ This URL will be called by http client app. As the client app hits this URL, 
     cpuload function will be called and generate CPU load.
-    Check cpuload.py for more information. """
+    Check cpuload.py for more information. Optional parameter cpu_ms is the calibrated cpu time
+    burned by the request in milliseconds. """
 @app.route('/cpu')
 def firstapp():
-    f = cpuload()
+    f = cpuload(request.args.get("cpu_ms", type=float))
     return f
 
 """ This URL will be called by python script. With GET call to this URL, httpclient function will be called.
     httpclient function is intent to call this app's cpuload function (http://FQDN/cpu).
+    Optional parameters count and concurrency fan out count calls with at most concurrency of them at once,
+    cpu_ms is passed to every call. The response is the aggregated timing of the calls.
     Check httpclient.py for more information. """
 @app.route('/')
 def get():
-    h = httpclient()
-    return h
\ No newline at end of file
+    count = request.args.get("count", 1, type=int)
+    concurrency = request.args.get("concurrency", 1, type=int)
+    if not 1 <= count <= MAX_COUNT or not 1 <= concurrency <= MAX_CONCURRENCY:
+        return "count must be 1 to {} and concurrency must be 1 to {}".format(MAX_COUNT, MAX_CONCURRENCY), 400
+    h = httpclient(count, concurrency, request.args.get("cpu_ms", type=float))
+    return h
+
+""" Production serving mode: worker processes sized to the container cpu limit unless WORKERS
+    is given, the app is warmed up before the port is opened. """
+if __name__ == "__main__":
+    serve(app, int(os.environ.get("PORT", 8080)), int(os.environ.get("WORKERS", 0)) or available_cpus(),
+          warm_paths=("/cpu?cpu_ms=1",))
@@ -1,18 +1,50 @@
+import os
 import math
 import time
 
-def cpuload():
+# cpu time burned at import to measure the loop speed of this node
+CALIBRATION_SECONDS = float(os.environ.get("CPU_CALIBRATION_SECONDS", 0.2))
+DEFAULT_COUNT = 1000000
+
+def loop(count):
+    for x in range(1, count):
+        s = math.sqrt(x)
+
+def calibrate(seconds, rounds=5):
+    """ Measure loop iterations per cpu millisecond of this node, cpu time of the thread is
+    measured, so the result is not skewed by cpu throttling, and the median of several rounds
+    is taken, so it is not skewed by a round disturbed by other processes. """
+    speeds = []
+    for i in range(rounds):
+        iterations = 0
+        cpu_start = time.thread_time()
+        while time.thread_time() - cpu_start < seconds / rounds:
+            loop(10000)
+            iterations += 10000
+        speeds.append(iterations / ((time.thread_time() - cpu_start) * 1000))
+    return sorted(speeds)[rounds // 2]
+
+ITERATIONS_PER_MS = calibrate(CALIBRATION_SECONDS)
+
+def cpuload(cpu_ms=None):
+    """ Burn cpu by a fixed loop, or by cpu_ms calibrated cpu milliseconds if given, and report
+    the requested and the actual cpu time of the request. """
+    count = DEFAULT_COUNT if cpu_ms is None else round(cpu_ms * ITERATIONS_PER_MS)
     etime = {}
     start_time = time.time()
-    for x in range(1, 1000000):
-        s = math.sqrt(x)
+    cpu_start = time.thread_time()
+    loop(count)
+    cpu_end = time.thread_time()
     end_time = time.time()
     time_taken = end_time - start_time
     etime["start_time"] = start_time
     etime["end_time"] = end_time
     etime["time_taken"] = time_taken
+    etime["iterations"] = count
+    etime["cpu_seconds"] = cpu_end - cpu_start
+    etime["requested_cpu_seconds"] = cpu_ms / 1000 if cpu_ms is not None else None
     return etime
 
 """if __name__ == "__main__":
     f = squareroot()
-    print(f)"""
\ No newline at end of file
+    print(f)"""
@@ -1,6 +1,70 @@
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
 
-url = "http://0.0.0.0:8080/cpu"
-def httpclient():
-    r = requests.get(url=url)
-    return r.text
\ No newline at end of file
+# the fan out calls this app by default, so every call in flight holds a server thread besides the
+# thread of its / request: THREADS of prefork.py times WORKERS must exceed the concurrent / callers
+# plus their fan out concurrency, or / requests wait on each other until FANOUT_TIMEOUT.
+# FANOUT_URL sends the fan out to a separate server instead
+url = os.environ.get("FANOUT_URL", "http://0.0.0.0:8080/cpu")
+# most concurrent calls of one fan out, also the most connections kept by the session
+MAX_CONCURRENCY = int(os.environ.get("FANOUT_MAX_CONCURRENCY", 64))
+# most calls of one fan out
+MAX_COUNT = int(os.environ.get("FANOUT_MAX_COUNT", 10000))
+# seconds to connect and to wait for the response of one call, a call timed out is an error
+TIMEOUT = float(os.environ.get("FANOUT_TIMEOUT", 30))
+
+# calls of all fan outs share the connection pool of one session
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=MAX_CONCURRENCY))
+
+def percentile(values, q):
+    """ Nearest rank percentile q of sorted values. """
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+def call(params):
+    """ Call the cpu load url once, return the wall clock seconds of the call and the report of cpuload,
+    the report is None if the call failed. """
+    start = time.monotonic()
+    try:
+        r = session.get(url=url, params=params, timeout=TIMEOUT)
+        report = r.json() if r.status_code == 200 else None
+    except (requests.RequestException, ValueError):
+        report = None
+    return time.monotonic() - start, report
+
+def httpclient(count=1, concurrency=1, cpu_ms=None):
+    """ Call the cpu load url count times with at most concurrency calls at once, and aggregate the
+    timing of the calls and the cpu time reported by cpuload. Optional cpu_ms is passed to every call. """
+    params = {"cpu_ms": cpu_ms} if cpu_ms is not None else {}
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(call, [params] * count))
+    duration = time.monotonic() - start
+    reports = [report for _, report in results if report is not None]
+    latencies = sorted(latency for latency, report in results if report is not None)
+    result = {
+        "count": count,
+        "concurrency": concurrency,
+        "completed": len(reports),
+        "errors": count - len(reports),
+        "duration": duration,
+        "rate": len(reports) / duration if duration > 0 else 0,
+        # cpu load duration and cpu time of the calls as reported by cpuload
+        "time_taken": sum(report["time_taken"] for report in reports),
+        "cpu_seconds": sum(report["cpu_seconds"] for report in reports),
+        "requested_cpu_seconds": cpu_ms * len(reports) / 1000 if cpu_ms is not None else None
+    }
+    if latencies:
+        result["latency"] = {
+            "min": latencies[0],
+            "max": latencies[-1],
+            "mean": sum(latencies) / len(latencies),
+            "p50": percentile(latencies, 0.5),
+            "p90": percentile(latencies, 0.9),
+            "p99": percentile(latencies, 0.99)
+        }
+    return result
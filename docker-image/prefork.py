@@ -0,0 +1,115 @@
+import os
+import signal
+import socket
+from werkzeug.serving import make_server, WSGIRequestHandler
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    # without gunicorn the app is served by werkzeug, which closes connections after each response
+    BaseApplication = None
+
+LISTEN_BACKLOG = 1024
+# request threads of a worker process served by gunicorn
+THREADS = int(os.environ.get("THREADS", 32))
+# seconds an idle keep-alive connection is kept open by gunicorn
+KEEPALIVE_SECONDS = int(os.environ.get("KEEPALIVE_SECONDS", 75))
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """ Request handler without access log, which costs more than a short request. """
+    def log_request(self, code="-", size="-"):
+        pass
+
+def available_cpus():
+    """ Number of cpus of the container cpu limit, os.cpu_count() reports the cpus of the node instead. """
+    cpus = len(os.sched_getaffinity(0))
+    try:
+        # cgroup v2
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, float(quota) / float(period))
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                quota = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if quota > 0:
+                cpus = min(cpus, quota / period)
+        except (OSError, ValueError):
+            pass
+    return max(1, int(cpus + 0.5))
+
+def serve(app, port, workers, warm_paths=()):
+    """ Serve app by worker processes sharing one listening socket, gunicorn threaded workers keeping
+    connections alive if gunicorn is installed, else threaded werkzeug servers. warm_paths are requested
+    once before the socket is opened, so the readiness probe passes only when the app is warm. Dead
+    workers are replaced, SIGTERM stops all of them. """
+    client = app.test_client()
+    for path in warm_paths:
+        client.get(path)
+    if BaseApplication is not None:
+        serve_gunicorn(app, port, workers)
+    else:
+        serve_werkzeug(app, port, workers)
+
+def serve_gunicorn(app, port, workers):
+    """ Serve app by gunicorn gthread workers, which keep idle connections alive for KEEPALIVE_SECONDS. """
+    class Server(BaseApplication):
+        def load_config(self):
+            settings = {
+                "bind": "0.0.0.0:{}".format(port),
+                "workers": workers,
+                "worker_class": "gthread",
+                "threads": THREADS,
+                "keepalive": KEEPALIVE_SECONDS,
+                "backlog": LISTEN_BACKLOG,
+                "preload_app": True
+            }
+            for key, value in settings.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    print("serving on port {} by {} gunicorn worker processes of {} threads".format(port, workers, THREADS))
+    Server().run()
+
+def serve_werkzeug(app, port, workers):
+    """ Serve app by forked threaded werkzeug servers, which close the connection after each response. """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("0.0.0.0", port))
+    sock.listen(LISTEN_BACKLOG)
+    children = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            server = make_server("0.0.0.0", port, app, threaded=True, request_handler=QuietRequestHandler,
+                                 fd=sock.fileno())
+            server.serve_forever()
+            os._exit(0)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for i in range(workers):
+        spawn()
+    print("serving on port {} by {} werkzeug worker processes".format(port, workers))
+    while children:
+        pid, status = os.wait()
+        children.discard(pid)
+        if not stopping:
+            print("worker process {} exited with status {}, restart it".format(pid, status))
+            spawn()
@@ -0,0 +1,153 @@
+import os
+import sys
+import json
+import glob
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from resultwriter import read_records
+
+"""
+Offline analysis of the results of autoscale-testing.py runs. Every run is one results.jsonl file,
+with its rotated segments, in the logs directory. The records of a run are loaded into numpy
+columns and summarized as one JSON line per run:
+
+- time_to_first_scale: seconds from the first record to the first desired replica count above the initial one
+- time_to_max_replicas: seconds from the first record to current replicas reaching max replicas
+- replicas: replica count timeline as [seconds, current_replicas, desired_replicas] change points
+- latency_by_replicas: server response latency percentiles by the current replica count when it completed.
+  Runs recorded before responses had their completion time use the time the batch was written instead,
+  which is after the last response of the batch
+- pods_by_node: count of server pods placed on every node, the pods of the deployment scaled by the HPA,
+  or those named with --server-prefix; all pods of the namespace if neither is known
+
+Usage: python analyze-runs.py logs/ [more dirs or results files] [--timeline DIR] [--server-prefix PREFIX]
+       [--workers N]
+"""
+
+RESULTS_SUFFIX = "results.jsonl"
+PERCENTILES = (50, 90, 99)
+
+
+def find_runs(paths):
+    """ Results files of the runs in paths, a path is a results file or a directory of them. """
+    runs = []
+    for path in paths:
+        if os.path.isdir(path):
+            runs += sorted(glob.glob(os.path.join(path, "*" + RESULTS_SUFFIX)))
+        elif os.path.exists(path):
+            runs.append(path)
+    return runs
+
+
+def parse_elapse_time(text):
+    """ Seconds of a timedelta written by str, like 0:00:01.234567. """
+    hours, minutes, seconds = text.split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def load_run(path):
+    """ Columns of the records of a run by record type. """
+    hpa = {"wall": [], "current": [], "desired": [], "max": []}
+    responses = {"wall": [], "latency": []}
+    placements = set()
+    target = None
+    for record in read_records(path):
+        if record["type"] == "hpa":
+            target = record.get("target") or target
+            hpa["wall"].append(record["wall"])
+            # replicas are None until the HPA controller first updates the status, they are nan
+            hpa["current"].append(record["current_replicas"])
+            hpa["desired"].append(record["desired_replicas"])
+            hpa["max"].append(record["max_replicas"])
+        elif record["type"] == "response":
+            responses["wall"].append(record.get("completed", record["wall"]))
+            responses["latency"].append(parse_elapse_time(record["elapse_time"]))
+        elif record["type"] == "pod_event" and record["node_name"]:
+            placements.add((record["pod_name"], record["node_name"]))
+    columns = {
+        "hpa": {key: np.array(values, dtype=float) for key, values in hpa.items()},
+        "responses": {key: np.array(values, dtype=float) for key, values in responses.items()},
+        "placements": placements,
+        "target": target
+    }
+    return columns
+
+
+def first_time(times, mask, start):
+    """ Seconds from start to the first time where mask is true, None if never. """
+    index = np.flatnonzero(mask)
+    return float(times[index[0]] - start) if index.size else None
+
+
+def analyze_run(path, timeline_dir=None, server_prefix=None):
+    """ Summary of one run, see the module documentation. """
+    columns = load_run(path)
+    hpa = columns["hpa"]
+    responses = columns["responses"]
+    name = os.path.basename(path)[:-len(RESULTS_SUFFIX)] or path
+    summary = {"run": name, "path": path, "hpa_records": int(hpa["wall"].size),
+               "responses": int(responses["wall"].size)}
+    if hpa["wall"].size == 0:
+        return summary
+    start = hpa["wall"][0]
+    known = ~np.isnan(hpa["current"])
+    hpa = {key: values[known] for key, values in hpa.items()}
+    if hpa["wall"].size == 0:
+        return summary
+    summary["time_to_first_scale"] = first_time(hpa["wall"], hpa["desired"] > hpa["current"][0], start)
+    summary["time_to_max_replicas"] = first_time(hpa["wall"], hpa["current"] >= hpa["max"], start)
+    summary["max_current_replicas"] = int(hpa["current"].max())
+    # hpa records are only written on change, so they are the change points of the timeline
+    timeline = np.column_stack((hpa["wall"] - start, hpa["current"], hpa["desired"]))
+    summary["replicas"] = [[seconds, int(current), int(desired)] for seconds, current, desired in timeline.tolist()]
+    if timeline_dir is not None:
+        np.savetxt(os.path.join(timeline_dir, name + "timeline.csv"), timeline, delimiter=",",
+                   header="seconds,current_replicas,desired_replicas", comments="", fmt=("%.6f", "%d", "%d"))
+
+    if responses["wall"].size:
+        # replica count when each response completed, responses before the first hpa record get the first one
+        index = np.maximum(np.searchsorted(hpa["wall"], responses["wall"], side="right") - 1, 0)
+        replicas = hpa["current"][index]
+        latency_by_replicas = {}
+        for count in np.unique(replicas):
+            latencies = responses["latency"][replicas == count]
+            stats = {"count": int(latencies.size), "mean": float(latencies.mean())}
+            stats.update({"p{}".format(q): float(value)
+                          for q, value in zip(PERCENTILES, np.percentile(latencies, PERCENTILES))})
+            latency_by_replicas[str(int(count))] = stats
+        summary["latency_by_replicas"] = latency_by_replicas
+
+    # pods of a deployment are named after it, the client pods run in the same namespace
+    if server_prefix is None and columns["target"]:
+        server_prefix = columns["target"] + "-"
+    nodes = np.array([node for pod, node in columns["placements"] if pod.startswith(server_prefix or "")])
+    if nodes.size:
+        names, counts = np.unique(nodes, return_counts=True)
+        summary["pods_by_node"] = {str(node): int(count) for node, count in zip(names, counts)}
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize autoscale-testing.py runs as JSON lines.")
+    parser.add_argument("paths", nargs="+", help="results files or directories of them")
+    parser.add_argument("--timeline", metavar="DIR", help="also write the replica timeline of every run as csv")
+    parser.add_argument("--server-prefix", metavar="PREFIX",
+                        help="name prefix of the server pods, default is the deployment scaled by the HPA")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="runs analyzed in parallel")
+    args = parser.parse_args()
+
+    runs = find_runs(args.paths)
+    if not runs:
+        sys.exit("no {} file found".format(RESULTS_SUFFIX))
+    if args.timeline:
+        os.makedirs(args.timeline, exist_ok=True)
+    # runs are independent, so they are analyzed by several processes
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for summary in executor.map(analyze_run, runs, [args.timeline] * len(runs),
+                                    [args.server_prefix] * len(runs)):
+            print(json.dumps(summary))
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,10 @@ import _thread
 import time
 import subprocess
 import sys
+import threading
+from kubernetes import client, config, watch
+from kubernetes.client.rest import ApiException
+from resultwriter import ResultWriter
 
 """
 - March 7:
@@ -34,78 +38,159 @@ iterate_count = int(sys.argv[1])
 d = datetime.now().strftime('%y-%m-%d_%H-%M-%S')
 test_name = "HPA_test1-"
 
-log_file = os.path.join(os.path.dirname(os.path.realpath(__file__)) + '/logs/' + test_name + str(d) + 'hpa-state.logs')
-pod_node_file = os.path.join(os.path.dirname(os.path.realpath(__file__)) + '/logs/' + test_name + str(d) + 'pod-node-details.logs')
-tmp_file = os.path.join(os.path.dirname(os.path.realpath(__file__)) + '/logs/' + 'hpa.json')
-tmp_file_1 = os.path.join(os.path.dirname(os.path.realpath(__file__)) + '/logs/' + 'hpa_1.json')
-tmp_file_2 = os.path.join(os.path.dirname(os.path.realpath(__file__)) + '/logs/' + 'hpa_2.json')
-server_response_file = os.path.join(os.path.dirname(os.path.realpath(__file__)) + '/logs/' + test_name + str(d) + '-server.log')
-tmp_file_3 = os.path.join(os.path.dirname(os.path.realpath(__file__)) + '/logs/' + 'hpa_3.json')
+# hpa states, pod events, pod nodes and server responses are typed records of one JSON Lines file,
+# load them with resultwriter.read_records
+results_file = os.path.join(os.path.dirname(os.path.realpath(__file__)) + '/logs/' + test_name + str(d) + 'results.jsonl')
+# size of a results segment before it is rotated and compressed
+RESULTS_SEGMENT_BYTES = 64 * 1024 * 1024
+writer = None
+
+# seconds a watch stays open before it is restarted from where it stopped
+WATCH_TIMEOUT = 300
+# seconds to wait for the first state of the HPA
+HPA_WAIT_TIMEOUT = 60
+
+# cluster state kept up to date by the watches, instead of polling kubectl
+state_lock = threading.Lock()
+hpa_state = {}
+hpa_seen = threading.Event()
+# pod name -> {"node_name", "phase", "ready"}
+pod_state = {}
 
 
 def get_url(url):
-    return requests.get(url)
+    response = requests.get(url)
+    # wall clock time the response completed, the records of a batch are written later
+    response.completed = time.time()
+    return response
 
 def generate_load(urls):
     with ThreadPoolExecutor(max_workers=connections_count) as pool:
         response_list = list(pool.map(get_url, urls))
         return response_list
 
-def write_logs(response_from_server,elapse_time,connections_count):
+def write_logs(response_from_server,elapse_time,connections_count,completed):
+    for c in range(0,connections_count):
+        writer.write('response', id=c, elapse_time=elapse_time[c], completed=completed[c],
+                     server_text=response_from_server[c])
+
+
+def load_cluster_config():
+    """ Load the kubectl config like kubectl does, or the service account when run in a pod,
+    return the namespace of the current context. """
     try:
-        attempts = range(0,connections_count)
-        #print("Test results will be captured in {}".format(server_response_file))
-        with open(server_response_file, 'a') as f:
-            f.write('Connections:')
-            for c in attempts:
-                f.write('\n  - id: {}'.format(c))
-                f.write('\n  elapse_time: {}'.format(elapse_time[c]))
-                f.write('\n  server_text: {}'.format(response_from_server[c]))
-                f.write('\n')
-    except FileNotFoundError:
-        print("The directory does not exist")
-
-
-def spinner():
-    #hpa_state_data = []
-    count = 1
+        config.load_kube_config()
+        _, context = config.list_kube_config_contexts()
+        return context["context"].get("namespace", "default")
+    except config.ConfigException:
+        config.load_incluster_config()
+        with open("/var/run/secrets/kubernetes.io/serviceaccount/namespace") as f:
+            return f.read().strip()
+
+
+def write_hpa_state(state, previous):
+    writer.write('hpa', previous_current_replicas=previous.get('current_replicas'),
+                 previous_desired_replicas=previous.get('desired_replicas'), **state)
+
+
+def write_pod_event(event_type, name, state):
+    writer.write('pod_event', event=event_type, pod_name=name, **state)
+
+
+def watch_events(list_func, handle, relist=None, **kwargs):
+    """ Feed every event of a watch on list_func to handle, forever. The watch resumes from the last
+    seen resource version when it times out, and starts over from a full list when that version is
+    too old for the API server or the connection was lost. The objects of a full list are passed to
+    relist, so objects deleted while the watch was down can be dropped, then fed to handle as ADDED. """
+    resource_version = None
     while True:
-        #current_state = {}
-        record_time = datetime.now().strftime('%y%m%d_%H%M%S')
-        os.system('kubectl get hpa {} -o json > {}'.format(kube_hpa, tmp_file))
-        with open(tmp_file, 'r') as input_file:
-            data = json.load(input_file)
-        """current_state = {
-            'date': record_time,
-            'name': data['metadata']['name'],
-            'min_replicas': data['spec']['minReplicas'],
-            'max_replicas': data['spec']['maxReplicas'],
-            'current_replicas': data['status']['currentReplicas'],
-            'desired_replicas': data['status']['desiredReplicas']
-        }"""
-        with open(log_file, 'a') as output_file:
-            output_file.write('\ndate: {}\n'.format(record_time))
-            output_file.write('  name: {}\n'.format(data['metadata']['name']))
-            output_file.write('  min_replicas: {}\n'.format(data['spec']['minReplicas']))
-            output_file.write('  max_replicas: {}\n'.format(data['spec']['maxReplicas']))
-            output_file.write('  current_replicas: {}\n'.format(data['status']['currentReplicas']))
-            output_file.write('  desired_replicas: {}\n'.format(data['status']['desiredReplicas']))
-        """hpa_state_data.append(current_state)
-        if len(hpa_state_data) > 0:
-            with open(log_file, 'a') as output_file:
-                output_file.write(str(hpa_state_data))"""
-        time.sleep(5)
-        
-"""     
-    output_file.write('\n\date: {}\n'.format(record_time))
-    output_file.write('  name: {}\n'.format(data['metadata']['name']))
-            output_file.write('  min_replicas: {}\n'.format(data['spec']['minReplicas']))
-            output_file.write('  max_replicas: {}\n'.format(data['spec']['maxReplicas']))
-            output_file.write('  current_replicas: {}\n'.format(data['status']['currentReplicas']))
-            output_file.write('  desired_replicas: {}\n'.format(data['status']['desiredReplicas']))
-
-"""        
-   
+        try:
+            if resource_version is None:
+                listing = list_func(namespace, **kwargs)
+                if relist is not None:
+                    relist(listing.items)
+                for item in listing.items:
+                    handle('ADDED', item)
+                resource_version = listing.metadata.resource_version
+            stream = watch.Watch().stream(list_func, namespace, resource_version=resource_version,
+                                          timeout_seconds=WATCH_TIMEOUT, **kwargs)
+            for event in stream:
+                resource_version = event['object'].metadata.resource_version
+                handle(event['type'], event['object'])
+        except ApiException as e:
+            if e.status != 410:
+                print("watch error: {}".format(e))
+                time.sleep(1)
+            resource_version = None
+        except Exception as e:
+            # connection to the API server lost
+            print("watch error: {}".format(e))
+            time.sleep(1)
+            resource_version = None
+
+
+def handle_hpa_event(event_type, hpa):
+    """ Record the HPA whenever its replicas or their bounds change. """
+    if event_type == 'DELETED':
+        return
+    state = {
+        'name': hpa.metadata.name,
+        # deployment scaled by the HPA, its pods are named after it
+        'target': hpa.spec.scale_target_ref.name,
+        'min_replicas': hpa.spec.min_replicas,
+        'max_replicas': hpa.spec.max_replicas,
+        'current_replicas': hpa.status.current_replicas,
+        'desired_replicas': hpa.status.desired_replicas
+    }
+    with state_lock:
+        previous = dict(hpa_state)
+        if state == previous:
+            return
+        hpa_state.clear()
+        hpa_state.update(state)
+    hpa_seen.set()
+    write_hpa_state(state, previous)
+
+
+def handle_pod_event(event_type, pod):
+    """ Record a pod whenever it is scheduled, changes phase or readiness, or is deleted. """
+    name = pod.metadata.name
+    state = {
+        'node_name': pod.spec.node_name,
+        'phase': pod.status.phase,
+        'ready': any(condition.type == 'Ready' and condition.status == 'True'
+                     for condition in pod.status.conditions or [])
+    }
+    with state_lock:
+        if event_type == 'DELETED':
+            pod_state.pop(name, None)
+        elif pod_state.get(name) == state:
+            return
+        else:
+            pod_state[name] = state
+    write_pod_event(event_type, name, state)
+
+
+def relist_pods(pods):
+    """ Record pods deleted while the pod watch was down as DELETED. """
+    names = set(pod.metadata.name for pod in pods)
+    with state_lock:
+        deleted = [(name, pod_state.pop(name)) for name in list(pod_state) if name not in names]
+    for name, state in deleted:
+        write_pod_event('DELETED', name, state)
+
+
+def start_monitor():
+    """ Start the watches of the HPA and the pods, and wait for the first state of the HPA. """
+    autoscaling_api = client.AutoscalingV1Api()
+    core_api = client.CoreV1Api()
+    _thread.start_new_thread(watch_events, (autoscaling_api.list_namespaced_horizontal_pod_autoscaler,
+                                            handle_hpa_event), {'field_selector': 'metadata.name=' + kube_hpa})
+    _thread.start_new_thread(watch_events, (core_api.list_namespaced_pod, handle_pod_event, relist_pods))
+    if not hpa_seen.wait(HPA_WAIT_TIMEOUT):
+        sys.exit("HPA {} not found in namespace {} after {} seconds".format(kube_hpa, namespace, HPA_WAIT_TIMEOUT))
+
+
 def current_value(before_load, after_load):
     l1 = []
     l2 = []
@@ -132,13 +217,15 @@ def load_generation_req():
 
     response_from_server = []
     _elapse_time = []
+    _completed = []
 
     req_start_count = 0
     while req_start_count < connections_count:
         response_from_server.append(load[req_start_count].text)
         _elapse_time.append(str(load[req_start_count].elapsed))
+        _completed.append(load[req_start_count].completed)
         req_start_count += 1
-    write_logs(response_from_server, _elapse_time, connections_count)
+    write_logs(response_from_server, _elapse_time, connections_count, _completed)
     pod_node_details()
     time.sleep(180)
     """Implement point 3 here"""
@@ -146,11 +233,9 @@ def load_generation_req():
 
 
 def iteration_fun():
-    os.system('kubectl get hpa {} -o json > {}'.format(kube_hpa, tmp_file_1))
-    with open(tmp_file_1, 'r') as input_file:
-            data = json.load(input_file)
-    current_replicas =  data['status']['currentReplicas']
-    desired_replicas =  data['spec']['maxReplicas']
+    with state_lock:
+        current_replicas = hpa_state['current_replicas']
+        desired_replicas = hpa_state['max_replicas']
 
     if current_replicas < desired_replicas:
         count = 1
@@ -158,29 +243,24 @@ def iteration_fun():
             print("iteration count")
             load_generation_req()
             #print("I am here!")
-            os.system('kubectl get hpa {} -o json > {}'.format(kube_hpa, tmp_file_2))
-            with open(tmp_file_2, 'r') as input_file_1:
-                data_1 = json.load(input_file_1)
-            current_replicas =  data_1['status']['currentReplicas']
-            desired_replicas =  data_1['spec']['maxReplicas']
+            with state_lock:
+                current_replicas = hpa_state['current_replicas']
+                desired_replicas = hpa_state['max_replicas']
             count += 1
 
 
 def pod_node_details():
-    os.system('kubectl get pods -o json > {}'.format(tmp_file_3))
-    record_time = datetime.now().strftime('%y%m%d_%H%M%S')
-    with open(tmp_file_3, 'r') as input_file_1:
-        data = json.load(input_file_1)
-    with open(pod_node_file, 'a') as output_file:
-        output_file.write('\ndate: {}\n'.format(record_time))
-        for d in data['items']:
-            output_file.write('  pod_name: {}\n'.format(d['metadata']['name']))
-            output_file.write('  node_name: {}\n'.format(d['spec']['nodeName']))
+    with state_lock:
+        pods = [{'pod_name': name, 'node_name': state['node_name']} for name, state in sorted(pod_state.items())]
+    writer.write('pod_nodes', pods=pods)
 
 
 
 if __name__ == "__main__":
-    _thread.start_new_thread(spinner, ())
+    # records are written in batches, and the rest at exit
+    writer = ResultWriter(results_file, max_bytes=RESULTS_SEGMENT_BYTES)
+    namespace = load_cluster_config()
+    start_monitor()
     #print('hello')
     load_generation_req()
     """os.system('kubectl get hpa {} -o json > {}'.format(kube_hpa, tmp_file_1))
@@ -191,12 +271,6 @@ if __name__ == "__main__":
     print(current_replicas)
     print(desired_replicas)"""
     iteration_fun()
-    
-    """ File Cleanup """
-    os.remove(tmp_file)
-    os.remove(tmp_file_1)
-    os.remove(tmp_file_2)
-    os.remove(tmp_file_3)
 
 
         
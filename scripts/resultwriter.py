@@ -0,0 +1,147 @@
+import os
+import gzip
+import json
+import time
+import atexit
+import shutil
+import threading
+
+
+class ResultWriter:
+    """
+    Writer of typed result records as JSON Lines, like
+    {"type": "hpa", "wall": time.time(), "mono": time.monotonic(), ..fields of the record}
+    The file is kept open and records are batched in memory, a background thread writes them every
+    flush_interval seconds, or as soon as batch_size records are pending, and at close or exit.
+    With max_bytes, the file is rotated when it grows past it, rotated segments are named like
+    results.00001.jsonl and are gzip compressed if compress is set. read_records loads them all in order.
+    """
+
+    def __init__(self, path, flush_interval=1.0, batch_size=1000, max_bytes=0, compress=True):
+        """
+        :param path: path of the current segment, a .jsonl file
+        :param flush_interval: seconds between writes of pending records
+        :param batch_size: pending records which trigger a write before the interval
+        :param max_bytes: size of a segment which triggers a rotation, 0 never rotates
+        :param compress: gzip rotated segments
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.compress = compress
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(path, 'a')
+        self.size = self.file.tell()
+        self.segment = len(segment_paths(path))
+        self.pending = []
+        self.lock = threading.Lock()
+        # serializes writes to the file of the flush thread and of close
+        self.file_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.closed = False
+        self.thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, record_type, **fields):
+        """ Queue one record of record_type, stamped with the wall clock and monotonic time of the call. """
+        record = {"type": record_type, "wall": time.time(), "mono": time.monotonic()}
+        record.update(fields)
+        with self.lock:
+            self.pending.append(record)
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.wake.set()
+
+    def flush(self):
+        """ Write pending records to the file. """
+        with self.lock:
+            records, self.pending = self.pending, []
+        if not records:
+            return
+        # values json can not encode are written by their str
+        lines = [json.dumps(record, default=str) + "\n" for record in records]
+        with self.file_lock:
+            if self.file.closed:
+                return
+            # one write call per batch, or per segment when the batch fills the segment
+            start = 0
+            size = self.size
+            for end, line in enumerate(lines, 1):
+                size += len(line)
+                if self.max_bytes and size >= self.max_bytes:
+                    self._write(lines[start:end])
+                    self._rotate()
+                    start = end
+                    size = 0
+            self._write(lines[start:])
+
+    def _write(self, lines):
+        data = "".join(lines)
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+
+    def _rotate(self):
+        self.file.close()
+        self.segment += 1
+        root, ext = os.path.splitext(self.path)
+        segment = "{}.{:05d}{}".format(root, self.segment, ext)
+        os.replace(self.path, segment)
+        if self.compress:
+            with open(segment, 'rb') as src, gzip.open(segment + ".gz", 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(segment)
+        self.file = open(self.path, 'a')
+        self.size = 0
+
+    def _flush_loop(self):
+        while not self.closed:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+
+    def close(self):
+        """ Write pending records and close the file, also called at exit. """
+        if self.closed:
+            return
+        self.closed = True
+        self.wake.set()
+        self.thread.join()
+        self.flush()
+        with self.file_lock:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def segment_paths(path):
+    """ Rotated segments of the results file of path, oldest first. """
+    root, ext = os.path.splitext(path)
+    directory = os.path.dirname(os.path.abspath(path))
+    prefix = os.path.basename(root) + "."
+    segments = []
+    for name in os.listdir(directory):
+        if not name.startswith(prefix):
+            continue
+        index = name[len(prefix):].split(".", 1)[0]
+        if index.isdigit() and name[len(prefix) + len(index):] in (ext, ext + ".gz"):
+            segments.append((int(index), os.path.join(directory, name)))
+    return [segment for _, segment in sorted(segments)]
+
+
+def read_records(path, record_type=None):
+    """ Generate the records of the rotated segments and the current segment of path in order,
+    only those of record_type if given. """
+    for segment in segment_paths(path) + ([path] if os.path.exists(path) else []):
+        opener = gzip.open if segment.endswith(".gz") else open
+        with opener(segment, 'rt') as f:
+            for line in f:
+                record = json.loads(line)
+                if record_type is None or record["type"] == record_type:
+                    yield record
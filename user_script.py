@@ -9,12 +9,20 @@
 #
 #
 
+import os
 import time
 import json
+import math
 from logging import Logger
 from threading import Thread, Event, Timer
+from urllib.parse import urlencode
 import requests
 from kubernetes.client import AutoscalingV1Api, AutoscalingV2beta2Api
+try:
+    from kubernetes.client import AutoscalingV2Api
+except ImportError:
+    # autoscaling/v2 is supported by kubernetes client 23 and later
+    AutoscalingV2Api = None
 
 from cloudsure.tpkg_core.tcase.error import (TestFailure, TestInputError,
                                              TestRunError)
@@ -27,6 +35,32 @@ from cloudsure.tpkg_core.user_script.types.user_script_v1 import UserScriptV1
 from cloudsure.providers.nfv.k8s.client_initializer import ClientInitializer
 
 
+# field of the metric source by metric type of v2beta2 and v2 HPA
+METRIC_SOURCE_FIELDS = {
+    "Resource": "resource",
+    "ContainerResource": "containerResource",
+    "Pods": "pods",
+    "Object": "object",
+    "External": "external"
+}
+
+
+def hpa_metric_name(metric: dict) -> str:
+    '''
+    Name of a metric spec or metric status of v2beta2 and v2 HPA, in the camel case form of the API.
+    '''
+    source = metric[METRIC_SOURCE_FIELDS[metric["type"]]]
+    # resource metrics are named by the resource, others by their metric identifier
+    return source["name"] if "name" in source else source["metric"]["name"]
+
+
+def parse_quantity(value: str) -> float:
+    '''
+    Parse a kubernetes quantity in milli units or plain, like 12500m or 12.5.
+    '''
+    return float(value[:-1]) / 1000 if value.endswith("m") else float(value)
+
+
 class MonitorThread(Thread):
     def __init__(self, script, start_time, cpu_util, http_rate, timeout=180, query_interval=1):
         self.script = script
@@ -58,6 +92,92 @@ class MonitorThread(Thread):
         return
 
 
+class ClientStreamThread(Thread):
+    '''
+    Subscribe to the per-interval stats stream of http client and record every interval. A new rate
+    changes the profile of the running client, so the stream goes on across rates, it only ends by
+    itself when the client is removed by /stop. stop ends it, start_http_client_stream does so before
+    subscribing again, so the intervals of every rate are recorded under the label of that rate.
+    '''
+    def __init__(self, script, url, label):
+        super().__init__(daemon=True)
+        self.script = script
+        self.url = url
+        self.label = label
+        self.resp = None
+        self.run_flag = True
+
+    def run(self):
+        try:
+            self.resp = requests.get(self.url, stream=True, timeout=(10, None))
+            for line in self.resp.iter_lines():
+                if not self.run_flag:
+                    break
+                if line:
+                    self.script._iq.write(label=self.label, value=line.decode())
+        except requests.RequestException as e:
+            if self.run_flag:
+                self.script._log.error("http client stats stream fail, err: {}".format(e))
+        finally:
+            if self.resp is not None:
+                self.resp.close()
+
+    def stop(self):
+        self.run_flag = False
+        if self.resp is not None:
+            self.resp.close()
+
+
+class DutyCycleSpreadThread(Thread):
+    '''
+    Hold a deployment-wide cpu load spread evenly on the ready server pods by their duty cycle burner.
+    The load is spread again whenever the ready pods change, so scale out lowers the load of each pod
+    like traffic through the server service would.
+    '''
+    def __init__(self, script, millicores, duration, label):
+        super().__init__(daemon=True)
+        self.script = script
+        self.millicores = millicores
+        self.duration = duration
+        self.label = label
+        self.pod_ips = []
+        self.run_flag = True
+
+    def burn_url(self, pod_ip):
+        # construct redirect url via platform service as http proxy
+        return "http://" + self.script.user_args["platform_svc_ip"] + "/redirect/" + pod_ip + ":8080/burn"
+
+    def run(self):
+        end = time.monotonic() + self.duration
+        while self.run_flag and time.monotonic() < end:
+            pod_ips = sorted(pod_status["pod_ip"]
+                             for pod_status in self.script.get_server_pods_status(self.script.deployment_name)
+                             if pod_status["ready_time"] is not None and pod_status["pod_ip"])
+            if pod_ips and pod_ips != self.pod_ips:
+                share = self.millicores / len(pod_ips)
+                seconds = end - time.monotonic()
+                for pod_ip in pod_ips:
+                    try:
+                        resp = requests.post(self.burn_url(pod_ip), params={"millicores": share, "seconds": seconds})
+                        if 200 != resp.status_code:
+                            self.script._log.error("start duty cycle burner fail, err: {}".format(resp.text))
+                    except requests.RequestException as e:
+                        self.script._log.error("start duty cycle burner fail, err: {}".format(e))
+                self.script._iq.write(label=self.label, value=str({"pods": len(pod_ips), "millicores_per_pod": share,
+                                                                    "timestamp": time.time()}))
+                self.pod_ips = pod_ips
+            time.sleep(int(self.script.user_args["scaling_query_interval"]))
+
+    def stop(self):
+        self.run_flag = False
+        self.join()
+        for pod_ip in self.pod_ips:
+            try:
+                requests.delete(self.burn_url(pod_ip))
+            except requests.RequestException as e:
+                self.script._log.error("stop duty cycle burner fail, err: {}".format(e))
+
+
 class UserScript(UserScriptV1):
     """User Script class.
 
@@ -74,14 +194,61 @@ class UserScript(UserScriptV1):
         (str) platform_svc_ip: the ip address of pre created platform service. the rest API to http client will be 
             sent to this proxy then forwarded to http client pod.
         (str) clientName: identify prefix of client resources deployed from chart file, must be configured with same value
-            of clientName key in values.yaml, used to qurey deployed client resources in cluster.
+            of clientName key in values.yaml, used to qurey deployed client resources in cluster. When clientReplicaCount
+            in values.yaml is more than 1, the http rate is split across all client pods.
         (str) serverName: identify prefix of server resources deployed from chart file, must be configured with same value
             of serverName key in values.yaml, used to qurey deployed server resources in cluster.
-        (list) cpu_util_list: the target cpu utilization of HPA
+        (list) cpu_util_list: the target cpu utilization of HPA, with hpa_metrics an item may be null for
+            HPA scaling only on the metrics of hpa_metrics
         (list) http_rate_list: the list of http rate to be iterated to trigger autoscaling, rate unit: reqs/min
         (int) watch_timeout: timeout seconds value of each watching for utilization and load rate combination
         (int) scaling_query_interval: the interval senconds of querying current scaling status
-        (str) autoscaling_version: must be align with HPA version used in Helm chart
+        (str) autoscaling_version: must be align with HPA version used in Helm chart, v1, v2beta2 or v2
+        (list) hpa_metrics: optional, more metric targets of v2beta2 and v2 HPA besides the cpu utilization of
+            cpu_util_list, in the form of the HPA spec, like [{"type": "Pods", "pods": {"metric": {"name":
+            "http_server_requests_per_second"}, "target": {"type": "AverageValue", "averageValue": "20"}}}].
+            server.py exports http_server_requests_per_second and http_server_requests_in_flight of each pod
+            on /custom-metrics for a custom metrics API, they are recorded for every server pod. HPA status
+            records the current value of every metric.
+        (float) http_cpu_ms: optional, cpu time each http request burns on the server in milliseconds, calibrated
+            by the server on its node at startup, so a http rate means the same cpu load on any node. By default
+            each request runs a fixed loop count whose cpu time depends on the node.
+        (dict) http_payload: optional, http requests fetch a payload of the server instead of burning cpu,
+            like {"bytes": 1048576, "chunk": 65536}, chunk is optional and streams the payload in chunks of
+            that size. Received bytes and throughput are reported by server pod in http client stats.
+        (str) http_arrival: optional, arrival process of http requests, constant or poisson, default is constant
+        (dict) http_rate_profile: optional, time based http rate profile uploaded to http client in one call instead
+            of iterating http_rate_list, like {"segments": [{"shape": "ramp", "duration": 300, "from": 60, "to": 6000}],
+            "loop": false}, supported shapes are constant, ramp, step, sine and spike, see RateProfile in client.py.
+            watch_timeout should cover the profile duration.
+        (dict) http_trace: optional, recorded request trace replayed by http client instead of http_rate_list or
+            http_rate_profile, like {"file": "/path/trace.csv.gz", "speed": 1.0, "loop": false}, file is a local
+            trace file uploaded to every http client pod before the test, each line of it is one request like
+            "timestamp,path,count", see TraceProfile in client.py. watch_timeout should cover the trace duration.
+        (dict) http_calibration: optional, measure the max rate one http client process sustains against the
+            server before the test, like {"max_rate": 60000, "step_duration": 10, "max_latency": 1.0}, see POST
+            /calibrate in client.py. Rates of http_rate_list above the ceiling are handled by http_rate_over_ceiling.
+        (str) http_rate_over_ceiling: optional, used with http_calibration, refuse to fail the test before it
+            starts, or shard (default) to generate the rate with several processes in each client pod as long
+            as the pod has enough cpus for them.
+        (dict) http_connection_rotation: optional, policy of http client to replace keep-alive connections, so
+            the load spreads onto server pods added by scale out, like {"max_requests": 1000, "max_age": 30}.
+            Connections are also replaced when the server pod count changes, endpoints_service defaults to the
+            server headless service, see RotationPolicy in client.py.
+        (dict) http_overload_policy: optional, what http client does with requests due while all its connections
+            are busy, like {"policy": "shed", "max_lateness": 1.0}, policy is queue (default), shed or catchup, see
+            OverloadPolicy in client.py. Dropped and late requests are counted in http client stats.
+        (list) http_workload_mix: optional, weighted mix of server workloads run by http requests instead of
+            /cpu, like [{"workload": "cpu", "params": {"count": 100000}, "weight": 3}, {"workload": "memory",
+            "params": {"mib": 64, "seconds": 1}, "weight": 1}], workloads are cpu, memory, disk and mix, see
+            server.py for their parameters. Stats and consumed resources are reported by workload.
+        (list) cpu_load_steps: optional, deployment-wide cpu load steps held by the duty cycle burner of the
+            server pods instead of http traffic, like [{"millicores": 1500, "duration": 300}, ..], each step
+            is spread evenly on the ready server pods and spread again when they change, and is monitored for
+            its duration, so HPA reaction to exact utilization steps can be measured.
+        (bool) http_client_stream: optional, subscribe once to the stats stream of http client and record
+            every interval of it instead of polling the stats in each query, default is false. The interval
+            records and HPA status both carry wall clock timestamps to line them up.
     """
 
     # monitor duration for each new http rate load,
@@ -126,26 +293,15 @@ class UserScript(UserScriptV1):
                     "targetCPUUtilizationPercentage": cpu_util
                 }
             }
-        elif self.user_args["autoscaling_version"] == "v2beta2":
+        elif self.user_args["autoscaling_version"] in ("v2beta2", "v2"):
             body = {
                 "spec": {
-                    "metrics": [
-                        {
-                            "type": "Resource",
-                            "resource": {
-                                "name": "cpu",
-                                "target": {
-                                    "type": "Utilization",
-                                    "averageUtilization": cpu_util
-                                }
-                            }
-                        }
-                    ]
+                    "metrics": self.get_hpa_metric_specs(cpu_util)
                 }
             }
         else:
             raise TestRunError(
-                "unsupported HPA version {}".format(autoscaler.api_version))
+                "unsupported HPA version {}".format(self.user_args["autoscaling_version"]))
 
         try:
             autoscaler = self.autoscaling_api.patch_namespaced_horizontal_pod_autoscaler(
@@ -153,28 +309,60 @@ class UserScript(UserScriptV1):
                 self.user_args["k8s_namespace"],
                 body)
         except ValueError as e:
-            if str(exception) == 'Invalid value for `conditions`, must not be `None`':
+            if str(e) == 'Invalid value for `conditions`, must not be `None`':
                 self._log.info('Skipping invalid \'conditions\' value...')
         except Exception as e:
             self._log.error("update hpa error: %s" % str(e))
-            raise TestRunError("update target cpu util %d fail!" % cpu_util)
+            raise TestRunError("update target cpu util %s fail!" % cpu_util)
 
-        self._log.info("update target cpu util %d complete!" % cpu_util)
+        self._log.info("update target cpu util %s complete!" % cpu_util)
 
         return
 
-    def get_http_client_pod_ip(self):
+    def get_hpa_metric_specs(self, cpu_util) -> list:
+        '''
+        Metric targets of v2beta2 and v2 HPA, the cpu utilization target followed by hpa_metrics.
+        A cpu resource metric of hpa_metrics is replaced by cpu_util, no cpu target if cpu_util is None.
+        '''
+        specs = []
+        if cpu_util is not None:
+            specs.append({
+                "type": "Resource",
+                "resource": {
+                    "name": "cpu",
+                    "target": {
+                        "type": "Utilization",
+                        "averageUtilization": cpu_util
+                    }
+                }
+            })
+        for metric in self.user_args.get("hpa_metrics") or []:
+            if metric["type"] == "Resource" and hpa_metric_name(metric) == "cpu":
+                continue
+            specs.append(metric)
+        if not specs:
+            raise TestInputError("HPA has no metric target, cpu_util is null and hpa_metrics is empty")
+        return specs
+
+    def get_http_client_pod_ips(self) -> list:
+        '''
+        Get ip of all running http client pods, sorted by pod name.
+        '''
         client_deployment_name = self.user_args["clientName"] + "-deployment"
         pod_list = self.core_v1_api.list_namespaced_pod(namespace=self.user_args["k8s_namespace"],
                                                         label_selector="app=http-client")
-        pod = None
+        pods = []
         for item in pod_list.items:
-            if item.metadata.name.startswith(client_deployment_name):
-                pod = item
-        if not pod:
+            if item.metadata.name.startswith(client_deployment_name) and item.status.pod_ip \
+                    and item.status.phase == "Running":
+                pods.append(item)
+        if not pods:
             raise TestRunError("can't find client pod resource.")
 
-        return pod.status.pod_ip
+        return [pod.status.pod_ip for pod in sorted(pods, key=lambda pod: pod.metadata.name)]
+
+    def get_http_client_pod_ip(self):
+        return self.get_http_client_pod_ips()[0]
 
     '''
     def get_http_client_pod_ip(self):
@@ -197,11 +385,14 @@ class UserScript(UserScriptV1):
     def start_http_client_rate(self, rate):
         # construct redirect url via platform service as http proxy
         url = "http://" + self.user_args["platform_svc_ip"] + \
-            "/redirect/" + self.http_client_pod_ip + ":8080/start"
+            "/redirect/" + self.http_client_pod_ip + ":8080" + self.http_client_api + "/start"
         payload = {
-            "target_url": "http://" + self.http_server_svc_ip + "/cpu",
-            "rate": rate
+            "target_url": self.http_target_url,
+            "rate": rate,
+            "arrival": self.user_args.get("http_arrival", "constant"),
+            "workers": self.http_client_workers
         }
+        self.add_http_client_options(payload)
 
         # need to align with http client api definition
         resp = requests.post(url, json=payload)
@@ -211,12 +402,133 @@ class UserScript(UserScriptV1):
             raise TestRunError("start http client rate fail, err: {}".format(resp.text))
         return
 
+    def add_http_client_options(self, payload):
+        '''
+        Add the optional fields shared by every start request of http client to payload.
+        '''
+        if self.http_client_api:
+            payload["peers"] = self.http_client_pod_ips
+        if self.user_args.get("http_connection_rotation"):
+            payload["rotation"] = self.get_http_connection_rotation()
+        if self.user_args.get("http_overload_policy"):
+            payload["overload"] = self.user_args["http_overload_policy"]
+        if self.user_args.get("http_workload_mix"):
+            payload["workloads"] = self.user_args["http_workload_mix"]
+
+    def get_http_connection_rotation(self) -> dict:
+        rotation = dict(self.user_args["http_connection_rotation"])
+        rotation.setdefault("endpoints_service", self.user_args["serverName"] + "-headless")
+        return rotation
+
+    def start_http_client_profile(self, profile):
+        # construct redirect url via platform service as http proxy
+        url = "http://" + self.user_args["platform_svc_ip"] + \
+            "/redirect/" + self.http_client_pod_ip + ":8080" + self.http_client_api + "/start"
+        payload = {
+            "target_url": self.http_target_url,
+            "profile": profile,
+            "arrival": self.user_args.get("http_arrival", "constant"),
+            "workers": self.http_client_workers
+        }
+        self.add_http_client_options(payload)
+
+        # need to align with http client api definition
+        resp = requests.post(url, json=payload)
+        if 200 != resp.status_code:
+            self._log.error(
+                "start http client profile fail, err: {}".format(resp.text))
+            raise TestRunError("start http client profile fail, err: {}".format(resp.text))
+        return
+
+    def upload_http_trace(self, file) -> str:
+        '''
+        Upload the trace file to every http client pod, the file is streamed, not read into memory.
+        :return: path of the trace file in http client pods
+        '''
+        path = None
+        for pod_ip in self.http_client_pod_ips:
+            # construct redirect url via platform service as http proxy
+            url = "http://" + self.user_args["platform_svc_ip"] + \
+                "/redirect/" + pod_ip + ":8080/traces/" + os.path.basename(file)
+            with open(file, "rb") as f:
+                resp = requests.put(url, data=f)
+            if 200 != resp.status_code:
+                self._log.error(
+                    "upload http trace fail, err: {}".format(resp.text))
+                raise TestRunError("upload http trace fail, err: {}".format(resp.text))
+            path = resp.json()["path"]
+        return path
+
+    def start_http_client_trace(self, trace):
+        # construct redirect url via platform service as http proxy
+        url = "http://" + self.user_args["platform_svc_ip"] + \
+            "/redirect/" + self.http_client_pod_ip + ":8080" + self.http_client_api + "/start"
+        payload = {
+            "target_url": self.http_target_url,
+            "trace": trace,
+            "arrival": self.user_args.get("http_arrival", "constant"),
+            "workers": self.http_client_workers
+        }
+        self.add_http_client_options(payload)
+
+        # need to align with http client api definition
+        resp = requests.post(url, json=payload)
+        if 200 != resp.status_code:
+            self._log.error(
+                "start http client trace fail, err: {}".format(resp.text))
+            raise TestRunError("start http client trace fail, err: {}".format(resp.text))
+        return
+
+    def calibrate_http_client(self) -> dict:
+        '''
+        Measure the max rate one process of the first http client pod sustains against the server,
+        all client pods are expected to have the same resources.
+        '''
+        # construct redirect url via platform service as http proxy, calibration is done by the pod itself
+        url = "http://" + self.user_args["platform_svc_ip"] + \
+            "/redirect/" + self.http_client_pod_ip + ":8080/calibrate"
+        payload = dict(self.user_args["http_calibration"])
+        payload["target_url"] = self.http_target_url
+        payload["arrival"] = self.user_args.get("http_arrival", "constant")
+        payload["workers"] = 1
+        resp = requests.post(url, json=payload)
+        if 200 != resp.status_code:
+            self._log.error("start http client calibration fail, err: {}".format(resp.text))
+            raise TestRunError("start http client calibration fail, err: {}".format(resp.text))
+        while True:
+            time.sleep(int(self.user_args["scaling_query_interval"]))
+            resp = requests.get(url)
+            if 200 != resp.status_code:
+                raise TestRunError("get http client calibration fail, err: {}".format(resp.text))
+            calibration = resp.json()
+            if calibration["complete"]:
+                return calibration
+
+    def plan_http_client_workers(self, calibration) -> int:
+        '''
+        Number of processes each http client pod needs to generate the highest rate of http_rate_list,
+        the test is refused when a rate can't be delivered.
+        '''
+        ceiling = calibration["max_sustainable_rate"]
+        if not ceiling:
+            raise TestRunError("http client can't sustain any calibrated rate: {}".format(calibration["steps"]))
+        # the rate is split evenly across client pods
+        rate = max(self.user_args["http_rate_list"]) / len(self.http_client_pod_ips)
+        workers = int(math.ceil(rate / ceiling))
+        if workers <= 1:
+            return 1
+        if self.user_args.get("http_rate_over_ceiling", "shard") != "shard" or workers > calibration["cpus"]:
+            raise TestInputError(
+                "http rate {} reqs/min per client pod exceeds what it can deliver, ceiling of one process: {}, "
+                "cpus: {}".format(rate, ceiling, calibration["cpus"]))
+        return workers
+
     def stop_http_client(self):
         # construct redirect url via platform service as http proxy
         url = "http://" + self.user_args["platform_svc_ip"] + \
-            "/redirect/" + self.http_client_pod_ip + ":8080/stop"
+            "/redirect/" + self.http_client_pod_ip + ":8080" + self.http_client_api + "/stop"
         payload = {
-            "target_url": "http://" + self.http_server_svc_ip + "/cpu",
+            "target_url": self.http_target_url,
         }
         # need to align with http client api definition
         resp = requests.post(url, json=payload)
@@ -226,6 +538,40 @@ class UserScript(UserScriptV1):
             raise TestRunError("stop http client rate fail, err: {}".format(resp.text))
         return
 
+    def get_http_client_stats(self, intervals=0) -> dict:
+        '''
+        Get traffic stats of http client, including latency quantiles, error counts, achieved rate
+        and cpu load duration reported by server.
+        '''
+        # construct redirect url via platform service as http proxy
+        url = "http://" + self.user_args["platform_svc_ip"] + \
+            "/redirect/" + self.http_client_pod_ip + ":8080" + self.http_client_api + "/stats"
+        resp = requests.get(url, params={"intervals": intervals})
+        if 200 != resp.status_code:
+            self._log.error(
+                "get http client stats fail, err: {}".format(resp.text))
+            raise TestRunError("get http client stats fail, err: {}".format(resp.text))
+        return resp.json()
+
+    def start_http_client_stream(self, http_rate):
+        '''
+        Start subscriber of http client stats stream if it is enabled.
+        '''
+        self.stop_http_client_stream()
+        if not self.user_args.get("http_client_stream"):
+            return
+        # construct redirect url via platform service as http proxy
+        url = "http://" + self.user_args["platform_svc_ip"] + \
+            "/redirect/" + self.http_client_pod_ip + ":8080" + self.http_client_api + "/stream"
+        self.stream_thread = ClientStreamThread(
+            self, url, "HTTP client interval stats under CPU util: {}, Http rate: {}".format(self.cpu_util, http_rate))
+        self.stream_thread.start()
+
+    def stop_http_client_stream(self):
+        if self.stream_thread is not None:
+            self.stream_thread.stop()
+            self.stream_thread = None
+
     def get_deployment_metrics(self, deployment_name) -> list:
         '''
         Get metrics of pods in deployment.
@@ -258,10 +604,30 @@ class UserScript(UserScriptV1):
             "hpa_name": hpa_name,
             "hpa_version": autoscaler.api_version,
             "current_replicas": autoscaler.status.current_replicas,
-            "desired_replicas": autoscaler.status.desired_replicas
+            "desired_replicas": autoscaler.status.desired_replicas,
+            "timestamp": time.time()
         }
         if autoscaler.api_version == "autoscaling/v1":
             hpa_status["current_cpu_utilization_percentage"] = autoscaler.status.current_cpu_utilization_percentage
+        elif autoscaler.api_version in ("autoscaling/v2beta2", "autoscaling/v2"):
+            # target and current value of every metric, in the camel case form of the API
+            specs = self.api_client.sanitize_for_serialization(autoscaler.spec.metrics or [])
+            statuses = self.api_client.sanitize_for_serialization(autoscaler.status.current_metrics or [])
+            current = {(metric["type"], hpa_metric_name(metric)): metric[METRIC_SOURCE_FIELDS[metric["type"]]]
+                       for metric in statuses}
+            hpa_status["metrics"] = []
+            for spec in specs:
+                name = hpa_metric_name(spec)
+                status = current.get((spec["type"], name), {})
+                hpa_status["metrics"].append({
+                    "type": spec["type"],
+                    "name": name,
+                    "target": spec[METRIC_SOURCE_FIELDS[spec["type"]]].get("target"),
+                    "current": status.get("current")
+                })
+                if spec["type"] == "Resource" and name == "cpu":
+                    hpa_status["current_cpu_utilization_percentage"] = \
+                        (status.get("current") or {}).get("averageUtilization")
         else:
             raise TestRunError(
                 "unsupported HPA version {}".format(autoscaler.api_version))
@@ -275,18 +641,60 @@ class UserScript(UserScriptV1):
             if item.metadata.name.startswith(self.user_args["serverName"] + "-deployment"):
                 pod_status = {
                     "pod_name": item.metadata.name,
+                    "pod_ip": item.status.pod_ip,
                     "node": item.spec.node_name,
-                    "phase": item.status.phase
+                    "phase": item.status.phase,
+                    "ready_time": None
                 }
+                for condition in item.status.conditions or []:
+                    if condition.type == "Ready" and condition.status == "True":
+                        pod_status["ready_time"] = condition.last_transition_time.timestamp()
                 pod_status_list.append(pod_status)
 
         return pod_status_list
 
-    def monitor_hpa_status(self, cpu_util, http_rate):
+    def get_server_pods_custom_metrics(self) -> dict:
+        '''
+        Get custom metrics exported by each ready server pod, like
+        {pod name: {"http_server_requests_per_second": 12.5, "http_server_requests_in_flight": 3.0}, ..}
+        '''
+        pods_metrics = {}
+        for pod_status in self.get_server_pods_status(self.deployment_name):
+            if pod_status["ready_time"] is None or not pod_status["pod_ip"]:
+                continue
+            # construct redirect url via platform service as http proxy
+            url = "http://" + self.user_args["platform_svc_ip"] + \
+                "/redirect/" + pod_status["pod_ip"] + ":8080/custom-metrics"
+            try:
+                resp = requests.get(url)
+            except requests.RequestException as e:
+                self._log.error("get server pod custom metrics fail, err: {}".format(e))
+                continue
+            if 200 != resp.status_code:
+                self._log.error("get server pod custom metrics fail, err: {}".format(resp.text))
+                continue
+            pods_metrics[pod_status["pod_name"]] = {item["metricName"]: parse_quantity(item["value"])
+                                                    for item in resp.json()["items"]}
+        return pods_metrics
+
+    def get_server_pods_first_request_delay(self) -> dict:
+        '''
+        Get seconds from each server pod ready to its first request served to http client, pods which
+        have not served any request yet are not included.
+        '''
+        first_seen = self.get_http_client_stats()["first_seen"]
+        delays = {}
+        for pod_status in self.get_server_pods_status(self.deployment_name):
+            if pod_status["pod_name"] in first_seen and pod_status["ready_time"] is not None:
+                delays[pod_status["pod_name"]] = first_seen[pod_status["pod_name"]] - pod_status["ready_time"]
+        return delays
+
+    def monitor_hpa_status(self, cpu_util, http_rate, timeout=None):
+        timeout = timeout or self.user_args["watch_timeout"]
         iter_start_time = time.monotonic()
         while True:
             now = time.monotonic()
-            if (now - iter_start_time) > self.user_args["watch_timeout"]:
+            if (now - iter_start_time) > timeout:
                 self._iq.write(label="Monitor duration timeout",
                                value="start time: {}, end time: {}".format(iter_start_time, now))
                 break
@@ -298,6 +706,14 @@ class UserScript(UserScriptV1):
             pod_metric_list = self.get_deployment_metrics(self.deployment_name)
             self._iq.write(label="POD metrics under CPU util: {}, Http rate: {}".format(cpu_util, http_rate),
                            value=str(pod_metric_list))
+            if self.user_args.get("hpa_metrics"):
+                self._iq.write(label="POD custom metrics under CPU util: {}, Http rate: {}".format(cpu_util, http_rate),
+                               value=str({"pods": self.get_server_pods_custom_metrics(), "timestamp": time.time()}))
+            # query http client traffic stats if they are not streamed
+            if self.stream_thread is None and not self.user_args.get("cpu_load_steps"):
+                client_stats = self.get_http_client_stats()
+                self._iq.write(label="HTTP client stats under CPU util: {}, Http rate: {}".format(cpu_util, http_rate),
+                               value=str(client_stats))
             # query pod and compute node association
             pod_status_list = self.get_server_pods_status(self.deployment_name)
             self._iq.write(label="POD node association", value=str(pod_status_list))
@@ -326,9 +742,13 @@ class UserScript(UserScriptV1):
             self.autoscaling_api = AutoscalingV1Api(self.api_client)
         elif self.user_args["autoscaling_version"] == "v2beta2":
             self.autoscaling_api = AutoscalingV2beta2Api(self.api_client)
+        elif self.user_args["autoscaling_version"] == "v2" and AutoscalingV2Api is not None:
+            self.autoscaling_api = AutoscalingV2Api(self.api_client)
         else:
             raise TestInputError("unsupported HPA version {}".format(
                 self.user_args["autoscaling_version"]))
+        if self.user_args.get("hpa_metrics") and self.user_args["autoscaling_version"] == "v1":
+            raise TestInputError("hpa_metrics needs autoscaling version v2beta2 or v2")
 
         # construct resources name which will be used afterwards
         self.deployment_name = self.user_args["serverName"] + "-deployment"
@@ -338,35 +758,96 @@ class UserScript(UserScriptV1):
 
         # acquire http client and http server svc ip.
         # Don't need wait because wait option has been set in helm install command
-        self.http_client_pod_ip = self.get_http_client_pod_ip()
-        self._log.info("http_client_pod_ip: %s" % self.http_client_pod_ip)
+        self.http_client_pod_ips = self.get_http_client_pod_ips()
+        self.http_client_pod_ip = self.http_client_pod_ips[0]
+        self._log.info("http_client_pod_ips: %s" % self.http_client_pod_ips)
+        # with several http client pods, the first one coordinates the traffic of all of them
+        self.http_client_api = "/coordinator" if len(self.http_client_pod_ips) > 1 else ""
         self.http_server_svc_ip = self.get_http_server_svc_ip()
         self._log.info("http_server_svc_ip: %s" % self.http_server_svc_ip)
+        self.http_target_url = "http://" + self.http_server_svc_ip + "/cpu"
+        if self.user_args.get("http_payload"):
+            self.http_target_url = "http://" + self.http_server_svc_ip + "/payload?" + \
+                urlencode(self.user_args["http_payload"])
+        elif self.user_args.get("http_cpu_ms"):
+            self.http_target_url += "?cpu_ms={}".format(self.user_args["http_cpu_ms"])
+
+        # check rates can be delivered by http clients before the test
+        self.http_client_workers = 1
+        if self.user_args.get("http_calibration"):
+            calibration = self.calibrate_http_client()
+            self._iq.write(label="HTTP client calibration", value=str(calibration))
+            self.http_client_workers = self.plan_http_client_workers(calibration)
+            self._log.info("http_client_workers: %s" % self.http_client_workers)
+
+        # upload the replayed trace to every http client pod once
+        if self.user_args.get("http_trace"):
+            self.http_trace = dict(self.user_args["http_trace"])
+            self.http_trace["path"] = self.upload_http_trace(self.http_trace.pop("file"))
+            self._log.info("http_trace: %s" % self.http_trace)
 
         # create event to sync with monitor thread
         self.event = Event()
+        self.stream_thread = None
 
         self._iq.write(label="Start HPA test", value="")
         for cpu_util in self.user_args["cpu_util_list"]:
+            self.cpu_util = cpu_util
             self._iq.write(label="Start CPU util",
                            value="cpu_util: {}".format(cpu_util))
             self.update_target_cpu_util_in_hpa(cpu_util)
             # sleep some time to make hpa effective
             time.sleep(10)
-            for http_rate in self.user_args["http_rate_list"]:
-                self._iq.write(label="Start http client rate",
-                               value="http_rate: {}".format(http_rate))
-                self.start_http_client_rate(http_rate)
+            if self.user_args.get("cpu_load_steps"):
+                # exact cpu load steps held by the server pods themselves
+                for step in self.user_args["cpu_load_steps"]:
+                    self._iq.write(label="Start CPU load step", value="step: {}".format(step))
+                    spread_thread = DutyCycleSpreadThread(
+                        self, step["millicores"], step["duration"],
+                        "CPU load spread under CPU util: {}, CPU load: {}m".format(cpu_util, step["millicores"]))
+                    spread_thread.start()
+                    self.monitor_hpa_status(cpu_util, "{}m".format(step["millicores"]), step["duration"])
+                    spread_thread.stop()
+                    self._iq.write(label="End CPU load step", value="step: {}".format(step))
+            elif self.user_args.get("http_trace"):
+                # the trace is replayed by http client on its own clock
+                self._iq.write(label="Start http client trace",
+                               value="trace: {}".format(self.http_trace))
+                self.start_http_client_trace(self.http_trace)
+                self.start_http_client_stream("trace")
+                self.rate_time_begin = time.monotonic()
+                self.monitor_hpa_status(cpu_util, "trace")
+                self._iq.write(label="End http client trace", value="")
+            elif self.user_args.get("http_rate_profile"):
+                # the whole rate profile is executed by http client on its own clock
+                self._iq.write(label="Start http client profile",
+                               value="profile: {}".format(self.user_args["http_rate_profile"]))
+                self.start_http_client_profile(self.user_args["http_rate_profile"])
+                self.start_http_client_stream("profile")
                 self.rate_time_begin = time.monotonic()
-                self.monitor_hpa_status(cpu_util, http_rate)
-                self._iq.write(label="End http client rate",
-                               value="http_rate: {}".format(http_rate))
+                self.monitor_hpa_status(cpu_util, "profile")
+                self._iq.write(label="End http client profile", value="")
+            else:
+                for http_rate in self.user_args["http_rate_list"]:
+                    self._iq.write(label="Start http client rate",
+                                   value="http_rate: {}".format(http_rate))
+                    self.start_http_client_rate(http_rate)
+                    self.start_http_client_stream(http_rate)
+                    self.rate_time_begin = time.monotonic()
+                    self.monitor_hpa_status(cpu_util, http_rate)
+                    self._iq.write(label="End http client rate",
+                                   value="http_rate: {}".format(http_rate))
+            if not self.user_args.get("cpu_load_steps"):
+                self._iq.write(label="Server pods first request delay under CPU util: {}".format(cpu_util),
+                               value=str(self.get_server_pods_first_request_delay()))
             self._iq.write(label="End CPU util",
                            value="cpu_util: {}".format(cpu_util))
             
             # stop http traffic until replicas return to 1
             self._iq.write(label="Stop http client begin under cpu util: {}".format(cpu_util), value="")
-            self.stop_http_client()
+            self.stop_http_client_stream()
+            if not self.user_args.get("cpu_load_steps"):
+                self.stop_http_client()
             while True:
                 pod_status_list = self.get_server_pods_status(self.deployment_name)
                 self._iq.write(label="POD status", value=str(pod_status_list))